@@ -0,0 +1,492 @@
+#!/usr/bin/python3
+
+# This module writes tar archives that can be read selectively, and reads
+# single members from them without decompressing the whole archive.
+#
+# A seekable archive is a regular '.tar.gz' file, which consists of many
+# gzip members ("frames") instead of a single one. Each frame starts at a
+# member boundary of the tar stream and can be decompressed on its own.
+# Any tool that reads gzip files reads the archive as a whole, because
+# concatenated gzip members form a valid gzip file.
+#
+# Next to the archive we keep an index with the suffix '.idx':
+#
+#   btrcp-archive-index 1
+#   F <compressed offset> <uncompressed offset>
+#   ...
+#   M <frame> <offset> <size> <mtime> <type> <name>
+#   ...
+#
+# The 'F' lines list the frames with the offset of their first byte in the
+# archive file and the offset of their first byte in the tar stream. The
+# 'M' lines list the members of the archive with the frame their header
+# starts in and the offset of that header in the tar stream. Names are
+# escaped the same way as in manifests.
+
+
+
+import argparse
+import os
+import sys
+import tarfile
+import zlib
+import encryption
+import filters
+import manifest
+from runcmdutils import write_log, LogLevel, mk_cmd
+
+
+
+# This is the version of the script.
+script_version='1.0.0'
+
+# The magic string and format version at the beginning of each index.
+_indexMagic = 'btrcp-archive-index'
+_indexVersion = '1'
+
+# The suffix of index files.
+index_suffix = '.idx'
+
+# The amount of uncompressed data after which a new frame is started at
+# the next member boundary. Larger frames compress a bit better, smaller
+# frames make reading single members faster.
+default_frame_size = 4 * 1024 * 1024
+
+# The gzip compression level of the frames.
+_compressionLevel = 6
+
+# The number of bytes read from the tar process at once.
+_readSize = 1024 * 1024
+
+# The number of bytes we hold back from compression. The tarfile module
+# reads ahead of the member it reports, so the boundary of that member may
+# lie in data we have already read. A frame can only start at a boundary
+# that has not been compressed yet.
+_holdBack = 256 * 1024
+
+
+
+# Returns the name of the index of an archive.
+def index_file_of (archiveFile):
+    return archiveFile + index_suffix
+
+
+
+# Compresses a tar stream into gzip frames which start at member boundaries.
+# Bytes pass through this class on their way from the tar process to the
+# tarfile module, which tells us where the members start.
+class _FrameWriter:
+
+    def __init__ (self, source, sink, *, frameSize = default_frame_size):
+        self._source = source
+        self._sink = sink
+        self._frameSize = frameSize
+        # The uncompressed bytes which have not been compressed yet, and the
+        # offset of their first byte in the tar stream.
+        self._pending = bytearray()
+        self._pendingOffset = 0
+        self._compressor = None
+        self._compressedOffset = 0
+        self.frames = []
+        self._start_frame()
+
+    def _start_frame (self):
+        self._compressor = zlib.compressobj (_compressionLevel, zlib.DEFLATED, 31)
+        self.frames.append ((self._compressedOffset, self._pendingOffset))
+
+    def _write (self, data):
+        if (data):
+            self._sink.write (data)
+            self._compressedOffset += len (data)
+
+    def _finish_frame (self):
+        self._write (self._compressor.flush())
+
+    # Compresses all pending bytes up to the offset given.
+    def _compress_until (self, offset):
+        n = offset - self._pendingOffset
+        if (n <= 0):
+            return
+        self._write (self._compressor.compress (bytes (self._pending[:n])))
+        del self._pending[:n]
+        self._pendingOffset = offset
+
+    # This is called by the tarfile module.
+    def read (self, size = -1):
+        data = self._source.read (size if size > 0 else _readSize)
+        if (data):
+            self._pending.extend (data)
+            self._compress_until (self._pendingOffset + len (self._pending) - _holdBack)
+        return data
+
+    # Called for each member of the tar stream. Starts a new frame at the
+    # member's header if the current frame is big enough, and returns the
+    # number of the frame the header lies in.
+    def boundary (self, offset):
+        frameStart = self.frames[-1][1]
+        if (offset >= self._pendingOffset and offset - frameStart >= self._frameSize):
+            self._compress_until (offset)
+            self._finish_frame()
+            self._start_frame()
+        return len (self.frames) - 1
+
+    # Compresses whatever is left of the tar stream, including the blocks
+    # tar writes after the last member.
+    def close (self):
+        data = self._source.read (_readSize)
+        while (data):
+            self._pending.extend (data)
+            data = self._source.read (_readSize)
+        self._compress_until (self._pendingOffset + len (self._pending))
+        self._finish_frame()
+
+
+
+# Writes the index of an archive. 'members' is a list of tuples of the
+# frame number, offset, size, mtime, type and name of each member.
+def _format_index (frames, members):
+    lines = ['{0} {1}\n'.format (_indexMagic, _indexVersion)]
+    lines.extend (['F {0} {1}\n'.format (c, u) for c, u in frames])
+    lines.extend (['M {0} {1} {2} {3} {4} {5}\n'.format (f, o, s, int (m), t, manifest._escape (n)) for f, o, s, m, t, n in members])
+    return ''.join (lines)
+
+
+
+# An entry of the index.
+class IndexEntry:
+    __slots__ = ['frame', 'offset', 'size', 'mtime', 'type', 'name']
+
+    def __init__ (self, frame, offset, size, mtime, type, name):
+        self.frame = frame
+        self.offset = offset
+        self.size = size
+        self.mtime = mtime
+        self.type = type
+        self.name = name
+
+
+
+# Reads an index. Returns a tuple of the list of frames and the list of
+# IndexEntry instances, in the order of the archive. The index of an
+# encrypted archive is decrypted with the key.
+def read_index (indexFile, *, key = None):
+    frames = []
+    members = []
+    lines = read_text (indexFile, key = key).split ('\n')
+    if (lines[0].split() != [_indexMagic, _indexVersion]):
+        raise manifest.ManifestError ('\'{0}\' is not an archive index.'.format (indexFile))
+    for line in lines[1:]:
+        if (line.startswith ('F ')):
+            _, c, u = line.split()
+            frames.append ((int (c), int (u)))
+        elif (line.startswith ('M ')):
+            _, frame, offset, size, mtime, type, name = line.split (' ', 6)
+            members.append (IndexEntry (int (frame), int (offset), int (size), int (mtime), type, manifest._unescape (name)))
+    return (frames, members)
+
+
+
+# Returns the single character tar uses for the type of a member.
+def _member_type (member):
+    return member.type.decode ('ASCII') if member.type else '0'
+
+
+
+# Writes a file, which is a Path instance and may lie on a remote machine;
+# remote files are written by dd. Instead of a file, another stream with
+# write() and close() and a 'name' can be given, e.g. an upload to an object
+# store. If a key is given, the data is encrypted on its way, see the module
+# encryption.
+class Sink:
+
+    def __init__ (self, file, *, key = None, stream = None):
+        if (stream is not None):
+            self.name = stream.name
+            self._proc = None
+            self._file = stream
+        elif (file.is_remote_path()):
+            self.name = file.full_path()
+            self._proc = mk_cmd (['dd', 'of={0}'.format (file), 'bs=1M', 'status=none'], machine = file.get_context()).popen()
+            self._file = self._proc.stdin
+        else:
+            self.name = file.full_path()
+            self._proc = None
+            self._file = open (file.path, 'wb')
+        self._writer = encryption.Writer (self._file, key) if key is not None else None
+
+    def write (self, data):
+        return (self._writer or self._file).write (data)
+
+    # Closes the file, and returns the exit code of dd or 0 for local files.
+    def close (self):
+        try:
+            if (self._writer is not None):
+                self._writer.close()
+        finally:
+            self._file.close()
+            if (self._proc is not None):
+                self._proc.wait()
+        return self._proc.returncode if self._proc is not None else 0
+
+
+
+# Writes a text file, e.g. an index, which is a Path instance and may lie
+# on a remote machine, or to a stream as for Sink. If a key is given, the
+# file is encrypted. Returns the exit code of dd, or 0.
+def write_text (file, text, *, key = None, stream = None):
+    if (key is None and stream is None):
+        file.write (text)
+        return 0
+    sink = Sink (file, key = key, stream = stream)
+    try:
+        sink.write (text.encode ('UTF-8', errors = 'surrogateescape'))
+    finally:
+        exitCode = sink.close()
+    return exitCode
+
+
+
+# Reads a local text file, which is decrypted with the key if it has been
+# encrypted.
+def read_text (fileName, *, key = None):
+    with encryption.open_file (fileName, key) as f:
+        return f.read().decode ('UTF-8', errors = 'surrogateescape')
+
+
+
+# Runs tar on the sources and writes a seekable archive and its index. The
+# archive is a Path instance and may lie on a remote machine. Returns the
+# exit code of tar. The index is written next to the archive, unless
+# another Path is given as 'indexFile'. If 'filesFrom' is given, it names
+# a local file with a NUL-separated list of the paths to archive, which tar
+# reads instead of recursing through the files. If a key is given, the
+# archive and its index are encrypted with it; the offsets of the frames
+# refer to the decrypted archive. The archive and the index can be written
+# to streams instead of files, see Sink. If 'count' is given, it is called
+# with the number of bytes and regular files that have been archived.
+def create_seekable_archive (archiveFile, files, *, excludes = [], frameSize = default_frame_size, indexFile = None, filesFrom = None, key = None, stream = None, indexStream = None, count = None):
+    # tar reads the file of exclude rules while it is running.
+    with filters.tar_exclude_args (filters.as_rules (excludes)) as excludeArgs:
+        args = ['tar', '--numeric-owner', '--sparse', '-cf', '-'] + excludeArgs
+        if (filesFrom):
+            args.extend (['--null', '--no-recursion', '-T', filesFrom])
+        args.extend ([str(f) for f in files])
+        tarProc = mk_cmd (args).popen (stderr = None)
+        sink = Sink (archiveFile, key = key, stream = stream)
+
+        members = []
+        regular = []
+        try:
+            writer = _FrameWriter (tarProc.stdout, sink, frameSize = frameSize)
+            with tarfile.open (fileobj = writer, mode = 'r|') as tar:
+                for member in tar:
+                    frame = writer.boundary (member.offset)
+                    members.append ((frame, member.offset, member.size, member.mtime, _member_type (member), member.name))
+                    if (member.isreg()):
+                        regular.append (member.size)
+            writer.close()
+        finally:
+            sinkCode = sink.close()
+        exitCode = tarProc.wait()
+        if (sinkCode != 0):
+            write_log ('Writing the archive \'{0}\' failed with exit code {1}.'.format (sink.name, sinkCode), LogLevel.ERROR)
+            return sinkCode
+
+    write_log ('Wrote {0} members in {1} frames to \'{2}\'.'.format (len (members), len (writer.frames), sink.name))
+    if (count is not None):
+        count (sum (regular), len (regular))
+    if (indexFile is None and indexStream is None):
+        indexFile = archiveFile._copy (index_file_of (archiveFile.path))
+    indexCode = write_text (indexFile, _format_index (writer.frames, members), key = key, stream = indexStream)
+    return exitCode or indexCode
+
+
+
+# Reads the tar stream of a seekable archive from the beginning of a frame
+# on. The gzip members following that frame are read as well, so the
+# stream continues until the end of the archive.
+class _FrameReader:
+
+    def __init__ (self, f, frame):
+        self._file = f
+        self._file.seek (frame[0])
+        self._decompressor = zlib.decompressobj (31)
+        self._buffer = b''
+        self.position = frame[1]
+
+    def _fill (self):
+        while (not self._buffer):
+            if (self._decompressor.eof):
+                unused = self._decompressor.unused_data
+                self._decompressor = zlib.decompressobj (31)
+                data = unused or self._file.read (_readSize)
+            else:
+                data = self._decompressor.unconsumed_tail or self._file.read (_readSize)
+            if (not data):
+                return False
+            self._buffer = self._decompressor.decompress (data, _readSize)
+        return True
+
+    def read (self, size):
+        res = []
+        while (size > 0 and self._fill()):
+            chunk = self._buffer[:size]
+            self._buffer = self._buffer[len (chunk):]
+            self.position += len (chunk)
+            size -= len (chunk)
+            res.append (chunk)
+        return b''.join (res)
+
+    def skip_to (self, offset):
+        while (self.position < offset):
+            if (not self.read (min (offset - self.position, _readSize))):
+                break
+
+
+
+# Exposes a window of the tar stream to the tarfile module, which ends at
+# the header of the next member.
+class _Window:
+
+    def __init__ (self, reader, end):
+        self._reader = reader
+        self._end = end
+
+    def read (self, size = -1):
+        if (size < 0):
+            size = _readSize
+        if (self._end is not None):
+            size = min (size, self._end - self._reader.position)
+        return self._reader.read (size) if size > 0 else b''
+
+
+
+# Returns True if the member lies at or below one of the paths given.
+def _is_selected (name, paths):
+    name = name.rstrip ('/')
+    for p in paths:
+        p = p.strip ('/')
+        if (name == p or name.startswith (p + '/')):
+            return True
+    return False
+
+
+
+# Reads member i of the index from the archive and hands its TarInfo to
+# 'extract' together with the tarfile it has been read with. 'reader' is the
+# reader of the member read before, or None. Returns the reader used.
+def _read_member (f, frames, members, i, reader, extract):
+    m = members[i]
+    # We only start at the member's frame if we cannot get there by reading
+    # on from where we are, e.g. the members are in the same or the
+    # following frame.
+    if (reader is None or reader.position > m.offset or frames[m.frame][1] > reader.position):
+        reader = _FrameReader (f, frames[m.frame])
+    reader.skip_to (m.offset)
+    end = members[i + 1].offset if i + 1 < len (members) else None
+    with tarfile.open (fileobj = _Window (reader, end), mode = 'r|') as tar:
+        for member in tar:
+            extract (tar, member)
+            break
+    return reader
+
+
+
+# Extracts the members of a seekable archive that lie at or below the paths
+# given into the target directory. Only the frames holding these members
+# are decompressed, and of an encrypted archive only the chunks holding
+# these frames are decrypted. Hard links whose targets are not extracted
+# get the data of their targets. Returns the number of members extracted.
+def extract (archiveFile, paths, targetDir, *, indexFile = None, key = None):
+    frames, members = read_index (indexFile or index_file_of (archiveFile), key = key)
+    selected = [i for i, m in enumerate (members) if _is_selected (m.name, paths)]
+    byName = {m.name: i for i, m in enumerate (members)}
+    links = []
+    count = 0
+
+    def extract_selected (tar, member):
+        nonlocal count
+        # A hard link can only be made if its target is already there.
+        if (member.islnk() and not os.path.lexists (os.path.join (targetDir, member.linkname))):
+            links.append (member)
+            return
+        tar.extract (member, targetDir, numeric_owner = True)
+        count += 1
+
+    with encryption.open_file (archiveFile, key) as f:
+        reader = None
+        for i in selected:
+            reader = _read_member (f, frames, members, i, reader, extract_selected)
+
+        # The target of each of the other links is read from its own frame
+        # and extracted under the name of the first link to it, the other
+        # links to it are linked to that one.
+        copies = {}
+        for link in links:
+            if (link.linkname in copies):
+                linkPath = os.path.join (targetDir, link.name)
+                os.makedirs (os.path.dirname (linkPath), exist_ok = True)
+                os.link (os.path.join (targetDir, copies[link.linkname]), linkPath)
+                count += 1
+                continue
+            target = byName.get (link.linkname)
+            if (target is None):
+                write_log ('The target \'{0}\' of the hard link \'{1}\' is not in the archive, the link is not extracted.'.format (link.linkname, link.name), LogLevel.ERROR)
+                continue
+
+            def extract_as_link (tar, member):
+                member.name = link.name
+                tar.extract (member, targetDir, numeric_owner = True)
+
+            _read_member (f, frames, members, target, None, extract_as_link)
+            copies[link.linkname] = link.name
+            count += 1
+    return count
+
+
+
+# Lists the members of a seekable archive from its index only.
+def list_members (archiveFile, *, indexFile = None, key = None):
+    return read_index (indexFile or index_file_of (archiveFile), key = key)[1]
+
+
+
+def init_arg_parser():
+    parser = argparse.ArgumentParser(prog='btrcp-archive', description='Lists and extracts members of seekable archives written by btrcp.')
+    parser.add_argument ('archive_file', metavar='ARCHIVE', help='Specifies the archive.')
+    parser.add_argument ('paths', metavar='PATH', nargs='*', help='Specifies the members to extract. Directories are extracted with all their contents.')
+    parser.add_argument ('--list', dest = 'list_members', required = False, action = 'store_const', const = True, help = 'lists the members of the archive.')
+    parser.set_defaults (list_members = False)
+    parser.add_argument ('--target', '-t', dest = 'target_dir', required = False, metavar='PATH', default = '.', help='Specifies the directory the members are extracted to.')
+    parser.add_argument ('--index', dest = 'index_file', required = False, metavar='FILE', default = None, help='Specifies the index. By default the index is expected next to the archive.')
+    parser.add_argument ('--key-file', '-k', dest = 'key_file', required = False, metavar='FILE', default = None, help='Specifies the key file of an encrypted archive.')
+    parser.add_argument ('--version', action = 'version', version = '%(prog)s {0}'.format (script_version))
+    return parser
+
+
+
+def parse_args(*args):
+    parser = init_arg_parser()
+    return parser.parse_args(*args)
+
+
+
+def main(*args):
+    args = parse_args (*args)
+    try:
+        key = encryption.read_key (args.key_file) if args.key_file else None
+        if (args.list_members):
+            for m in list_members (args.archive_file, indexFile = args.index_file, key = key):
+                print ('{0} {1:>14} {2} {3}'.format (m.type, m.size, m.mtime, m.name))
+            return 0
+        count = extract (args.archive_file, args.paths, args.target_dir, indexFile = args.index_file, key = key)
+    except (OSError, encryption.EncryptionError) as e:
+        write_log ('{0}'.format (e), LogLevel.ERROR)
+        return 1
+    write_log ('Extracted {0} members from \'{1}\'.'.format (count, args.archive_file))
+    return 0 if count > 0 else 1
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -50,7 +50,7 @@ def init_arg_parser():
     parser.add_argument ('--log-file', '-l', dest = 'log_file_name', required = False, metavar = 'FILENAME', help = 'Specifies the name of a log file.')
     parser.add_argument ('--quiet', dest = 'silent_mode', required = False, action = 'store_const', const = True, help = 'Suppresses all console output of this script.')
     parser.set_defaults (silent_mode = False)
-    parser.add_argument ('--dry-run', dest = 'dry_run', required = False, action = 'store_const', const = True, help = 'Make this a dry-run, actions are only logged.')
+    parser.add_argument ('--dry-run', dest = 'dry_run', required = False, action = 'store_const', const = True, help = 'Make this a dry-run: lists the operations of the backups without executing them, and estimates how much data would be copied and how long that would take.')
     parser.set_defaults (dry_run=False)
     parser.add_argument ('--version', action = 'version', version = '%(prog)s {0}'.format (script_version))
     return parser
@@ -230,6 +230,9 @@ def backup_lxc_container (containerName):
     # Check the container's state once again to make sure that
     # we work with a container that is really in the state STOPPED
     containerState = get_lxc_container_state (containerName)
+    # A dry-run only plans to stop the container.
+    if (containerWasStoppedByScript and runcmdutils.is_planning()):
+        containerState = 'STOPPED'
     if (enforceStopContainer and containerState != 'STOPPED'):
         write_log ('Container \'{0}\' is not in the correct state for a backup. The current state is \'{1}\''.format (containerName, containerState))
         return False
@@ -277,7 +280,18 @@ def start_backup():
 def inner_main(*args):
     args = parse_args (*args)
     init_env (args)
-    return start_backup()
+    if (not env.dry_run):
+        return start_backup()
+
+    # Plan the backups of all containers, including stopping and starting
+    # them, instead of executing them.
+    runcmdutils.start_plan()
+    try:
+        res = start_backup()
+    finally:
+        plan = runcmdutils.finish_plan()
+    btrcp.write_plan_report (plan)
+    return res
 
 
 
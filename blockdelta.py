@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+
+# This module copies large files, like the disk images of containers and
+# virtual machines, block by block. Such files are huge but only a few of
+# their blocks change between two backups, while rsync either rewrites
+# them completely (local copies) or reads both sides to find the changes.
+#
+# The file is mapped into memory and its fixed-size blocks are hashed in
+# parallel. The hashes are compared against the block index of the file
+# from the previous backup, and only the blocks whose hashes differ are
+# written into the file in the new backup, in place. In a snapshot of the
+# previous backup all other blocks keep sharing their extents with it.
+#
+# The block indices of a backup are kept next to it, i.e. the index of the
+# file 'home/vm.img' in the snapshot 'host/2022-01-01-12-00' is
+# 'host/2022-01-01-12-00.blocks/home/vm.img.blk'. An index has a header line
+#
+#   btrcp-blocks 1 <algorithm> <block size> <size> <mtime in ns>
+#
+# with the size and mtime of the file it describes, followed by the binary
+# digests of all blocks.
+
+
+
+import concurrent.futures
+import mmap
+import os
+import manifest
+import runcmdutils
+from runcmdutils import write_log, LogLevel
+
+
+
+# The size of the blocks that are compared.
+default_block_size = 1024 * 1024
+
+# The suffix of the directory with the block indices of a backup.
+blocks_suffix = '.blocks'
+
+# The suffix of each block index.
+_indexSuffix = '.blk'
+
+# The magic string and format version at the beginning of each index.
+_indexMagic = 'btrcp-blocks'
+_indexVersion = '1'
+
+# The number of blocks a worker thread hashes at once.
+_batchBlocks = 64
+
+
+
+# Returns the directory of the block indices of a backup.
+def blocks_dir_of (backupPath):
+    return backupPath.rstrip (os.sep) + blocks_suffix
+
+
+
+# Returns the block index of a file, given relative to its backup.
+def index_file_of (blocksDir, relPath):
+    return os.path.join (blocksDir, relPath.lstrip (os.sep) + _indexSuffix)
+
+
+
+# The block hashes of a file, together with the size and mtime of the file
+# they have been taken from.
+class BlockIndex:
+    def __init__ (self, algorithm, blockSize, size, mtime, digests):
+        self.algorithm = algorithm
+        self.blockSize = blockSize
+        self.size = size
+        self.mtime = mtime
+        self.digests = digests
+
+    # Returns True if the index describes a file with the given stat result.
+    def matches (self, st):
+        return self.size == st.st_size and self.mtime == st.st_mtime_ns
+
+
+
+def read_index (indexFile):
+    with open (indexFile, 'rb') as f:
+        header = f.readline().decode ('ASCII').split()
+        if (len (header) != 6 or header[0] != _indexMagic or header[1] != _indexVersion):
+            raise manifest.ManifestError ('The block index \'{0}\' has no valid header.'.format (indexFile))
+        algorithm = header[2]
+        blockSize, size, mtime = [int (h) for h in header[3:]]
+        data = f.read()
+    digestSize = len (manifest._mk_hasher (algorithm).digest())
+    digests = [data[i : i + digestSize] for i in range (0, len (data), digestSize)]
+    if (len (digests) != (size + blockSize - 1) // blockSize):
+        raise manifest.ManifestError ('The block index \'{0}\' is truncated.'.format (indexFile))
+    return BlockIndex (algorithm, blockSize, size, mtime, digests)
+
+
+
+# Writes a block index. It is written to a temporary file first, so that
+# an interrupted run never leaves an index which does not match its file.
+def write_index (indexFile, index):
+    with runcmdutils.atomic_write (indexFile, 'wb', makeDirs = True) as f:
+        f.write ('{0} {1} {2} {3} {4} {5}\n'.format (_indexMagic, _indexVersion, index.algorithm, index.blockSize, index.size, index.mtime).encode ('ASCII'))
+        f.write (b''.join (index.digests))
+
+
+
+# Reads a block index, returns None if it does not exist or cannot be used.
+def _read_usable_index (indexFile, algorithm, blockSize):
+    try:
+        index = read_index (indexFile)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, manifest.ManifestError) as e:
+        write_log ('The block index \'{0}\' cannot be used: {1}'.format (indexFile, e), LogLevel.WARNING)
+        return None
+    if (index.algorithm != algorithm or index.blockSize != blockSize):
+        return None
+    return index
+
+
+
+def _hash_batch (view, first, count, blockSize, algorithm):
+    digests = []
+    for i in range (first, first + count):
+        hasher = manifest._mk_hasher (algorithm)
+        hasher.update (view[i * blockSize : (i + 1) * blockSize])
+        digests.append (hasher.digest())
+    return digests
+
+
+
+# Hashes the blocks of a file. The file is mapped into memory and batches
+# of blocks are hashed by a pool of threads; the hash functions release
+# the GIL, so the threads run in parallel.
+def hash_blocks (path, *, blockSize = default_block_size, algorithm = None, workers = None):
+    algorithm = algorithm or manifest.default_algorithm()
+    with open (path, 'rb') as f:
+        size = os.fstat (f.fileno()).st_size
+        if (size == 0):
+            return []
+        with mmap.mmap (f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+            view = memoryview (mm)
+            try:
+                count = (size + blockSize - 1) // blockSize
+                batches = [(i, min (_batchBlocks, count - i)) for i in range (0, count, _batchBlocks)]
+                with concurrent.futures.ThreadPoolExecutor (max_workers = workers) as pool:
+                    results = pool.map (lambda b: _hash_batch (view, b[0], b[1], blockSize, algorithm), batches)
+                    return [d for digests in results for d in digests]
+            finally:
+                view.release()
+
+
+
+def _copy_attributes (dest, st):
+    os.chmod (dest, st.st_mode & 0o7777)
+    try:
+        os.chown (dest, st.st_uid, st.st_gid)
+    except PermissionError:
+        pass
+    os.utime (dest, ns = (st.st_atime_ns, st.st_mtime_ns))
+
+
+
+# Returns True if the file in the backup is the same as the source file,
+# as far as the block index of the previous backup tells.
+def is_unchanged (source, dest, previousIndex, *, blockSize = default_block_size):
+    previous = _read_usable_index (previousIndex, manifest.default_algorithm(), blockSize)
+    try:
+        return previous is not None and previous.matches (os.stat (source)) and previous.matches (os.stat (dest))
+    except FileNotFoundError:
+        return False
+
+
+
+# Copies a large file into a backup, writing only the blocks that changed.
+# 'dest' is the file in the new backup, which is a copy of the file in the
+# previous backup (or the same file, if backups are updated in place).
+# 'previousIndex' is the block index of the file in the previous backup,
+# and 'newIndex' is where the index of the new backup is written to.
+# Without a usable previous index, the blocks of 'dest' are hashed instead.
+# Returns the number of bytes written, which is 0 if the file did not
+# change since the previous backup.
+def sync_file (source, dest, previousIndex, newIndex, *, blockSize = default_block_size, workers = None):
+    algorithm = manifest.default_algorithm()
+    st = os.stat (source)
+    try:
+        destSt = os.stat (dest)
+    except FileNotFoundError:
+        destSt = None
+
+    previous = _read_usable_index (previousIndex, algorithm, blockSize) if destSt is not None else None
+    if (previous is not None and not previous.matches (destSt)):
+        write_log ('The block index \'{0}\' does not match \'{1}\'.'.format (previousIndex, dest), LogLevel.DEBUG)
+        previous = None
+    if (previous is not None and previous.matches (st)):
+        if (newIndex != previousIndex):
+            write_index (newIndex, previous)
+        return 0
+
+    # The new index is written last, an interrupted run must not leave an
+    # index that claims blocks which have not been written.
+    if (newIndex == previousIndex and os.path.exists (newIndex)):
+        os.remove (newIndex)
+
+    sourceDigests = hash_blocks (source, blockSize = blockSize, algorithm = algorithm, workers = workers)
+    if (previous is not None):
+        destDigests = previous.digests
+    elif (destSt is not None):
+        destDigests = hash_blocks (dest, blockSize = blockSize, algorithm = algorithm, workers = workers)
+    else:
+        destDigests = []
+        os.makedirs (os.path.dirname (dest), exist_ok = True)
+
+    changed = [i for i, d in enumerate (sourceDigests) if i >= len (destDigests) or destDigests[i] != d]
+    written = 0
+    fd = os.open (dest, os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        with open (source, 'rb') as f:
+            if (changed):
+                with mmap.mmap (f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                    for i in changed:
+                        block = mm[i * blockSize : (i + 1) * blockSize]
+                        os.pwrite (fd, block, i * blockSize)
+                        written += len (block)
+        os.ftruncate (fd, st.st_size)
+        os.fsync (fd)
+    finally:
+        os.close (fd)
+    _copy_attributes (dest, st)
+
+    write_log ('Wrote {0} of {1} blocks of \'{2}\'.'.format (len (changed), len (sourceDigests), dest))
+    write_index (newIndex, BlockIndex (algorithm, blockSize, st.st_size, st.st_mtime_ns, sourceDigests))
+    return written
@@ -1,23 +1,47 @@
 #!/usr/bin/python3
 
 
+import archive
 import argparse
+import asyncio
+import blockdelta
+import changejournal
+import concurrent.futures
+import contextlib
+import cProfile
 from asyncio import format_helpers
 from asyncio.log import logger
 import datetime
+import encryption
+import fanout
 from datetime import timedelta
 from enum import Enum
+import filters
+import functools
 import getpass
 import glob
-import itertools
+import hashlib
+import history
+import linktuning
+import manifest
+import objectstore
 import os
 import plumbum as pb
-from prelude import identity, fst, snd, concat
+import prelude
+from prelude import identity, fst, snd
 import runcmdutils
-from runcmdutils import Path, set_log_level, write_log, LogLevel, run_cmd, mk_cmd
+from runcmdutils import Path, set_log_level, write_log, LogLevel, run_cmd, mk_cmd, CommandLine
+import shards
 import signal
+import sizes
 import sys
 import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import tracing
+from tracing import traced
 from urllib.parse import urlparse
 
 
@@ -63,10 +87,105 @@ class Environment:
     # Tells rsync to ignore read-errors
     ignore_errors = False
 
+    # The name of the run journal, which is kept in the destination
+    # directory of each host. It records the phase of the running backup,
+    # so that the next run can resume an interrupted backup.
+    run_journal_name = '.btrcp-run'
+
+    # The name of the file in the destination directory of each host that
+    # records which snapshot each snapshot of strategy 3 has been taken of.
+    parents_file_name = '.btrcp-parents'
+
+    # Writes a manifest with the hashes of all files next to each backup,
+    # which can be checked later on with the verify command.
+    write_manifests = False
+
+    # Writes archives of strategy 1 in independently compressed frames and
+    # keeps an index next to them, so single files can be restored quickly.
+    seekable_archives = False
+
+    # Splits the sources of strategy 1 into this many archives of about the
+    # same size, which are written concurrently, see the module shards.
+    archive_shards = 1
+
+    # Encrypts the archives of strategy 1 with the key read from this file,
+    # see the module encryption.
+    encryption_key_file = None
+    encryption_key = None
+
+    # The endpoint of the object store of destinations given as s3:// URLs,
+    # or None for Amazon S3, and the size and number of the parts that are
+    # uploaded concurrently, see the module objectstore.
+    s3_endpoint = None
+    s3_part_size = objectstore.default_part_size
+    s3_workers = objectstore.default_workers
+
+    # Files of at least this many bytes are copied block by block by the
+    # rsync-based strategies, see the module blockdelta. 0 turns this off.
+    large_file_size = 0
+
+    # Copies the sources of the rsync-based strategies from temporary
+    # read-only snapshots of their BTRFS subvolumes, see _source_snapshots().
+    snapshot_source = False
+
+    # Enables the quotas of BTRFS destinations, whose quota groups tell the
+    # sizes of the snapshots of strategy 3, see the module sizes.
+    enable_quota = False
+
+    # The capacity policy of strategies 1 and 3: before a backup, the oldest
+    # backups of the host are removed until the destination keeps at least
+    # min_free_percent of its space free, and the backups of the host take
+    # at most host_budget bytes. 0 turns either limit off.
+    min_free_percent = 0
+    host_budget = 0
+
+    # If set, the timed spans of the run are written to this file in the
+    # Chrome trace event format.
+    trace_file = None
+
+    # If set, the cProfile statistics of the run are written to this file.
+    profile_file = None
+
+    # Only plans the backup instead of executing it, see plan_backup().
+    dry_run = False
+
+    # Each completed backup is recorded in this file, to predict how long
+    # planned backups will take.
+    history_file = history.default_history_file
+
+    # If set, the last runs of the history are written to this file as
+    # metrics in the OpenMetrics text format after each backup.
+    metrics_file = None
+
+    # Tunes the options of rsync to the link to remote destinations. The
+    # measurements of each link are cached in link_tuning_file and
+    # repeated after link_tuning_days days.
+    link_tuning = True
+    link_tuning_file = linktuning.default_cache_file
+    link_tuning_days = linktuning.default_max_age_days
+
+    # The journal file written by the change journal watcher. If set,
+    # rsync-based strategies only copy the paths recorded in it.
+    change_journal = None
+
+    # The state file of the find-new mode. If set, rsync-based strategies
+    # ask BTRFS which files of the source subvolumes changed since the
+    # generation recorded in this file.
+    find_new_state = None
+
+    # The number of days after which the find-new mode scans the sources
+    # completely, which removes files that have been deleted in the meantime.
+    full_scan_days = 7
+
+    # Files with include and exclude rules, see the module filters.
+    filter_files = []
+    exclude_files = []
+
     host_name = None
     source_dirs = []
     excluded_dirs = []
-    dest_dir = '.'
+    # The backup is written to each of the destinations, see backup_to_many().
+    dest_dirs = ['.']
 
 
 
@@ -140,7 +259,9 @@ def init_arg_parser():
     parser.add_argument ('--source-dir', dest = 'source_dirs', required = False, action = 'deprecated', default = [], metavar='PATH', help='This argument has been deprecated and will be removed in future versions of this script\n Please use the option --source instead.')
     parser.add_argument ('--exclude', '-e', dest = 'excluded_dirs', required = False, action = 'append', default = [], metavar='PATH', help='Specifies a source directories to backup. This option can be used multiple times in one command.')
     parser.add_argument ('--exclude-dir', dest = 'excluded_dirs', required = False, action = 'deprecated', default = [], metavar='PATH', help='This argument has been deprecated and will be removed in future versions of this script\n Please use the option --exclude instead.')
-    parser.add_argument ('--dest-dir', '-d', dest = 'dest_dir', required = False, default='.', metavar='PATH', help='Specifies the destination directory where the backups will be written to.')
+    parser.add_argument ('--exclude-from', dest = 'exclude_files', required = False, action = 'append', default = [], metavar = 'FILE', help = 'reads patterns to exclude from FILE, one on each line. This option can be used multiple times in one command.')
+    parser.add_argument ('--filter-from', dest = 'filter_files', required = False, action = 'append', default = [], metavar = 'FILE', help = 'reads include (\'+ PATTERN\') and exclude (\'- PATTERN\') rules from FILE, which take precedence over all excludes. This option can be used multiple times in one command.')
+    parser.add_argument ('--dest-dir', '-d', dest = 'dest_dirs', required = False, action = 'append', default = [], metavar='PATH', help='Specifies the destination directory where the backups will be written to. This option can be used multiple times in one command, the sources are then read once for all destinations as far as possible.')
     parser.add_argument ('--hostname', dest = 'host_name', required = False, metavar = 'NAME', default = None, help = 'sets the alternate hostname to be used instead of the local machines own hostname.')
     parser.add_argument ('--strategy', dest = 'backup_strategy', required = False, metavar = 'NUM', default = None, help = 'sets the backup strategy to use. Supported values are 1, 2, 3, 4.')
     parser.add_argument ('--days-off', dest = 'days_off_str', required = False, metavar = 'NUM', default = '2', help = 'set the number of days to offset the retention strategy, i.e. deletion of backups will only start after NUM days.')
@@ -153,12 +274,40 @@ def init_arg_parser():
     parser.set_defaults (sync_mode = False)
     parser.add_argument ('--ignore-errors', dest = 'ignore_errors', required = False, action = 'store_const', const = True, help = 'tells rsync (if used for the backup) to ignore read-errors.')
     parser.set_defaults (ignore_errors = False)
+    parser.add_argument ('--change-journal', dest = 'change_journal', required = False, metavar = 'FILE', default = None, help = 'only copies the paths recorded in the journal FILE by the change journal watcher. Falls back to a full scan if the journal cannot be used.')
+    parser.add_argument ('--find-new', dest = 'find_new_state', required = False, metavar = 'FILE', default = None, help = 'only copies the files of BTRFS source subvolumes that changed since the generation recorded in the state FILE.')
+    parser.add_argument ('--full-scan-days', dest = 'full_scan_days_str', required = False, metavar = 'NUM', default = '7', help = 'sets the number of days after which --find-new scans the sources completely to pick up deleted files.')
+    parser.add_argument ('--manifest', dest = 'write_manifests', required = False, action = 'store_const', const = True, help = 'writes a manifest of each backup that can be verified later on. Only supported for local destinations.')
+    parser.set_defaults (write_manifests = False)
+    parser.add_argument ('--seekable-archive', dest = 'seekable_archives', required = False, action = 'store_const', const = True, help = 'writes the archive of strategy 1 in independently compressed frames with an index, which allows to list and restore single files quickly.')
+    parser.set_defaults (seekable_archives = False)
+    parser.add_argument ('--archive-shards', dest = 'archive_shards_str', required = False, metavar = 'NUM', default = '1', help = 'splits the sources of strategy 1 into NUM archives of about the same size, which are written concurrently and kept as one backup.')
+    parser.add_argument ('--encrypt-key', dest = 'encryption_key_file', required = False, metavar = 'FILE', default = None, help = 'encrypts the archives of strategy 1 and their indices with the key in FILE, see encryption.py --generate-key.')
+    parser.add_argument ('--s3-endpoint', dest = 's3_endpoint', required = False, metavar = 'URL', default = None, help = 'sets the endpoint of the object store of destinations given as s3://BUCKET/PREFIX, e.g. http://localhost:9000 for MinIO. Default is Amazon S3.')
+    parser.add_argument ('--s3-part-size', dest = 's3_part_size_str', required = False, metavar = 'MIB', default = str (objectstore.default_part_size // 1048576), help = 'sets the size of the parts of uploads to object stores in mebibytes, at least 5. Default is {0}.'.format (objectstore.default_part_size // 1048576))
+    parser.add_argument ('--s3-workers', dest = 's3_workers_str', required = False, metavar = 'NUM', default = str (objectstore.default_workers), help = 'sets the number of parts that are uploaded to object stores concurrently. Default is {0}.'.format (objectstore.default_workers))
+    parser.add_argument ('--large-file-size', dest = 'large_file_size_str', required = False, metavar = 'MIB', default = '0', help = 'copies files of at least MIB mebibytes, like disk images, block by block and writes only the blocks that changed since the previous backup. Only supported for local sources and destinations.')
+    parser.add_argument ('--snapshot-source', dest = 'snapshot_source', required = False, action = 'store_const', const = True, help = 'copies each source from a temporary read-only snapshot of the BTRFS subvolume it lies in, which is deleted after the backup (strategies 2 and 3).')
+    parser.set_defaults (snapshot_source = False)
+    parser.add_argument ('--enable-quota', dest = 'enable_quota', required = False, action = 'store_const', const = True, help = 'enables the quotas of the BTRFS destination of strategy 3 if they are not enabled yet, so that the sizes of the snapshots can be read from their quota groups.')
+    parser.set_defaults (enable_quota = False)
+    parser.add_argument ('--min-free', dest = 'min_free_percent_str', required = False, metavar = 'PERCENT', default = '0', help = 'removes the oldest backups of the host before a backup until PERCENT of the destination stays free after it, and does not start a backup that cannot fit (strategies 1 and 3).')
+    parser.add_argument ('--host-budget', dest = 'host_budget_str', required = False, metavar = 'GIB', default = '0', help = 'removes the oldest backups of the host before a backup until all of its backups take at most GIB gibibytes, and does not start a backup that cannot fit (strategies 1 and 3).')
+    parser.add_argument ('--trace', dest = 'trace_file', required = False, metavar = 'FILE', default = None, help = 'writes the time spent in each phase and command of the backup to FILE, which can be loaded into a trace viewer like chrome://tracing.')
+    parser.add_argument ('--profile', dest = 'profile_file', required = False, metavar = 'FILE', default = None, help = 'writes cProfile statistics of the script to FILE.')
+    parser.add_argument ('--no-link-tuning', dest = 'link_tuning', required = False, action = 'store_const', const = False, help = 'uses the same rsync options for remote destinations as for local ones, instead of tuning compression, delta transfer and the ssh cipher to the link.')
+    parser.set_defaults (link_tuning = True)
+    parser.add_argument ('--link-tuning-days', dest = 'link_tuning_days_str', required = False, metavar = 'NUM', default = str (linktuning.default_max_age_days), help = 'sets the number of days after which the link to a remote destination is measured again. Default is {0}.'.format (linktuning.default_max_age_days))
     parser.add_argument ('--log-file', dest = 'log_file_name', required = False, metavar = 'FILENAME', help = 'Specifies the name of a log file.')
     parser.add_argument ('--log-level', '-l', dest = 'log_level', required = False, metavar = 'LEVEL', default = 'WARN', help = 'Specifies the log level useb by the script, valied values are DEBUG, INFO, WARN, WARNING, CRITICAL, and ERROR.')
+    parser.add_argument ('--log-json', dest = 'log_json', required = False, action = 'store_const', const = True, help = 'Writes each log record as a JSON object on a line of its own.')
+    parser.set_defaults (log_json = False)
     parser.add_argument ('--quiet', dest = 'silent_mode', required = False, action = 'store_const', const = True, help = 'Suppresses all console output of this script.')
     parser.set_defaults (silent_mode = False)
-    parser.add_argument ('--dry-run', dest = 'dry_run', required = False, action = 'store_const', const = True, help = 'Make this a dry-run, actions are only logged.')
+    parser.add_argument ('--dry-run', dest = 'dry_run', required = False, action = 'store_const', const = True, help = 'Make this a dry-run: lists the operations of the backup without executing them, and estimates how much data would be copied and how long that would take.')
     parser.set_defaults (dry_run=False)
+    parser.add_argument ('--history', dest = 'history_file', required = False, metavar = 'FILE', default = history.default_history_file, help = 'sets the file completed backups are recorded in, which is used to predict the duration of dry-runs. Default is {0}.'.format (history.default_history_file.replace ('%', '%%')))
+    parser.add_argument ('--metrics', dest = 'metrics_file', required = False, metavar = 'FILE', default = None, help = 'writes the last backup runs of the history to FILE in the OpenMetrics text format after each backup, e.g. for the textfile collector of node_exporter.')
     parser.add_argument ('--version', action = 'version', version = '%(prog)s {0}'.format (script_version))
     return parser
 
@@ -196,6 +345,10 @@ def init_env (args):
     if (args.log_file_name):
         env.log_file_name = args.log_file_name
         runcmdutils.add_log_file_handler (env.log_file_name)
+    # Write the log records as JSON objects if they are to be processed
+    # by other tools.
+    if (args.log_json):
+        runcmdutils.use_json_log_records()
     # Converts the string of --days-off to an integer
     env.days_off = int (args.days_off_str)
     # If a backup strategy is given, convert that string
@@ -205,10 +358,34 @@ def init_env (args):
     env.host_name = args.host_name
     env.source_dirs = args.source_dirs
     env.excluded_dirs = args.excluded_dirs
-    env.dest_dir = args.dest_dir
+    env.exclude_files = args.exclude_files
+    env.filter_files = args.filter_files
+    env.dest_dirs = args.dest_dirs or ['.']
     env.stay_on_file_system = args.stay_on_file_system
     env.preserve_path = args.preserve_path
     env.ignore_errors = args.ignore_errors
+    env.change_journal = args.change_journal
+    env.find_new_state = args.find_new_state
+    env.full_scan_days = int (args.full_scan_days_str)
+    env.write_manifests = args.write_manifests
+    env.seekable_archives = args.seekable_archives
+    env.archive_shards = max (1, int (args.archive_shards_str))
+    env.encryption_key_file = args.encryption_key_file
+    env.s3_endpoint = args.s3_endpoint
+    env.s3_part_size = int (args.s3_part_size_str) * 1048576
+    env.s3_workers = max (1, int (args.s3_workers_str))
+    env.large_file_size = int (args.large_file_size_str) * 1048576
+    env.snapshot_source = args.snapshot_source
+    env.enable_quota = args.enable_quota
+    env.min_free_percent = float (args.min_free_percent_str)
+    env.host_budget = int (float (args.host_budget_str) * 1073741824)
+    env.trace_file = args.trace_file
+    env.profile_file = args.profile_file
+    env.dry_run = args.dry_run
+    env.history_file = args.history_file
+    env.metrics_file = args.metrics_file
+    env.link_tuning = args.link_tuning
+    env.link_tuning_days = int (args.link_tuning_days_str)
     # set the log level of all script output
     #set_log_level("WARN")
 
@@ -257,41 +434,25 @@ def _mk_datetime_from_file_name (fileName, *, suffix = None):
 # Groups the list of files according to the retention intervals that
 # are defined globally. This function returns a list of tuples whose
 # first element is the Deltas-instance and the second element is the
-# list of files that belong to that Deltas-interval.
+# list of files that belong to that Deltas-interval. Files older than
+# all intervals are grouped with the delta None. The files are tuples of
+# a path and its datetime, and each group is sorted from the newest to
+# the oldest file.
 def _mk_delta_groups (files):
     bounds = _mk_datetime_boundaries()
-    files.sort (reverse = True, key = snd)
     # filter those files that are younger than 'days_off'
     timeThreshold = datetime.datetime.now() - _mk_timediff (Deltas.Day, env.days_off)
-    files = [f for f in files if snd (f) < timeThreshold]
-
-    write_log ('Bounds based on the retention intervals: {0}'.format (bounds))
+    files = sorted ([f for f in files if snd (f) < timeThreshold], reverse = True, key = snd)
 
-    # This variable stores the groups we build.
-    grps = []
-    grp = []
-
-    idx = 0
-    delta, lowerBound = bounds[idx]
-    idx += 1
-    for f in files:
-        #write_log ('delta={0}, lowerBound={1}, file-date=\'{2}\''.format (delta, lowerBound, snd (f)))
-        if (snd (f) > lowerBound):
-            grp.append (f)
-        else:
-            if (idx < len (bounds)):
-                grps.append ((delta, grp))
-                grp = []
-                grp.append (f)
-                idx += 1
-                delta, lowerBound = bounds[idx]
-            else:
-                delta = None
-                grp.append (f)
+    write_log ('Bounds based on the retention intervals: {0}', LogLevel.INFO, bounds)
 
-    grps.append ((delta, grp))
+    # Each file belongs to the first interval whose lower bound it is newer
+    # than. The files are sorted, so the files of each interval follow each
+    # other and can be grouped in one pass.
+    def delta_of (f):
+        return next ((delta for delta, lowerBound in bounds if snd (f) > lowerBound), None)
 
-    return grps
+    return list (prelude.groupby (files, delta_of))
 
 
 
@@ -311,45 +472,34 @@ def _ctime_to_delta_string (tstmp, delta):
 
 
 
-# Groups the elements of a list, The grouping is based
-# on equality of whatever the group-function returns. This function
-# packs the grouped results into a list of tuples where the first
-# element is the criteria that is shared by that group, and a list
-# of elements belonging to that group. The list of elements per group
-# has the same structure the input list had.
-def _groupby (lst, group_fn):
-    return [(k, [g for g in grp]) for k, grp in itertools.groupby (lst, group_fn)]
-
-
-
-def _filter_all_but_max (grps, fn):
-    res = []
-    for grp in grps:
-        mx = min (snd (grp), key = fn)
-        res.append ((fst (grp), [e for e in snd (grp) if e != mx]))
-    return res
-
-
-
-# Takes a list of tuples of file names and their mtimes, and a time Delta
-# this group lies in, and returns a new list which only contains those
-# file names that can be removed.
+# Takes a list of tuples of file names and their datetimes, sorted from
+# the newest to the oldest, and a time Delta this group lies in, and yields
+# the files that can be removed: of all files within the same period of
+# the delta, only the oldest one is retained.
 def _find_unretained_files (files, delta):
-    # Make a list of all file names that consists of tuples with their
-    # first element being the group-by string based on the ctime of the
-    # file, and the second element of the tuple bing the file name itself.
-    #tpls = [(_ctime_to_delta_string (ctime, delta), (ctime, f)) for f, ctime in files]
-    # Group this items according to the given delta.
-    grps = _groupby (files, lambda x: _ctime_to_delta_string (snd (x), delta))
-    # Remove all files that we want to keep from the list
-    return _filter_all_but_max (grps, snd)
+    # Group the files by the period of the delta their datetime lies in.
+    for period, grp in prelude.groupby (files, lambda x: _ctime_to_delta_string (snd (x), delta)):
+        retained = prelude.min (grp, key_fn = snd)
+        yield from (f for f in grp if f is not retained)
 
 
 
-# Removes all files that are listed in the parameter.
+# Removes all files that are listed in the parameter. Backups which are
+# BTRFS subvolumes are deleted as such, because completed snapshots are
+# read-only and cannot be removed with rm.
+@traced()
 def _remove_files (files):
+    # The removals are independent of each other, so they run concurrently.
+    commands = []
     for file in files:
-        _rm (file, is_folder = True if file.is_dir() else False)
+        if (file.is_dir() and _path_is_btrfs_subvolume (file)):
+            args = ['btrfs', 'subvolume', 'delete', str(file)]
+        else:
+            args = ['rm', '-r', str(file)] if file.is_dir() else ['rm', str(file)]
+        # Remove the manifest and the indices of the backup as well.
+        sidecars = ['rm', '-rf', manifest.manifest_file_of (file.path), archive.index_file_of (file.path), blockdelta.blocks_dir_of (file.path)]
+        commands.extend ([(args, file.get_context()), (sidecars, file.get_context())])
+    runcmdutils.run_cmds (commands)
 
 
 
@@ -366,28 +516,165 @@ def _remove_files (files):
 #    list we have obtained in step (2) and performs a delete-operation
 #    on the file system to remove each backup which is listed in our
 #    list.
+# The pattern may also be a list of patterns, whose backups are retained
+# together, e.g. single archives and sets of shards.
+@traced()
 def _execute_retention_plan (path, *, pattern = None):
     # Creates a list of files that lie in the given path and adds the
     # ctime of each file to each tuple of the list.
     if (not pattern):
         pattern = '*'
+    fileNames = _list_backups (path, pattern if isinstance (pattern, list) else [pattern])
+    # All removals run concurrently.
+    _remove_files (_unretained_backups (fileNames))
+
 
-    wildcardPos = pattern.rfind('*')
-    suffix = pattern if wildcardPos < 0 else pattern[wildcardPos + 1:]
-    fileNames = [(f, _mk_datetime_from_file_name (f.path, suffix = suffix)) for f in path.glob (pattern)]
 
-    # TODO: group the file names according to the retention intervals
-    # which are globally defined.
-    deltaGroups = _mk_delta_groups (fileNames)
+# Returns the backups that are not retained, of tuples of backups and
+# their datetimes.
+def _unretained_backups (backups):
+    # Group the backups according to the retention intervals which
+    # are globally defined.
+    deltaGroups = _mk_delta_groups (backups)
 
     # For each interval defined in our list of retention-intervals we
-    # go and remove the files that are not ment to be retained.
+    # go and collect the backups that are not ment to be retained.
+    removeList = []
     for delta, grp in deltaGroups:
-        fltrd = _find_unretained_files (grp, delta)
-        write_log ('Old backups that are removal-candidates for delta {0}: {1}'.format (delta, fltrd))
-        removeList = [fst (p) for p in concat ([snd (f) for f in fltrd])]
-        write_log ('Old backups that are being removed for delta {0}: {1}'.format (delta, [p.path for p in removeList]))
+        unretained = [fst (f) for f in _find_unretained_files (grp, delta)]
+        write_log ('Old backups that are being removed for delta {0}: {1}', LogLevel.INFO, delta, CommandLine (unretained))
+        removeList.extend (unretained)
+    return removeList
+
+
+
+# Returns the names of the backups the retention plan keeps in its
+# intervals, of tuples of backups and their datetimes.
+def _guaranteed_backups (backups):
+    guaranteed = set()
+    for delta, grp in _mk_delta_groups (backups):
+        if (delta is None):
+            continue
+        unretained = [id (f) for f in _find_unretained_files (grp, delta)]
+        guaranteed.update ([fst (f).get_last_part() for f in grp if id (f) not in unretained])
+    return guaranteed
+
+
+
+# Returns the backups in the path that match one of the patterns, as
+# tuples of the path of each backup and the datetime of its name.
+def _list_backups (path, patterns):
+    backups = []
+    for p in patterns:
+        wildcardPos = p.rfind('*')
+        suffix = p if wildcardPos < 0 else p[wildcardPos + 1:]
+        backups.extend ([(f, _mk_datetime_from_file_name (f.path, suffix = suffix)) for f in path.glob (p)])
+    return backups
+
+
+
+# Returns the backups among the names of the keys of a host in an object
+# store like _list_backups(). Names that merely match a pattern, but are
+# not named by a timestamp, are left out.
+def _list_object_backups (names, patterns):
+    backups = []
+    for p in patterns:
+        wildcardPos = p.rfind('*')
+        suffix = p if wildcardPos < 0 else p[wildcardPos + 1:]
+        for name in objectstore.match_backups (names, [p]):
+            try:
+                backups.append ((name, _mk_datetime_from_file_name (name, suffix = suffix)))
+            except ValueError:
+                continue
+    return backups
+
+
+
+# Returns the available and the total number of bytes of the file system
+# the path lies in, or None if they cannot be told.
+def _free_space (path):
+    res = run_cmd (['df', '-B1', '--output=avail,size', str(path)], machine = path.get_context())
+    fields = res.stdout.split()[-2:] if res.returncode == 0 else []
+    if (len (fields) != 2 or not all ([f.isdigit() for f in fields])):
+        write_log ('The free space of \'{0}\' cannot be told: {1}', LogLevel.WARNING, path, res.stderr.strip())
+        return None
+    return (int (fields[0]), int (fields[1]))
+
+
+
+# Returns how many bytes are missing for a backup of 'need' bytes to fit
+# into the host directory, according to env.min_free_percent and
+# env.host_budget.
+def _capacity_shortfall (hostDir, backupSizes, need):
+    shortfall = 0
+    if (env.min_free_percent):
+        space = _free_space (hostDir)
+        if (space is not None):
+            available, total = space
+            shortfall = max (shortfall, need + int (total * env.min_free_percent / 100) - available)
+    if (env.host_budget):
+        shortfall = max (shortfall, sizes.used_size (backupSizes) + need - env.host_budget)
+    return shortfall
+
+
+
+# Applies the capacity policy before a backup of the host: if the next
+# backup does not fit, the oldest backups are removed until it does. The
+# size of the next backup is estimated from the sizes of the recent ones
+# (see sizes.estimate_next() for 'estimateKey'), and removing a backup is
+# expected to free its exclusive size. The estimate may be too high, e.g.
+# for snapshots whose blocks are shared with newer ones, so the space is
+# checked again after the removals, and further backups are removed until
+# the next one fits. Backups younger than env.days_off days, the backups
+# the retention plan keeps in its intervals and the most recent backup,
+# which the next one may build on, are never removed, nor are backups
+# whose exclusive size is not known. Returns False if the backup still
+# does not fit.
+@traced()
+def _make_room (hostDir, patterns, *, estimateKey):
+    if (not env.min_free_percent and not env.host_budget):
+        return True
+    sizesFile = hostDir.join (sizes.sizes_file_name)
+    backupSizes = sizes.parse_sizes (sizesFile.read()) if sizesFile.is_file() else {}
+    need = sizes.estimate_next (backupSizes, estimateKey)
+    shortfall = _capacity_shortfall (hostDir, backupSizes, need)
+    if (shortfall <= 0):
+        return True
+
+    timeThreshold = datetime.datetime.now() - _mk_timediff (Deltas.Day, env.days_off)
+    backups = _list_backups (hostDir, patterns)
+    guaranteed = _guaranteed_backups (backups)
+    candidates = [backup for backup, created in sorted (backups, key = snd)[:-1] if created < timeThreshold and backup.get_last_part() not in guaranteed]
+    while (shortfall > 0 and candidates):
+        removeList = []
+        while (shortfall > 0 and candidates):
+            backup = candidates.pop (0)
+            exclusive = backupSizes.get (backup.get_last_part(), {}).get ('exclusive')
+            if (exclusive is None):
+                write_log ('The size of the backup \'{0}\' is not known, it is not removed to make room.', LogLevel.DEBUG, backup)
+                continue
+            removeList.append (backup)
+            shortfall -= exclusive
+        if (not removeList):
+            break
+
+        write_log ('Old backups that are being removed to make room for the next backup: {0}', LogLevel.WARNING, CommandLine (removeList))
+        subvolumes = [backup for backup in removeList if backup.is_dir() and _path_is_btrfs_subvolume (backup)]
         _remove_files (removeList)
+        for backup in removeList:
+            backupSizes.pop (backup.get_last_part(), None)
+        sizesFile.write (sizes.format_sizes (backupSizes))
+        if (runcmdutils.is_planning()):
+            continue
+        # Deleted subvolumes are cleaned up in the background, their space
+        # is only free afterwards.
+        if (subvolumes):
+            run_cmd (['btrfs', 'subvolume', 'sync', str(hostDir)], machine = hostDir.get_context())
+        shortfall = _capacity_shortfall (hostDir, backupSizes, need)
+    if (shortfall > 0):
+        write_log ('The next backup of about {0} bytes does not fit into \'{1}\', {2} bytes are missing.'.format (need, hostDir, shortfall), LogLevel.ERROR)
+        return False
+    return True
 
 
 
@@ -423,80 +710,294 @@ def _hostname():
 
 
 
-# Measures the size of the path.
-def _du (path):
-    cmd_args = ['du', '-shx', str (path)]
-    res = run_cmd (cmd_args, machine = path.get_context())
-    if (res.returncode == 0):
-        return fst (res.stdout.rstrip().split())
-    return None
-
-
-
 # Creates a g-zipped tar file from the current work directory and writes
 # the archive to the file given by the parameter backupFileName.
-def _create_tar_of_directory (backupFileName, files, *, excludes = []):
-    if (backupFileName.get_context() != pb.local):
-        args = ['tar', '--numeric-owner', '-czf', '--sparse', '-']
-        for ex in excludes:
-            args.extend (['--exclude', str(ex)])
-        args.extend ([str(f) for f in files])
-        tar_cmd = mk_cmd (args)
-        tee_cmd = mk_cmd (['tee', str(backupFileName)], machine = backupFileName.get_context())
-        cmd = tar_cmd | tee_cmd
-    else:
-        args = ['tar', '--numeric-owner', '-czf', str(backupFileName)]
-        for ex in excludes:
-            args.extend (['--exclude', str(ex)])
-        args.extend ([str(f) for f in files])
-        tar_cmd = mk_cmd (args)
-        cmd = tar_cmd
-    res = cmd.run()
+# If 'filesFrom' is given, it names a local file with a NUL-separated list
+# of the paths to archive, which tar reads instead of recursing.
+@traced()
+def _create_tar_of_directory (backupFileName, files, *, excludes = [], filesFrom = None):
+    listArgs = ['--null', '--no-recursion', '-T', filesFrom] if filesFrom else []
+    with filters.tar_exclude_args (filters.as_rules (excludes)) as excludeArgs, _counting_tar() as countArgs:
+        excludeArgs = excludeArgs + countArgs
+        if (env.encryption_key is not None):
+            args = ['tar', '--numeric-owner', '--sparse', '-czf', '-'] + excludeArgs + listArgs
+            args.extend ([str(f) for f in files])
+            return _write_stream (mk_cmd (args), archive.Sink (backupFileName, key = env.encryption_key))
+        if (backupFileName.get_context() != pb.local):
+            args = ['tar', '--numeric-owner', '--sparse', '-czf', '-'] + excludeArgs + listArgs
+            args.extend ([str(f) for f in files])
+            tar_cmd = mk_cmd (args)
+            tee_cmd = mk_cmd (['tee', str(backupFileName)], machine = backupFileName.get_context())
+            cmd = tar_cmd | tee_cmd
+        else:
+            args = ['tar', '--numeric-owner', '-czf', str(backupFileName)] + excludeArgs + listArgs
+            args.extend ([str(f) for f in files])
+            # Local archives are written through exec_cmd() to account for the
+            # resources tar uses.
+            return runcmdutils.exec_cmd (mk_cmd (args)).returncode
+        res = cmd.run()
     # The return-code is stored in the first element of the result-triple
     # that is returned by the call to run().
     return fst (res)
 
 
 
+# Counts the regular files tar archives as transferred, see
+# _count_transfer(). Yields the arguments of tar, which make it list the
+# members it archives with their sizes in a file. The list is read once
+# tar is done, which saves walking through the sources a second time.
+@contextlib.contextmanager
+def _counting_tar():
+    with tempfile.NamedTemporaryFile (prefix = 'btrcp-tar-', suffix = '.lst') as listing:
+        yield ['--verbose', '--verbose', '--index-file', listing.name]
+        listing.seek (0)
+        _count_transfer (*_parse_tar_listing (listing.read().decode ('UTF-8', errors = 'surrogateescape')))
+
+
+
+# Returns the number of bytes and regular files of the verbose listing of
+# tar, whose lines look like
+#
+#   -rw-r--r-- 0/0   3000 2022-01-01 12:00 home/user/file
+def _parse_tar_listing (output):
+    sizes = [line.split()[2] for line in output.splitlines() if line.startswith ('-') and len (line.split()) > 2]
+    sizes = [int (s) for s in sizes if s.isdigit()]
+    return (sum (sizes), len (sizes))
+
+
+
+# Returns the amount of data the backup of the current thread has copied
+# so far, as a tuple of bytes and files.
+def _transfer_totals():
+    return (getattr (_transfer, 'bytes', 0), getattr (_transfer, 'files', 0))
+
+
+
+# Writes the output of a command into a sink, see archive.Sink, e.g. an
+# encrypted file or an upload to an object store. Returns the exit code of
+# the command, or of writing the sink if that failed.
+def _write_stream (cmd, sink):
+    proc = cmd.popen (stderr = None)
+    try:
+        data = proc.stdout.read (encryption.default_chunk_size)
+        while (data):
+            sink.write (data)
+            data = proc.stdout.read (encryption.default_chunk_size)
+    finally:
+        # If writing failed, closing the pipe stops the command.
+        proc.stdout.close()
+        exitCode = proc.wait()
+        sinkCode = sink.close()
+    if (sinkCode != 0):
+        write_log ('Writing \'{0}\' failed with exit code {1}.'.format (sink.name, sinkCode), LogLevel.ERROR)
+        return sinkCode
+    return exitCode
+
+
+
 # Calls 'rsync' in archive-mode. Please note that the source path must end
 # with a separator character ('/') if it designates a directory. Conversely
 # the source path must not end with a slash if it references a file instead
 # of a folder.
-def _rsync (sources, dest, *, excludes = [], stayOnFS = True, preservePath = False, syncMode = False, ignoreErrors = False):
+# If 'filesFrom' is given, it names a file with a NUL-separated list of
+# paths relative to the (single) source, and rsync only copies those
+# paths instead of recursing through the source.
+# Partially transferred files are always kept, so that an interrupted
+# transfer is continued by the delta algorithm of the next run, which uses
+# the partial file as its basis.
+# While a plan is made, the amount of data to copy is estimated with a
+# dry-run of rsync to 'planDest' if given, e.g. to the backup a snapshot
+# would be taken of, or else to 'dest'.
+# 'basis' tells the tree the destination starts from, see
+# _transfer_basis(); without it, the transfer is neither recorded for nor
+# replayed from other destinations.
+@traced()
+def _rsync (sources, dest, *, excludes = [], stayOnFS = True, preservePath = False, syncMode = False, ignoreErrors = False, filesFrom = None, planDest = None, basis = None):
     # If we sync a single file, we must not append a slash to the
     # path, otherwise rsync will run into an error.
     src = [str(source) for source in sources]
     dst = str(dest)
+    rules = filters.as_rules (excludes)
     if (dest.is_remote_path()):
         dst = dest.full_path()
     else:
         # In case this is not a remote path, changes are that
         # we might include the destination in our backup itself.
-        # To prevent this, we 
-        excludes.append(dst)
+        # To prevent this, we exclude it.
+        rules = filters.as_rules ([filters.literal_pattern (dst)]) + rules
 
     # TODO: add the option '-X' to that call after figuring out why
     # not all rsync calls succeed.
-    args = ['rsync', '-a', '-A', '--sparse']
+    args = ['rsync', '-a', '-A', '--sparse', '--partial', '--stats']
     if (preservePath):
         args.append('--relative')
     if (stayOnFS):
         args.append('-x')
     if (ignoreErrors):
         args.append('--ignore-errors')
-    if (syncMode):
+    if (filesFrom):
+        # Paths in the list that no longer exist in the source have been
+        # deleted since the last backup.
+        args.extend(['--files-from', filesFrom, '--from0'])
+        args.append('--delete-missing-args' if syncMode else '--ignore-missing-args')
+    elif (syncMode):
         args.append('--delete')
-    for ex in excludes:
-        args.extend(['--exclude', str(ex)])
-    # Extend the arguments of rsync with the source and destination.
-    args.extend (src)
-    args.append (dst)
-
-    res = run_cmd (args)
+    if (dest.is_remote_path() and env.link_tuning):
+        args.extend (_link_options (dest))
+
+    # The rules are handed to rsync in a filter file, which exists until
+    # rsync is done.
+    with filters.rsync_filter_args (rules) as filterArgs:
+        args.extend (filterArgs)
+
+        # While backing up to several destinations, the transfer to the first
+        # one is written to a batch file, which the others replay without
+        # reading the sources again, see the module fanout. A batch only
+        # applies to a destination that is identical to the one it has been
+        # written for, so it is only replayed on the same basis.
+        recording = None if runcmdutils.is_planning() or basis is None else fanout.current()
+        key = (tuple (src), preservePath, syncMode, filesFrom is not None, basis)
+        batchFile = recording.next ('rsync', key) if recording else None
+        res = None
+        writeBatch = False
+        if (batchFile is not None):
+            # The list of files is part of the batch.
+            replayArgs = [a for i, a in enumerate (args) if a not in ['--from0', '--files-from', '--delete-missing-args', '--ignore-missing-args'] and args[i - 1] != '--files-from']
+            res = run_cmd (replayArgs + ['--read-batch={0}'.format (batchFile), dst])
+            if (res.returncode != 0):
+                write_log ('Replaying the transfer to {0} failed, copying from the sources instead.'.format (dst), LogLevel.WARNING)
+                res = None
+        elif (recording):
+            batchFile = recording.new_file ('batch')
+            args.append ('--write-batch={0}'.format (batchFile))
+            writeBatch = True
+
+        # Extend the arguments of rsync with the source and destination.
+        args.extend (src)
+        args.append (dst)
+
+        # A plan gets the amount of data rsync would copy.
+        if (runcmdutils.is_planning()):
+            planArgs = args[:-1] + [planDest.full_path() if planDest.is_remote_path() else str(planDest)] if planDest else args
+            planRes = run_cmd (planArgs + ['--dry-run'])
+            runcmdutils.current_plan().add_estimate (*_parse_rsync_stats (planRes.stdout))
+
+        if (res is None):
+            res = run_cmd (args)
+            if (res.returncode == 0 and writeBatch):
+                recording.record ('rsync', key, batchFile)
+    if (res.returncode == 0):
+        _count_transfer (*_parse_rsync_stats (res.stdout))
+        # Only a scan of the whole sources tells how much data they hold.
+        _count_referenced (None if filesFrom else _parse_rsync_total_size (res.stdout))
     return res.returncode
 
 
 
+# Returns what tells the tree a transfer to a destination starts from, see
+# _rsync(): an empty tree if 'previousBackup' is None, or else the backup
+# the destination is a copy of, told by its name and the hash of its
+# manifest. Returns None if the tree cannot be told, e.g. without manifests.
+def _transfer_basis (previousBackup):
+    if (previousBackup is None):
+        return ('', None)
+    if (previousBackup.is_remote_path()):
+        return None
+    try:
+        with open (manifest.manifest_file_of (previousBackup.path), 'rb') as f:
+            return (previousBackup.get_last_part(), hashlib.sha256 (f.read()).hexdigest())
+    except OSError:
+        return None
+
+
+
+# The rsync options chosen for each remote host during this run.
+_linkOptions = {}
+
+
+
+# Returns the rsync options tuned to the link to the host of a remote path.
+def _link_options (dest):
+    host = dest.get_host()
+    if (host not in _linkOptions):
+        _linkOptions[host] = linktuning.rsync_options (host, dest.get_context(), cacheFile = env.link_tuning_file, maxAgeDays = env.link_tuning_days)
+    return _linkOptions[host]
+
+
+
+# Returns the numbers of the --stats output of rsync by their names.
+def _rsync_stats_of (output):
+    stats = {}
+    for line in output.splitlines():
+        key, sep, value = line.partition (':')
+        if (sep):
+            number = value.strip().split (' ')[0].replace (',', '').replace ('.', '')
+            if (number.isdigit()):
+                stats[key.strip()] = int (number)
+    return stats
+
+
+
+# Returns the number of bytes and regular files rsync copied (or would have
+# copied in a dry-run), as reported in its --stats output.
+def _parse_rsync_stats (output):
+    stats = _rsync_stats_of (output)
+    # Older versions of rsync do not tell regular files from others.
+    files = stats.get ('Number of regular files transferred', stats.get ('Number of files transferred', 0))
+    return (stats.get ('Total transferred file size', 0), files)
+
+
+
+# Returns the number of bytes of all files rsync looked at, as reported in
+# its --stats output, or None if it is missing.
+def _parse_rsync_total_size (output):
+    return _rsync_stats_of (output).get ('Total file size')
+
+
+
+# The amount of data the backup of the current thread has copied so far.
+_transfer = threading.local()
+
+
+
+# Resets the amount of data the backup of the current thread has copied.
+def _reset_transfer():
+    _transfer.bytes = 0
+    _transfer.files = 0
+    _transfer.referenced = 0
+
+
+
+# Adds to the amount of data the backup of the current thread has copied.
+def _count_transfer (bytes, files):
+    _transfer.bytes = getattr (_transfer, 'bytes', 0) + bytes
+    _transfer.files = getattr (_transfer, 'files', 0) + files
+
+
+
+# Adds to the amount of data the backup of the current thread refers to.
+# None means that the amount cannot be told, e.g. because only the changed
+# paths of the sources have been copied.
+def _count_referenced (bytes):
+    referenced = getattr (_transfer, 'referenced', 0)
+    _transfer.referenced = None if referenced is None or bytes is None else referenced + bytes
+
+
+
+# Returns the apparent size in bytes and the number of files of the given
+# sources, measured concurrently. This walks through all of the sources, so
+# it is only used to estimate planned backups.
+def _measure_sources (sourceDirs):
+    commands = []
+    for sourceDir in sourceDirs:
+        commands.append ((['du', '-sbx', str (sourceDir)], sourceDir.get_context()))
+        commands.append ((['du', '-sx', '--inodes', str (sourceDir)], sourceDir.get_context()))
+    results = runcmdutils.run_cmds (commands)
+    sizes = [int (fst (res.stdout.split())) if res.returncode == 0 and res.stdout.strip() else 0 for res in results]
+    return (sum (sizes[0::2]), sum (sizes[1::2]))
+
+
+
 # Returns the path to the btrfs command binaries. This is needed to make sure
 # that the PATH environment of the Python script includes it.
 def _find_btrfs_cmd_path():
@@ -537,6 +1038,7 @@ def _create_btrfs_subvolume (subvolPath):
 
 
 # Creates a BTRFS shanpshot for a given subvolume at the requested locatoin.
+@traced()
 def _create_btrfs_snapshot (subvolPath, snapshotPath, *, readOnly = False):
     if (readOnly):
         res = run_cmd (['btrfs', 'subvolume', 'snapshot', '-r', str(subvolPath), str(snapshotPath)], machine = subvolPath.get_context())
@@ -546,6 +1048,267 @@ def _create_btrfs_snapshot (subvolPath, snapshotPath, *, readOnly = False):
 
 
 
+# Returns the current generation of the BTRFS subvolume the path points to.
+# Asking find-new for changes beyond any real generation only prints the
+# transid marker, which is the current generation.
+def _btrfs_subvolume_generation (subvolPath):
+    res = run_cmd (['btrfs', 'subvolume', 'find-new', str(subvolPath), str(2**63 - 1)], machine = subvolPath.get_context())
+    if (res.returncode == 0):
+        for line in res.stdout.splitlines():
+            if (line.startswith ('transid marker was ')):
+                return int (line.split()[-1])
+    write_log ('Reading the generation of the subvolume \'{0}\' failed.'.format (subvolPath), LogLevel.ERROR)
+    return None
+
+
+
+# Lists the files of a BTRFS subvolume that have been modified after the
+# given generation. The paths returned are relative to the root of the
+# subvolume. Deleted files are not reported by BTRFS. Returns None if
+# the command failed.
+def _btrfs_find_new (subvolPath, generation):
+    res = run_cmd (['btrfs', 'subvolume', 'find-new', str(subvolPath), str(generation)], machine = subvolPath.get_context())
+    if (res.returncode != 0):
+        write_log ('Listing the changes of the subvolume \'{0}\' failed with exit code {1}.'.format (subvolPath, res.returncode), LogLevel.ERROR)
+        return None
+    paths = set()
+    for line in res.stdout.splitlines():
+        # Each line reads 'inode N file offset N len N disk start N offset N
+        # gen N flags FLAGS path', where only the path may contain spaces.
+        parts = line.split (' ', 16)
+        if (fst (parts) == 'inode' and len (parts) == 17):
+            paths.add (parts[16])
+    return paths
+
+
+
+# Reads the find-new state file, which stores for each source subvolume
+# the generation of the last successful backup and the time of the last
+# full scan. Returns a dictionary that maps the source paths to a tuple
+# of both values.
+def _read_find_new_state (stateFile):
+    state = {}
+    try:
+        with open (stateFile, 'r', encoding = 'UTF-8') as f:
+            for line in f:
+                generation, lastFullScan, path = line.rstrip ('\n').split (' ', 2)
+                state[path] = (int (generation), datetime.datetime.strptime (lastFullScan, env.timestampFormatString))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        write_log ('The find-new state file \'{0}\' cannot be read: {1}'.format (stateFile, e), LogLevel.WARNING)
+        return {}
+    return state
+
+
+
+# Writes the find-new state file atomically.
+def _write_find_new_state (stateFile, state):
+    with runcmdutils.atomic_write (stateFile) as f:
+        for path, (generation, lastFullScan) in sorted (state.items()):
+            f.write ('{0} {1} {2}\n'.format (generation, lastFullScan.strftime (env.timestampFormatString), path))
+
+
+
+# Deletes a BTRFS subvolume or snapshot.
+def _delete_btrfs_subvolume (subvolPath):
+    res = run_cmd (['btrfs', 'subvolume', 'delete', str(subvolPath)], machine = subvolPath.get_context())
+    return res.returncode
+
+
+
+# Makes a BTRFS subvolume or snapshot read-only.
+def _set_btrfs_read_only (subvolPath):
+    res = run_cmd (['btrfs', 'property', 'set', '-ts', str(subvolPath), 'ro', 'true'], machine = subvolPath.get_context())
+    return res.returncode
+
+
+
+# Returns True if the BTRFS subvolume is read-only.
+def _btrfs_is_read_only (subvolPath):
+    res = run_cmd (['btrfs', 'property', 'get', '-ts', str(subvolPath), 'ro'], machine = subvolPath.get_context())
+    return res.stdout.strip() == 'ro=true'
+
+
+
+# Returns the root of the BTRFS subvolume the path lies in, or None if it
+# does not lie on BTRFS.
+def _find_btrfs_subvolume_root (path):
+    res = run_cmd (['stat', '-f', '--format=%T', str(path)], machine = path.get_context())
+    if (res.stdout.strip() != 'btrfs'):
+        return None
+    p = os.path.abspath (path.path)
+    while (not _path_is_btrfs_subvolume (path._copy (p))):
+        if (p == os.sep):
+            return None
+        p = os.path.dirname (p)
+    return path._copy (p)
+
+
+
+# Returns the name of the directory a source subvolume is snapshotted into
+# by the current thread, see _source_snapshots().
+def _source_snapshot_name():
+    return '.btrcp-snapshot-{0}-{1}'.format (os.getpid(), threading.get_ident())
+
+
+
+# Freezes the sources with temporary read-only snapshots of the BTRFS
+# subvolumes they lie in, one for each subvolume. Yields a dictionary that
+# maps the full path of each source to the directory its snapshot is seen
+# through, see _frozen_path(), or None if a snapshot cannot be created.
+# The snapshot of the subvolume '/home' is created as
+# '/home/.btrcp-snapshot-ID/home', so the view of the subvolume is
+# '/home/.btrcp-snapshot-ID', and the frozen '/home/user' is found at
+# '/home/.btrcp-snapshot-ID/home/user'. Sources which do not lie on BTRFS
+# are copied live. The snapshots are deleted when the with-block is left.
+@contextlib.contextmanager
+def _source_snapshots (sourceDirs):
+    views = {}
+    snapshots = []
+    try:
+        for sourceDir in sourceDirs:
+            subvol = _find_btrfs_subvolume_root (sourceDir)
+            if (subvol is None):
+                write_log ('The source {0} does not lie in a BTRFS subvolume and is copied live.'.format (sourceDir.full_path()), LogLevel.WARNING)
+                continue
+            view = subvol.join (_source_snapshot_name())
+            views[sourceDir.full_path()] = view
+            if (view in [fst (s) for s in snapshots]):
+                continue
+            snapshot = view.join (subvol.path.lstrip (os.sep)) if subvol.path != os.sep else view
+            if (runcmdutils.is_planning()):
+                runcmdutils.plan_operation ('snapshot {0} read-only to {1} and copy the sources from there'.format (subvol.path, snapshot.path), machine = subvol.get_context())
+                continue
+            if ((snapshot != view and _mkdir (snapshot._copy (os.path.dirname (snapshot.path))) != 0) or _create_btrfs_snapshot (subvol, snapshot, readOnly = True) != 0):
+                write_log ('Creating a read-only snapshot of the source subvolume \'{0}\' failed.'.format (subvol.full_path()), LogLevel.ERROR)
+                if (view.exists()):
+                    _rm (view, is_folder = True)
+                yield None
+                return
+            snapshots.append ((view, snapshot))
+        # A plan copies from the live sources.
+        yield {} if runcmdutils.is_planning() else views
+    finally:
+        for view, snapshot in snapshots:
+            if (_delete_btrfs_subvolume (snapshot) != 0):
+                write_log ('Deleting the snapshot \'{0}\' of a source failed.'.format (snapshot.full_path()), LogLevel.ERROR)
+            elif (snapshot != view):
+                _rm (view, is_folder = True)
+
+
+
+# Returns the path in the frozen view of its source, or the path itself if
+# the source is copied live. If 'relative' is set, the view is separated
+# from the path by '/./', which makes rsync --relative recreate the path as
+# it is in the live source.
+def _frozen_path (path, sourceDir, views, *, relative = False):
+    view = views.get (sourceDir.full_path())
+    if (view is None):
+        return path
+    return path._copy (view.path.rstrip (os.sep) + (os.sep + '.' if relative else '') + os.path.abspath (path.path))
+
+
+
+# Returns the ids of the BTRFS subvolumes, or None for paths which are not
+# subvolumes. The ids are asked for concurrently.
+def _btrfs_subvolume_ids (subvolPaths):
+    results = runcmdutils.run_cmds ([(['btrfs', 'inspect-internal', 'rootid', str(p)], p.get_context()) for p in subvolPaths])
+    return [int (res.stdout.strip()) if res.returncode == 0 and res.stdout.strip().isdigit() else None for res in results]
+
+
+
+# Returns the referenced and exclusive sizes of the subvolumes of the BTRFS
+# file system the path lies in, by subvolume id, see sizes.parse_qgroups().
+# Returns None if quotas are not enabled on the file system. If
+# env.enable_quota is set, quotas are enabled on the mount point instead,
+# which scans the whole file system once.
+@traced()
+def _btrfs_qgroup_sizes (path, mountPoint):
+    # The quota groups are updated when the data is committed.
+    run_cmd (['btrfs', 'filesystem', 'sync', str(path)], machine = path.get_context())
+    res = run_cmd (['btrfs', 'qgroup', 'show', '--raw', str(path)], machine = path.get_context())
+    if (res.returncode != 0 and env.enable_quota):
+        write_log ('Enabling the quotas of \'{0}\', which takes a while.'.format (mountPoint))
+        if (run_cmd (['btrfs', 'quota', 'enable', str(mountPoint)], machine = mountPoint.get_context()).returncode == 0):
+            run_cmd (['btrfs', 'quota', 'rescan', '-w', str(mountPoint)], machine = mountPoint.get_context())
+            res = run_cmd (['btrfs', 'qgroup', 'show', '--raw', str(path)], machine = path.get_context())
+    if (res.returncode != 0):
+        write_log ('The quota groups of \'{0}\' cannot be read, the sizes of the snapshots are estimated: {1}', LogLevel.INFO, path, res.stderr.strip())
+        return None
+    return sizes.parse_qgroups (res.stdout)
+
+
+
+# Reads the run journal of a host directory. Returns a dictionary with
+# the entries of the journal, or None if there is no journal.
+def _read_run_journal (hostDir):
+    journal = hostDir.join (env.run_journal_name)
+    if (not journal.is_file()):
+        return None
+    return _parse_run_journal (journal.read())
+
+
+
+# Writes the run journal of a host directory. The journal is written each
+# time the backup enters a new phase.
+def _write_run_journal (hostDir, **entries):
+    write_log ('Backup of \'{0}\' enters phase \'{1}\'.', LogLevel.DEBUG, hostDir, entries.get ('phase'))
+    journal = hostDir.join (env.run_journal_name)
+    journal.write (_format_run_journal (entries))
+
+
+
+# Returns the entries of a run journal from its contents.
+def _parse_run_journal (text):
+    entries = {}
+    for line in text.splitlines():
+        if ('=' in line):
+            key, value = line.split ('=', 1)
+            entries[key] = value
+    return entries
+
+
+
+# Returns the contents of a run journal with the entries and the time of
+# the update.
+def _format_run_journal (entries):
+    entries = dict (entries, updated = datetime.datetime.now().strftime (env.timestampFormatString))
+    return ''.join (['{0}={1}\n'.format (k, v) for k, v in sorted (entries.items())])
+
+
+
+# Returns the parents recorded in the host directory, i.e. the name of the
+# snapshot each snapshot has been taken of, by the name of the snapshot.
+def _read_parents (hostDir):
+    parentsFile = hostDir.join (env.parents_file_name)
+    if (not parentsFile.is_file()):
+        return {}
+    return dict ([line.split ('=', 1) for line in parentsFile.read().splitlines() if '=' in line])
+
+
+
+# Records the snapshot a new snapshot has been taken of. The parents of
+# snapshots which no longer exist are dropped.
+def _record_parent (hostDir, snapshot, parent):
+    parents = _read_parents (hostDir)
+    parents[snapshot.get_last_part()] = parent.get_last_part()
+    names = set ([p.get_last_part() for p in hostDir.glob (_snapshot_pattern())])
+    hostDir.join (env.parents_file_name).write (''.join (['{0}={1}\n'.format (k, v) for k, v in sorted (parents.items()) if k in names]))
+
+
+
+# Returns the target of the incomplete backup recorded in the run journal
+# of the host directory, or None if the last backup with the given strategy
+# has been completed.
+def _find_incomplete_backup (hostDir, strategy):
+    journal = _read_run_journal (hostDir)
+    if (journal is None or journal.get ('strategy') != str (strategy) or journal.get ('phase') == 'complete' or not journal.get ('target')):
+        return None
+    return hostDir.join (journal['target'])
+
+
+
 # returns the mount point from where the path actually starts in the current
 # file system hirarchy.
 def _get_mount_point (path):
@@ -556,6 +1319,7 @@ def _get_mount_point (path):
 
 
 
+@traced()
 def _get_possible_mount_point (path):
     mountPoint = None
     p = path.path
@@ -568,6 +1332,7 @@ def _get_possible_mount_point (path):
 
 
 
+@traced()
 def _find_best_backup_strategy(destinationDir):
     mountPoint = _get_possible_mount_point (destinationDir)
     if (not _path_is_btrfs_subvolume (mountPoint)):
@@ -584,52 +1349,690 @@ def _get_most_recent_backup_dir (hostName, destinationDir):
 
 
 
+# Writes the manifest of a completed backup, if manifests are enabled. The
+# hashes of files which did not change since the previous backup are taken
+# from the manifest of that backup.
+@traced()
+def _write_manifest (backupPath, *, previousBackup = None):
+    if (not env.write_manifests):
+        return
+    if (backupPath.is_remote_path()):
+        write_log ('Manifests can only be written for local destinations, skipping the manifest of \'{0}\'.'.format (backupPath.full_path()), LogLevel.WARNING)
+        return
+    manifestFile = manifest.manifest_file_of (backupPath.path)
+    if (runcmdutils.is_planning()):
+        runcmdutils.plan_operation ('write the manifest {0}'.format (manifestFile))
+        return
+    try:
+        if (backupPath.is_dir()):
+            previousManifest = manifest.manifest_file_of ((previousBackup or backupPath).path)
+            manifest.create_manifest (backupPath.path, manifestFile, previousManifest = previousManifest)
+        elif (encryption.is_encrypted (backupPath.path)):
+            write_log ('The manifest of the encrypted archive \'{0}\' is not written, it would list the archived files in the clear.'.format (backupPath.full_path()), LogLevel.WARNING)
+        else:
+            manifest.create_archive_manifest (backupPath.path, manifestFile)
+    except (OSError, EOFError, tarfile.TarError, manifest.ManifestError) as e:
+        write_log ('Writing the manifest \'{0}\' failed: {1}'.format (manifestFile, e), LogLevel.ERROR)
+
+
+
+# Records the sizes of the backups of a host in its sizes file, see the
+# module sizes. 'backup' is the backup that has just been completed, and
+# 'patterns' match all backups of the host; the sizes of backups which no
+# longer exist are dropped. The sizes of snapshots are read from the quota
+# groups of the file system at 'mountPoint', which also updates the
+# exclusive sizes of the older snapshots. Without a mount point the backup
+# is an archive.
+@traced()
+def _record_backup_sizes (hostDir, backup, *, patterns, mountPoint = None):
+    sizesFile = hostDir.join (sizes.sizes_file_name)
+    if (runcmdutils.is_planning()):
+        runcmdutils.plan_operation ('record the size of the backup {0} in {1}'.format (backup.full_path(), sizesFile.full_path()), machine = sizesFile.get_context())
+        return
+
+    knownSizes = sizes.parse_sizes (sizesFile.read()) if sizesFile.is_file() else {}
+    names = [p.get_last_part() for pattern in patterns for p in hostDir.glob (pattern)]
+    backupSizes = {name: knownSizes.get (name, {}) for name in names}
+    entry = backupSizes.setdefault (backup.get_last_part(), {})
+    transferred = getattr (_transfer, 'bytes', 0)
+    referenced = getattr (_transfer, 'referenced', None)
+    entry['transferred'] = transferred
+
+    if (mountPoint is None):
+        res = run_cmd (['du', '-sb', str(backup)], machine = backup.get_context())
+        if (res.returncode == 0):
+            entry['referenced'] = entry['exclusive'] = int (fst (res.stdout.split()))
+    else:
+        qgroups = _btrfs_qgroup_sizes (hostDir, mountPoint)
+        if (qgroups is None):
+            # What has been copied is not shared with the previous snapshot.
+            entry['exclusive'] = transferred
+            if (referenced is not None):
+                entry['referenced'] = referenced
+        else:
+            # The subvolume id of each snapshot is only asked for once.
+            missing = [name for name, s in backupSizes.items() if 'id' not in s]
+            for name, subvolId in zip (missing, _btrfs_subvolume_ids ([hostDir.join (n) for n in missing])):
+                if (subvolId is not None):
+                    backupSizes[name]['id'] = subvolId
+            for s in backupSizes.values():
+                if (s.get ('id') in qgroups):
+                    s['referenced'], s['exclusive'] = qgroups[s['id']]
+
+    sizesFile.write (sizes.format_sizes (backupSizes))
+    write_log ('The backup \'{0}\' refers to {1} bytes, {2} bytes of them exclusively.', LogLevel.INFO, backup, entry.get ('referenced', 'unknown'), entry.get ('exclusive', 'unknown'))
+
+
+
+# Copies the files or directories of a backup that has been written to
+# another destination to the given targets, which may be on other machines.
+# The copies are streamed from one machine to the other. Returns False if
+# one of them fails.
+@traced()
+def _copy_recorded_backup (sources, targets):
+    for source, target in zip (sources, targets):
+        if (source.is_dir()):
+            if (_mkdir (target) != 0):
+                return False
+            cmd = mk_cmd (['tar', '-C', str(source), '-cf', '-', '.'], machine = source.get_context()) | mk_cmd (['tar', '-C', str(target), '-xf', '-'], machine = target.get_context())
+        else:
+            cmd = mk_cmd (['cat', str(source)], machine = source.get_context()) | mk_cmd (['dd', 'of={0}'.format (target), 'bs=1M', 'status=none'], machine = target.get_context())
+        exitCode = fst (cmd.run (retcode = None))
+        if (exitCode != 0):
+            write_log ('Copying \'{0}\' to \'{1}\' failed with exit code {2}, writing the backup from the sources instead.'.format (source.full_path(), target.full_path(), exitCode), LogLevel.WARNING)
+            return False
+        write_log ('Copied \'{0}\' to \'{1}\' instead of reading the sources again.'.format (source.full_path(), target.full_path()))
+    return True
+
+
+
 # Implements the second backup strategy:
 # Uses tar to zip up all source directories and write them as a single
 # file to the destination directory.
-def backup_strategy_1 (hostName, sourceDirs, destinationDir, *, excludes = [], stayOnFS = True, preservePath = False, ignoreErrors = False):
+# The archive is written under a '.part' name first, and only renamed once
+# tar finished successfully. A compressed tar stream cannot be continued,
+# so the partial archive of an interrupted run is removed by the next run.
+@traced()
+def backup_strategy_1 (hostName, sourceDirs, destinationDir, *, excludes = [], stayOnFS = True, preservePath = False, syncMode = False, ignoreErrors = False, changeJournal = None, findNewState = None):
     tarBaseDir = destinationDir.join (hostName)
     _mkdir (tarBaseDir)
 
+    incompleteArchive = _find_incomplete_backup (tarBaseDir, 1)
+    if (incompleteArchive is not None and incompleteArchive.exists()):
+        write_log ('Removing the incomplete archive \'{0}\' of an interrupted backup of host \'{1}\'.'.format (incompleteArchive, hostName))
+        _rm (incompleteArchive, is_folder = incompleteArchive.is_dir())
+
+    if (not _make_room (tarBaseDir, _archive_patterns, estimateKey = 'referenced')):
+        return False
+
+    if (env.snapshot_source):
+        write_log ('Strategy 1 does not copy the sources from snapshots, they are archived live.', LogLevel.WARNING)
+
+    if (env.archive_shards > 1):
+        return _backup_shards (hostName, sourceDirs, tarBaseDir, excludes = excludes)
+
     tarFileName = datetime.datetime.now().strftime ('{0}.tar.gz'.format (env.timestampFormatString))
     tarBackupFile = tarBaseDir.join (tarFileName)
+    tarPartFile = tarBaseDir.join (tarFileName + '.part')
+    _write_run_journal (tarBaseDir, strategy = 1, phase = 'transfer', target = tarPartFile.get_last_part())
 
     #backedUpFiles = []
     #for dir in sourceDirs:
     #    backedUpFiles.extend(dir.glob ('*'))
 
     #exitCode = _create_tar_of_directory(tarBackupFile, backedUpFiles)
-    exitCode = _create_tar_of_directory(tarBackupFile, sourceDirs)
+    tarIndexFile = tarBaseDir.join (archive.index_file_of (tarFileName))
+    # An archive written to another destination is copied from there, see
+    # the module fanout.
+    recording = None if runcmdutils.is_planning() else fanout.current()
+    key = (tuple ([s.full_path() for s in sourceDirs]), env.seekable_archives)
+    recorded = recording.next ('archive', key) if recording else None
+    if (recorded is not None and not _copy_recorded_backup (fst (recorded), [tarPartFile, tarIndexFile])):
+        recorded = None
+    totals = _transfer_totals()
+    if (recorded is not None):
+        # The copy counts as the transfer it replays.
+        _count_transfer (*snd (recorded))
+        exitCode = 0
+    elif (runcmdutils.is_planning()):
+        # tar reads all of the sources.
+        runcmdutils.current_plan().add_estimate (*_measure_sources (sourceDirs))
+        runcmdutils.plan_operation ('write the archive {0} of {1}'.format (tarPartFile.full_path(), ' '.join ([s.full_path() for s in sourceDirs])), machine = tarPartFile.get_context())
+        exitCode = 0
+    elif (env.seekable_archives):
+        exitCode = archive.create_seekable_archive (tarPartFile, sourceDirs, excludes = excludes, indexFile = tarIndexFile, key = env.encryption_key, count = _count_transfer)
+    else:
+        exitCode = _create_tar_of_directory(tarPartFile, sourceDirs, excludes = excludes)
     if (exitCode != 0):
         write_log ('Creating a tar-archive failed for host \'{0}\' with exit code \'{1}\''.format (hostName, exitCode))
-        if (not _mv (tarBackupFile, tarBackupFile + '.err')):
+        if (_mv (tarPartFile, tarBaseDir.join (tarFileName + '.err')) != 0):
             write_log ('Moving tar-archive during error handling failed for host \'{0}\'.'.format (hostName))
+        if (tarIndexFile.exists()):
+            _rm (tarIndexFile)
+        _write_run_journal (tarBaseDir, strategy = 1, phase = 'failed', target = tarPartFile.get_last_part())
+        return False
+
+    if (_mv (tarPartFile, tarBackupFile) != 0):
+        write_log ('Renaming the tar-archive failed for host \'{0}\'.'.format (hostName), LogLevel.ERROR)
         return False
+    if (recording and recorded is None):
+        recording.record ('archive', key, ([tarBackupFile, tarIndexFile] if env.seekable_archives else [tarBackupFile], tuple ([n - t for n, t in zip (_transfer_totals(), totals)])))
+    _write_run_journal (tarBaseDir, strategy = 1, phase = 'complete', target = tarFileName)
+    _write_manifest (tarBackupFile)
+    _record_backup_sizes (tarBaseDir, tarBackupFile, patterns = _archive_patterns)
 
     write_log ('Backup file successfully created for host \'{0}\''.format (hostName))
 
     # At the end we remove old backups that are no longer needed.
-    _execute_retention_plan (tarBaseDir, pattern = '*.tar.gz')
+    _execute_retention_plan (tarBaseDir, pattern = _archive_patterns)
 
     return True
 
 
 
-# Backs up multiple source directories using rsync.
-def backup_rsync_source_dirs (sourceDirs, destinationDir, *, excludes = [], stayOnFS = True, preservePath = False, syncMode = False, ignoreErrors = False):
-    # Measure the size of the backup
-    for sourceDir in sourceDirs:
-        write_log ('The size of the source {0} is: {1}.'.format (sourceDir.path, _du (sourceDir)))
+# The patterns of the backups of strategy 1: single archives and sets of
+# shards are retained as one series.
+_archive_patterns = ['*.tar.gz', '*' + shards.set_suffix]
 
-    # If this is a folder, then we remove any trailing path separators
-    # from the source directory parameter.
-    srcDirs = [sourceDir if sourceDir.is_file() else sourceDir.join ('') for sourceDir in sourceDirs]
 
-    exitCode = _rsync (srcDirs, destinationDir, excludes = excludes, stayOnFS = stayOnFS, preservePath = preservePath, syncMode = syncMode, ignoreErrors = ignoreErrors)
-    if (exitCode != 0):
-        #write_log ('Copying {0} \'{1}\' with rsync failed with exit code \'{2}\''.format ('file' if sourceDir.is_file() else 'directory', sourceDir, exitCode))
+
+# Writes the archive of strategy 1 as a set of shards, see the module
+# shards. The sources are split into env.archive_shards lists of about the
+# same size, and one tar per list writes its shard concurrently into a
+# '.part' directory, which is renamed once all shards have been written.
+@traced()
+def _backup_shards (hostName, sourceDirs, tarBaseDir, *, excludes = []):
+    setName = datetime.datetime.now().strftime (env.timestampFormatString) + shards.set_suffix
+    setDir = tarBaseDir.join (setName)
+    partDir = tarBaseDir.join (setName + '.part')
+    _write_run_journal (tarBaseDir, strategy = 1, phase = 'transfer', target = partDir.get_last_part())
+
+    # A set of shards written to another destination is copied from there,
+    # see the module fanout.
+    recording = None if runcmdutils.is_planning() else fanout.current()
+    key = (tuple ([s.full_path() for s in sourceDirs]), env.archive_shards, env.seekable_archives)
+    recorded = recording.next ('shards', key) if recording else None
+    totals = _transfer_totals()
+    if (recorded is not None and _copy_recorded_backup (fst (recorded), [partDir])):
+        _count_transfer (*snd (recorded))
+        exitCodes = [0]
+    else:
+        recorded = None
+        exitCodes = _write_shards (sourceDirs, partDir, excludes = excludes)
+
+    if (any ([c != 0 for c in exitCodes])):
+        write_log ('Creating the shards failed for host \'{0}\' with exit codes {1}'.format (hostName, exitCodes))
+        if (_mv (partDir, tarBaseDir.join (setName + '.err')) != 0):
+            write_log ('Moving the shards during error handling failed for host \'{0}\'.'.format (hostName))
+        _write_run_journal (tarBaseDir, strategy = 1, phase = 'failed', target = partDir.get_last_part())
+        return False
+
+    if (_mv (partDir, setDir) != 0):
+        write_log ('Renaming the shards failed for host \'{0}\'.'.format (hostName), LogLevel.ERROR)
+        return False
+    if (recording and recorded is None):
+        recording.record ('shards', key, ([setDir], tuple ([n - t for n, t in zip (_transfer_totals(), totals)])))
+    _write_run_journal (tarBaseDir, strategy = 1, phase = 'complete', target = setName)
+    _write_manifest (setDir)
+    _record_backup_sizes (tarBaseDir, setDir, patterns = _archive_patterns)
+
+    write_log ('Shards successfully created for host \'{0}\''.format (hostName))
+
+    _execute_retention_plan (tarBaseDir, pattern = _archive_patterns)
+
+    return True
+
+
+
+# Writes the shards of the sources into the directory 'partDir', and the
+# list of their contents once all of them have been written. Returns the
+# exit codes of the tar processes.
+def _write_shards (sourceDirs, partDir, *, excludes = []):
+    shares = shards.split_sources ([str (s) for s in sourceDirs], env.archive_shards, excludes = excludes)
+    if (shares is None):
+        return [1]
+    shardNames = [shards.shard_file_name (i + 1) for i in range (len (shares))]
+
+    if (runcmdutils.is_planning()):
+        runcmdutils.current_plan().add_estimate (*_measure_sources (sourceDirs))
+        for name, share in zip (shardNames, shares):
+            runcmdutils.plan_operation ('write the shard {0} of {1} paths'.format (partDir.join (name).full_path(), len (share)), machine = partDir.get_context())
+        return [0]
+
+    _mkdir (partDir)
+    # The shards are written by threads of their own, which count their
+    # transfers for the backup when they are done.
+    shardTotals = []
+    with tempfile.TemporaryDirectory() as listDir:
+        def write_shard (i):
+            _reset_transfer()
+            exitCode = _write_shard (i)
+            shardTotals.append (_transfer_totals())
+            return exitCode
+        def _write_shard (i):
+            listFile = os.path.join (listDir, shardNames[i] + '.lst')
+            with open (listFile, 'w', encoding = 'UTF-8', errors = 'surrogateescape') as f:
+                f.write (''.join ([p + '\0' for p in shares[i]]))
+            shardFile = partDir.join (shardNames[i])
+            if (env.seekable_archives):
+                return archive.create_seekable_archive (shardFile, [], excludes = excludes, filesFrom = listFile, key = env.encryption_key, count = _count_transfer)
+            return _create_tar_of_directory (shardFile, [], excludes = excludes, filesFrom = listFile)
+        with concurrent.futures.ThreadPoolExecutor (max_workers = len (shares)) as pool:
+            exitCodes = list (pool.map (write_shard, range (len (shares))))
+    for bytes, files in shardTotals:
+        _count_transfer (bytes, files)
+    if (all ([c == 0 for c in exitCodes])):
+        # The list names the archived paths, it is encrypted like the shards.
+        exitCodes.append (archive.write_text (partDir.join (shards.list_name), shards.format_list (list (zip (shardNames, shares))), key = env.encryption_key))
+    return exitCodes
+
+
+
+# Backs up the sources to an object store, see the module objectstore. The
+# archive of strategy 1, or its set of shards with env.archive_shards, is
+# streamed into multipart uploads below '<host>/' of the URL, and only
+# becomes visible once all of its parts have been uploaded. The run journal
+# is kept as an object there as well. If the last backup of the host has
+# been interrupted, it is resumed under the same name: its archives are
+# written again from the sources, but parts which have already been
+# uploaded are not sent again. Other unfinished uploads of the host are
+# aborted, and the retention plan is applied to the backups in the store.
+@traced()
+def backup_to_object_store (hostName, sourceDirs, url, *, excludes = [], **kwargs):
+    try:
+        bucket = objectstore.Bucket (url, endpoint = env.s3_endpoint, workers = env.s3_workers)
+        return _backup_to_bucket (hostName, sourceDirs, bucket, hostName + '/', excludes = excludes)
+    except objectstore.errors as e:
+        write_log ('The backup of host \'{0}\' to \'{1}\' failed: {2}'.format (hostName, url, e), LogLevel.ERROR)
+        return False
+
+
+
+def _backup_to_bucket (hostName, sourceDirs, bucket, hostKey, *, excludes = []):
+    journal = _parse_run_journal (bucket.read_text (hostKey + env.run_journal_name) or '')
+    suffix = shards.set_suffix if env.archive_shards > 1 else '.tar.gz'
+    target = journal.get ('target', '')
+    if (journal.get ('phase') != 'transfer' or not target.endswith (suffix)):
+        target = None
+    # The most recent upload of each key of the interrupted backup is
+    # resumed, all other uploads of the host are aborted.
+    uploads = bucket.list_uploads (hostKey)
+    resumed = {k: ids[-1] for k, ids in uploads.items() if target and (k == hostKey + target or k.startswith (hostKey + target + '.') or k.startswith (hostKey + target + '/'))}
+    stale = [(k, u) for k, ids in uploads.items() for u in ids if resumed.get (k) != u]
+    name = target or datetime.datetime.now().strftime (env.timestampFormatString) + suffix
+
+    if (runcmdutils.is_planning()):
+        runcmdutils.current_plan().add_estimate (*_measure_sources (sourceDirs))
+        for k, uploadId in stale:
+            runcmdutils.plan_operation ('abort the unfinished upload to {0}'.format (bucket.url (k)))
+        runcmdutils.plan_operation ('{0} the upload of {1} of {2}'.format ('resume' if target else 'start', bucket.url (hostKey + name), ' '.join ([s.full_path() for s in sourceDirs])))
+        _execute_object_retention (bucket, hostKey)
+        return True
+
+    _abort_uploads (bucket, stale)
+    if (target):
+        write_log ('Resuming the interrupted backup \'{0}\' of host \'{1}\'.'.format (bucket.url (hostKey + name), hostName))
+    bucket.write_text (hostKey + env.run_journal_name, _format_run_journal ({'strategy': 1, 'phase': 'transfer', 'target': name}))
+
+    if (env.archive_shards > 1):
+        exitCodes = _upload_shards (sourceDirs, bucket, hostKey + name + '/', excludes = excludes, uploads = resumed)
+    else:
+        exitCodes = [_upload_archive (sourceDirs, bucket, hostKey + name, excludes = excludes, uploads = resumed)]
+    # The uploads that have been resumed are taken out of 'resumed'. The
+    # others are not written any more, e.g. shards after the sources have
+    # been split differently, or an index without --seekable-archives.
+    _abort_uploads (bucket, list (resumed.items()))
+    if (any ([c != 0 for c in exitCodes])):
+        # The journal stays in the phase of the transfer and the uploads are
+        # kept, so that the next run resumes them.
+        write_log ('Uploading the backup failed for host \'{0}\' with exit codes {1}, it will be resumed by the next run.'.format (hostName, exitCodes), LogLevel.ERROR)
         return False
 
+    bucket.write_text (hostKey + env.run_journal_name, _format_run_journal ({'strategy': 1, 'phase': 'complete', 'target': name}))
+    write_log ('Backup successfully uploaded for host \'{0}\''.format (hostName))
+    # Nothing resumes uploads of a completed backup, they only keep parts.
+    _abort_uploads (bucket, [(k, u) for k, ids in bucket.list_uploads (hostKey + name).items() for u in ids])
+
+    _execute_object_retention (bucket, hostKey)
+    return True
+
+
+
+# Streams an archive of the sources into an upload to the key, and its
+# index next to it if env.seekable_archives is set. 'uploads' are the ids
+# of the interrupted uploads that can be resumed, by their keys; the ones
+# that are resumed are removed from it. The uploads are only completed if
+# the archive has been written successfully. Returns the exit code of tar.
+def _upload_archive (files, bucket, key, *, excludes = [], filesFrom = None, uploads = {}):
+    writer = bucket.open_writer (key, partSize = env.s3_part_size, uploadId = uploads.pop (key, None))
+    if (env.seekable_archives):
+        indexKey = archive.index_file_of (key)
+        indexWriter = bucket.open_writer (indexKey, partSize = env.s3_part_size, uploadId = uploads.pop (indexKey, None))
+        exitCode = archive.create_seekable_archive (None, files, excludes = excludes, filesFrom = filesFrom, key = env.encryption_key, stream = writer, indexStream = indexWriter, count = _count_transfer)
+    else:
+        indexWriter = None
+        listArgs = ['--null', '--no-recursion', '-T', filesFrom] if filesFrom else []
+        with filters.tar_exclude_args (filters.as_rules (excludes)) as excludeArgs, _counting_tar() as countArgs:
+            args = ['tar', '--numeric-owner', '--sparse', '-czf', '-'] + excludeArgs + countArgs + listArgs + [str(f) for f in files]
+            exitCode = _write_stream (mk_cmd (args), archive.Sink (None, key = env.encryption_key, stream = writer))
+    if (exitCode != 0):
+        return exitCode
+    writer.complete()
+    if (indexWriter is not None):
+        indexWriter.complete()
+    write_log ('Uploaded {0} bytes to \'{1}\', {2} bytes had been uploaded before.'.format (writer.uploaded_bytes, writer.name, writer.skipped_bytes))
+    return 0
+
+
+
+# Aborts the multipart uploads, which are given as (key, upload id) tuples.
+def _abort_uploads (bucket, uploads):
+    for k, uploadId in uploads:
+        write_log ('Aborting the unfinished upload to \'{0}\'.'.format (bucket.url (k)))
+        bucket.abort_upload (k, uploadId)
+
+
+
+# Uploads the shards of the sources below the key, which ends with '/',
+# like _write_shards(). Returns the exit codes of the tar processes.
+def _upload_shards (sourceDirs, bucket, key, *, excludes = [], uploads = {}):
+    shares = shards.split_sources ([str (s) for s in sourceDirs], env.archive_shards, excludes = excludes)
+    if (shares is None):
+        return [1]
+    shardNames = [shards.shard_file_name (i + 1) for i in range (len (shares))]
+
+    shardTotals = []
+    with tempfile.TemporaryDirectory() as listDir:
+        def upload_shard (i):
+            _reset_transfer()
+            listFile = os.path.join (listDir, shardNames[i] + '.lst')
+            with open (listFile, 'w', encoding = 'UTF-8', errors = 'surrogateescape') as f:
+                f.write (''.join ([p + '\0' for p in shares[i]]))
+            exitCode = _upload_archive ([], bucket, key + shardNames[i], excludes = excludes, filesFrom = listFile, uploads = uploads)
+            shardTotals.append (_transfer_totals())
+            return exitCode
+        with concurrent.futures.ThreadPoolExecutor (max_workers = len (shares)) as pool:
+            exitCodes = list (pool.map (upload_shard, range (len (shares))))
+    for bytes, files in shardTotals:
+        _count_transfer (bytes, files)
+    if (all ([c == 0 for c in exitCodes])):
+        # The list names the archived paths, it is encrypted like the shards.
+        text = shards.format_list (list (zip (shardNames, shares)))
+        data = text.encode ('UTF-8', errors = 'surrogateescape')
+        bucket.write_bytes (key + shards.list_name, encryption.encrypt_bytes (data, env.encryption_key) if env.encryption_key is not None else data)
+    return exitCodes
+
+
+
+# Applies the retention plan to the backups of a host in an object store,
+# which are found by listing the keys of the host. Each backup is removed
+# with its index, and a set of shards with all of its keys.
+@traced()
+def _execute_object_retention (bucket, hostKey):
+    backups = _list_object_backups (bucket.list_names (hostKey), _archive_patterns)
+    keys = []
+    for name in _unretained_backups (backups):
+        if (runcmdutils.is_planning()):
+            runcmdutils.plan_operation ('delete {0}'.format (bucket.url (hostKey + name)))
+        elif (name.endswith (shards.set_suffix)):
+            keys.extend (bucket.list_keys (hostKey + name + '/'))
+        else:
+            keys.extend ([hostKey + name, hostKey + archive.index_file_of (name)])
+    bucket.delete_keys (keys)
+
+
+
+# Copies only the changed paths of each source directory with rsync. The
+# changes are absolute paths as recorded by the change journal. Each source
+# directory gets its own rsync call, because the list of files rsync reads
+# is relative to the source. Frozen sources are copied from their views,
+# see _source_snapshots().
+@traced()
+def _rsync_changed_paths (sourceDirs, destinationDir, changes, *, excludes = [], stayOnFS = True, preservePath = False, syncMode = False, ignoreErrors = False, planDest = None, views = {}, basis = None):
+    for sourceDir in sourceDirs:
+        base = _frozen_path (sourceDir, sourceDir, views)
+        changedPaths = changejournal.changes_below (changes, sourceDir.path)
+        # With --preserve-path the paths are taken relative to the root,
+        # which gives the same layout as rsync's --relative option.
+        if (preservePath):
+            base = views.get (sourceDir.full_path(), Path (os.sep))
+            prefix = os.path.abspath (sourceDir.path).strip (os.sep)
+            changedPaths = [os.path.join (prefix, p) for p in changedPaths]
+        write_log ('The change journal lists {0} changed paths for the source {1}.'.format (len (changedPaths), sourceDir.path))
+        if (not changedPaths):
+            continue
+
+        with tempfile.NamedTemporaryFile (prefix = 'btrcp-files-', suffix = '.lst') as filesFrom:
+            filesFrom.write (b''.join ([os.fsencode (p) + b'\0' for p in changedPaths]))
+            filesFrom.flush()
+            exitCode = _rsync ([base.join ('')], destinationDir, excludes = excludes, stayOnFS = stayOnFS, syncMode = syncMode, ignoreErrors = ignoreErrors, filesFrom = filesFrom.name, planDest = planDest, basis = basis)
+        if (exitCode != 0):
+            return False
+
+    return True
+
+
+
+# Returns the changes recorded in the change journal, or None if the
+# sources have to be scanned completely. The second element of the
+# returned tuple is the cursor that has to be committed after the
+# backup succeeded.
+def _read_change_journal (changeJournal, sourceDirs, *, fullScan = False):
+    changes, cursor = changejournal.read_changes (changeJournal)
+    if (fullScan):
+        write_log ('There is no previous backup to apply the change journal to, falling back to a full scan.')
+        changes = None
+    elif (changes is None):
+        write_log ('The change journal \'{0}\' cannot be used, falling back to a full scan.'.format (changeJournal))
+    return (changes, cursor)
+
+
+
+# Asks BTRFS for the files that changed in each source subvolume since
+# the generations stored in the find-new state file. Returns a tuple of
+# the changed paths (or None if a full scan is needed) and the new state
+# that has to be written after the backup succeeded.
+def _read_find_new_changes (findNewState, sourceDirs, *, fullScan = False):
+    state = _read_find_new_state (findNewState)
+    now = datetime.datetime.now()
+    newState = {}
+    changes = set()
+
+    for sourceDir in sourceDirs:
+        if (not _path_is_btrfs_subvolume (sourceDir)):
+            write_log ('The source {0} is not the root of a BTRFS subvolume, falling back to a full scan.'.format (sourceDir.path))
+            return (None, None)
+        path = os.path.abspath (sourceDir.path)
+        # The generation is read before the backup starts, all changes
+        # that happen while we copy will be found by the next backup.
+        generation = _btrfs_subvolume_generation (sourceDir)
+        if (generation is None):
+            return (None, None)
+        lastGeneration, lastFullScan = state.get (path, (None, None))
+        newState[path] = (generation, lastFullScan)
+        if (lastGeneration is None):
+            write_log ('There is no generation recorded for the source {0}.'.format (sourceDir.path))
+            fullScan = True
+        elif (now - lastFullScan > _mk_timediff (Deltas.Day, env.full_scan_days)):
+            write_log ('The last full scan of the source {0} is older than {1} days.'.format (sourceDir.path, env.full_scan_days))
+            fullScan = True
+        elif (not fullScan):
+            changedPaths = _btrfs_find_new (sourceDir, lastGeneration)
+            if (changedPaths is None):
+                fullScan = True
+            else:
+                changes.update ([os.path.join (path, p) for p in changedPaths])
+
+    if (fullScan):
+        write_log ('Scanning all sources completely instead of asking BTRFS for the changed files.')
+        newState = dict ([(p, (g, now)) for p, (g, _) in newState.items()])
+        return (None, newState)
+    return (changes, newState)
+
+
+
+# Determines which paths changed since the last backup. Returns a tuple of
+# the set of changed absolute paths, or None if the sources have to be
+# scanned completely, and a function that has to be called after the backup
+# succeeded, so that the next backup continues from there.
+@traced()
+def _collect_changes (sourceDirs, *, changeJournal = None, findNewState = None, fullScan = False):
+    if (not changeJournal and not findNewState):
+        return (None, lambda: None)
+
+    if (any ([s.is_remote_path() or not s.is_dir() for s in sourceDirs])):
+        write_log ('Changed paths can only be determined for local source directories, falling back to a full scan.')
+        return (None, lambda: None)
+
+    if (changeJournal):
+        changes, cursor = _read_change_journal (changeJournal, sourceDirs, fullScan = fullScan)
+        return (changes, lambda: changejournal.commit_changes (cursor))
+
+    changes, newState = _read_find_new_changes (findNewState, sourceDirs, fullScan = fullScan)
+    if (newState is None):
+        return (None, lambda: None)
+    return (changes, lambda: _write_find_new_state (findNewState, newState))
+
+
+
+# Backs up multiple source directories using rsync.
+# If a change journal or a find-new state file is given, only the paths
+# that changed since the last backup are copied, unless 'fullScan' is set
+# or the changes cannot be determined reliably.
+# For 'planDest' and 'basis' see _rsync().
+# Large files are left out by rsync and copied block by block afterwards;
+# 'previousBackup' is the backup the destination is a snapshot of.
+# If env.snapshot_source is set, the sources are copied from temporary
+# snapshots, see _source_snapshots().
+def backup_rsync_source_dirs (sourceDirs, destinationDir, *, excludes = [], stayOnFS = True, preservePath = False, syncMode = False, ignoreErrors = False, changeJournal = None, findNewState = None, fullScan = False, planDest = None, previousBackup = None, basis = None):
+    # While backing up to several destinations, the changes are collected
+    # once, and committed after all destinations got them, see the module
+    # fanout.
+    recording = None if runcmdutils.is_planning() else fanout.current()
+    key = (tuple ([s.full_path() for s in sourceDirs]), fullScan)
+    recorded = recording.next ('changes', key) if recording else None
+    if (recorded is not None):
+        changes, commit = fst (recorded), lambda: None
+    else:
+        changes, commit = _collect_changes (sourceDirs, changeJournal = changeJournal, findNewState = findNewState, fullScan = fullScan)
+        if (recording):
+            recording.record ('changes', key, (changes,))
+            recording.defer (commit)
+            commit = lambda: None
+
+    if (runcmdutils.is_planning()):
+        commit = lambda: runcmdutils.plan_operation ('remember the state of the sources for the next backup')
+
+    # The changes are collected before the sources are frozen. Paths that
+    # change in between are copied again by the next backup.
+    with _source_snapshots (sourceDirs if env.snapshot_source else []) as views:
+        if (views is None):
+            return False
+        if (views):
+            excludes = filters.as_rules ([filters.literal_pattern (_source_snapshot_name()) + '/']) + excludes
+
+        largeFiles = _find_large_files (sourceDirs, destinationDir, excludes = excludes, stayOnFS = stayOnFS, preservePath = preservePath, changes = changes, views = views)
+        # The large files must not be copied by rsync as well, whatever the
+        # other rules say.
+        excludes = filters.as_rules ([filters.literal_pattern (os.sep + rel) for source, rel in largeFiles]) + excludes
+
+        if (changes is not None):
+            if (not _rsync_changed_paths (sourceDirs, destinationDir, changes, excludes = excludes, stayOnFS = stayOnFS, preservePath = preservePath, syncMode = syncMode, ignoreErrors = ignoreErrors, planDest = planDest, views = views, basis = basis)):
+                return False
+            if (not _copy_large_files (largeFiles, destinationDir, previousBackup)):
+                return False
+            commit()
+            return True
+
+        # If this is a folder, then we remove any trailing path separators
+        # from the source directory parameter.
+        srcDirs = [_frozen_path (sourceDir, sourceDir, views, relative = preservePath) for sourceDir in sourceDirs]
+        srcDirs = [srcDir if sourceDir.is_file() else srcDir.join ('') for sourceDir, srcDir in zip (sourceDirs, srcDirs)]
+
+        exitCode = _rsync (srcDirs, destinationDir, excludes = excludes, stayOnFS = stayOnFS, preservePath = preservePath, syncMode = syncMode, ignoreErrors = ignoreErrors, planDest = planDest, basis = basis)
+        if (exitCode != 0):
+            #write_log ('Copying {0} \'{1}\' with rsync failed with exit code \'{2}\''.format ('file' if sourceDir.is_file() else 'directory', sourceDir, exitCode))
+            return False
+        if (not _copy_large_files (largeFiles, destinationDir, previousBackup)):
+            return False
+
+    # A full scan covers everything that changed so far.
+    commit()
+    return True
+
+
+
+# Finds the files of the sources that are copied block by block, if
+# env.large_file_size is set. Returns a list of tuples of the absolute path
+# of each file and its path relative to the destination, as rsync would
+# write it. Only files of local sources are copied block by block to local
+# destinations, and excluded files are left out. If the set of changed paths
+# is given, only those are considered instead of searching the sources.
+# If the sources are frozen, the files are copied from their frozen views.
+@traced()
+def _find_large_files (sourceDirs, destinationDir, *, excludes = [], stayOnFS = True, preservePath = False, changes = None, views = {}):
+    if (not env.large_file_size):
+        return []
+    if (destinationDir.is_remote_path() or any ([s.is_remote_path() for s in sourceDirs])):
+        write_log ('Large files are only copied block by block between local sources and destinations.', LogLevel.WARNING)
+        return []
+
+    if (changes is None):
+        commands = []
+        for sourceDir in sourceDirs:
+            args = ['find', str (sourceDir)] + (['-xdev'] if stayOnFS else []) + ['-type', 'f', '-size', '+{0}c'.format (env.large_file_size - 1), '-printf', '%p\\0']
+            commands.append (args)
+        candidates = [res.stdout.split ('\0') for res in runcmdutils.run_cmds (commands)]
+    else:
+        candidates = [[p for p in changes if p == os.path.abspath (s.path) or p.startswith (os.path.join (os.path.abspath (s.path), ''))] for s in sourceDirs]
+        candidates = [[p for p in paths if os.path.isfile (p) and not os.path.islink (p) and os.path.getsize (p) >= env.large_file_size] for paths in candidates]
+    destPrefix = os.path.join (os.path.abspath (destinationDir.path), '')
+    pathFilter = filters.PathFilter (excludes)
+
+    largeFiles = []
+    for sourceDir, paths in zip (sourceDirs, candidates):
+        root = os.path.dirname (sourceDir.path) if sourceDir.is_file() else sourceDir.path
+        for path in paths:
+            if (not path or os.path.abspath (path).startswith (destPrefix) or pathFilter.is_excluded (path, root)):
+                continue
+            if (preservePath):
+                rel = os.path.abspath (path).lstrip (os.sep)
+            elif (sourceDir.is_file()):
+                rel = os.path.basename (path)
+            else:
+                rel = os.path.relpath (path, str (sourceDir))
+            frozen = _frozen_path (sourceDir._copy (path), sourceDir, views).path
+            # Files created after the snapshot are copied by the next backup.
+            if (os.path.isfile (frozen)):
+                largeFiles.append ((frozen, rel))
+    write_log ('Found {0} files of at least {1} MiB to copy block by block.'.format (len (largeFiles), env.large_file_size // 1048576))
+    return largeFiles
+
+
+
+# Copies the large files block by block into the destination. Returns
+# False if one of them cannot be copied.
+@traced()
+def _copy_large_files (largeFiles, destinationDir, previousBackup):
+    blocksDir = blockdelta.blocks_dir_of (destinationDir.path)
+    previousBlocksDir = blockdelta.blocks_dir_of (previousBackup.path) if previousBackup is not None else blocksDir
+    for source, rel in largeFiles:
+        dest = destinationDir.join (rel).path
+        previousIndex = blockdelta.index_file_of (previousBlocksDir, rel)
+        newIndex = blockdelta.index_file_of (blocksDir, rel)
+        if (runcmdutils.is_planning()):
+            if (not blockdelta.is_unchanged (source, dest if previousBackup is None else previousBackup.join (rel).path, previousIndex)):
+                runcmdutils.current_plan().add_estimate (os.path.getsize (source), 1)
+                runcmdutils.plan_operation ('copy the changed blocks of {0} to {1}'.format (source, dest))
+            continue
+        try:
+            written = blockdelta.sync_file (source, dest, previousIndex, newIndex)
+        except OSError as e:
+            write_log ('Copying the blocks of \'{0}\' failed: {1}'.format (source, e), LogLevel.ERROR)
+            return False
+        if (written):
+            _count_transfer (written, 1)
+        _count_referenced (os.path.getsize (source))
     return True
 
 
@@ -640,9 +2043,16 @@ def backup_rsync_source_dirs (sourceDirs, destinationDir, *, excludes = [], stay
 # method uses rsync to move all files between locatoins.
 # This strategy does not execute any retention plan because it overwrites
 # older backups in place.
-def backup_strategy_2 (hostName, sourceDirs, destinationDir, *, excludes = [], stayOnFS = True, preservePath = False, syncMode = False, ignoreErrors = False):
+@traced()
+def backup_strategy_2 (hostName, sourceDirs, destinationDir, *, excludes = [], stayOnFS = True, preservePath = False, syncMode = False, ignoreErrors = False, changeJournal = None, findNewState = None):
     rsyncDestDir = destinationDir.join (hostName)
-    return  backup_rsync_source_dirs (sourceDirs, rsyncDestDir, excludes = excludes, stayOnFS = stayOnFS, preservePath = preservePath, syncMode = syncMode, ignoreErrors = ignoreErrors)
+    # Without a previous backup in place, the change journal does not help.
+    fullScan = not rsyncDestDir.exists()
+    basis = _transfer_basis (None if fullScan else rsyncDestDir)
+    if (not backup_rsync_source_dirs (sourceDirs, rsyncDestDir, excludes = excludes, stayOnFS = stayOnFS, preservePath = preservePath, syncMode = syncMode, ignoreErrors = ignoreErrors, changeJournal = changeJournal, findNewState = findNewState, fullScan = fullScan, basis = basis)):
+        return False
+    _write_manifest (rsyncDestDir)
+    return True
 
 
 
@@ -651,7 +2061,11 @@ def backup_strategy_2 (hostName, sourceDirs, destinationDir, *, excludes = [], s
 # in the destination location to better track the backup process over time.
 # This assumes that the backup destination has already set up a btrfs subvolume
 # to snapshot. If the destination folder is not 
-def backup_strategy_3 (hostName, sourceDirs, destinationDir, *, excludes = [], stayOnFS = True, preservePath = False, syncMode = False, ignoreErrors = False):
+# The phases of each backup are recorded in the run journal of the host
+# directory. If a backup is interrupted, the next run resumes it in the
+# same snapshot. Only completed snapshots are made read-only.
+@traced()
+def backup_strategy_3 (hostName, sourceDirs, destinationDir, *, excludes = [], stayOnFS = True, preservePath = False, syncMode = False, ignoreErrors = False, changeJournal = None, findNewState = None):
     destBaseDir = destinationDir.join (hostName)
     destDirName = datetime.datetime.now().strftime (env.timestampFormatString)
     destBtrfsDir = destBaseDir.join (destDirName)
@@ -671,39 +2085,77 @@ def backup_strategy_3 (hostName, sourceDirs, destinationDir, *, excludes = [], s
             return False
         _mkdir (destBaseDir)
 
-    # Also ensure that the destination directory for the backup does not exist,
-    # which we take as a sign that we would be overwriting someone else's data.
-    if (destBtrfsDir.is_dir()):
-        write_log ('The backup destination directory \'{0}\' already exists. ({1})'.format (destBtrfsDir, hostName))
+    if (not _make_room (destBaseDir, [_snapshot_pattern()], estimateKey = 'transferred')):
         return False
-    if (destBtrfsDir.exists()):
-        write_log ('The backup destination directory \'{0}\' already exists as a file. ({1})'.format (destBtrfsDir, hostName))
-        return False
-        
-    # Get the most recent backup:
-    # This command lists all directories whose names match our date-pattern
-    # we use when we create backup directories.
-    mostRecentBackupDir = _get_most_recent_backup_dir (hostName, destinationDir)
-    write_log ('The most recent backup of host \'{0}\' is \'{1}\''.format (hostName, mostRecentBackupDir))
-    
-    # if there is no backup to build on, we have to create a new subvolume
-    if (mostRecentBackupDir == None or not _path_is_btrfs_subvolume (mostRecentBackupDir)):
-        exitCode = _create_btrfs_subvolume (destBtrfsDir)
-        if (exitCode != 0):
-            write_log ('Creating a BTRFS subvolume failed with exit code {0}.'.format (exitCode))
-            return False
+
+    # If the last backup has been interrupted after its snapshot had been
+    # created, we continue to fill that snapshot instead of starting over.
+    fullScan = False
+    mostRecentBackupDir = None
+    incompleteBackupDir = _find_incomplete_backup (destBaseDir, 3)
+    resume = incompleteBackupDir is not None and incompleteBackupDir.is_dir() and _path_is_btrfs_subvolume (incompleteBackupDir)
+    if (resume):
+        write_log ('Resuming the incomplete backup \'{0}\' of host \'{1}\'.'.format (incompleteBackupDir, hostName))
+        destBtrfsDir = incompleteBackupDir
     else:
-        # Create a snapshot from the latest backup which we will use to rsync
-        # our current contents to.
-        exitCode = _create_btrfs_snapshot (mostRecentBackupDir, destBtrfsDir)
-        if (exitCode != 0):
-            write_log ('Creating BTRFS snapshot failed with exit code {0}.'.format (exitCode))
+        # Also ensure that the destination directory for the backup does not exist,
+        # which we take as a sign that we would be overwriting someone else's data.
+        if (destBtrfsDir.is_dir()):
+            write_log ('The backup destination directory \'{0}\' already exists. ({1})'.format (destBtrfsDir, hostName))
+            return False
+        if (destBtrfsDir.exists()):
+            write_log ('The backup destination directory \'{0}\' already exists as a file. ({1})'.format (destBtrfsDir, hostName))
             return False
 
+        # Get the most recent backup:
+        # This command lists all directories whose names match our date-pattern
+        # we use when we create backup directories.
+        mostRecentBackupDir = _get_most_recent_backup_dir (hostName, destinationDir)
+        write_log ('The most recent backup of host \'{0}\' is \'{1}\''.format (hostName, mostRecentBackupDir))
+
+        _write_run_journal (destBaseDir, strategy = 3, phase = 'snapshot', target = destDirName)
+
+        # if there is no backup to build on, we have to create a new subvolume
+        fullScan = mostRecentBackupDir == None or not _path_is_btrfs_subvolume (mostRecentBackupDir)
+        if (fullScan):
+            exitCode = _create_btrfs_subvolume (destBtrfsDir)
+            if (exitCode != 0):
+                write_log ('Creating a BTRFS subvolume failed with exit code {0}.'.format (exitCode))
+                return False
+        else:
+            # Create a snapshot from the latest backup which we will use to rsync
+            # our current contents to.
+            exitCode = _create_btrfs_snapshot (mostRecentBackupDir, destBtrfsDir)
+            if (exitCode != 0):
+                write_log ('Creating BTRFS snapshot failed with exit code {0}.'.format (exitCode))
+                return False
+            # The parent is the best base for sending the snapshot to a
+            # replica incrementally, see replicate.py.
+            _record_parent (destBaseDir, destBtrfsDir, mostRecentBackupDir)
+
+    _write_run_journal (destBaseDir, strategy = 3, phase = 'transfer', target = destBtrfsDir.get_last_part())
+
+    # A planned snapshot does not exist, but it would be a copy of the
+    # most recent backup.
+    planDest = mostRecentBackupDir if (runcmdutils.is_planning() and not resume and not fullScan) else None
+    # What an interrupted run left in a snapshot is not known.
+    basis = None if resume else _transfer_basis (None if fullScan else mostRecentBackupDir)
+
     # From here it really is the same as in strategy 2:
     # we just rsync everything to its destination directory, while
     # the destination is located inside a BTRFS volume or snapshot.
-    backup_rsync_source_dirs (sourceDirs, destBtrfsDir, excludes = excludes, stayOnFS = stayOnFS, preservePath = preservePath, syncMode = syncMode, ignoreErrors = ignoreErrors)
+    if (not backup_rsync_source_dirs (sourceDirs, destBtrfsDir, excludes = excludes, stayOnFS = stayOnFS, preservePath = preservePath, syncMode = syncMode, ignoreErrors = ignoreErrors, changeJournal = changeJournal, findNewState = findNewState, fullScan = fullScan, planDest = planDest, previousBackup = None if fullScan else mostRecentBackupDir, basis = basis)):
+        if (not ignoreErrors):
+            write_log ('Copying the sources of host \'{0}\' failed, the backup \'{1}\' is incomplete and will be resumed by the next run.'.format (hostName, destBtrfsDir), LogLevel.ERROR)
+            return False
+        write_log ('Copying the sources of host \'{0}\' reported errors which are ignored.'.format (hostName), LogLevel.WARNING)
+
+    # The snapshot is complete, protect it from further changes.
+    if (_set_btrfs_read_only (destBtrfsDir) != 0):
+        write_log ('Making the backup \'{0}\' read-only failed.'.format (destBtrfsDir), LogLevel.WARNING)
+    _write_run_journal (destBaseDir, strategy = 3, phase = 'complete', target = destBtrfsDir.get_last_part())
+    _write_manifest (destBtrfsDir, previousBackup = mostRecentBackupDir)
+    _record_backup_sizes (destBaseDir, destBtrfsDir, patterns = [_snapshot_pattern()], mountPoint = mountPoint)
 
     # At the end we remove old backups that are no longer needed.
     #_execute_retention_plan (destBaseDir, pattern = '{0}/'.format (env.timestampGlobPattern))
@@ -712,11 +2164,18 @@ def backup_strategy_3 (hostName, sourceDirs, destinationDir, *, excludes = [], s
 
 
 
+# The pattern of the snapshots of strategy 3.
+def _snapshot_pattern():
+    return '{0}/'.format (env.timestampGlobPattern)
+
+
+
 # Implements the 4th backup strategy:
 # If the root filesystem of the source is a BTRFS subvolume, we can make
 # use of this and create a snapshot, before sending the difference to the
 # backup location itself. For this we will use btrfs send and receive.
-def backup_strategy_4 (hostName, sourceDir, destinationDir, *, excludes = [], ignoreErrors = False):
+@traced()
+def backup_strategy_4 (hostName, sourceDir, destinationDir, *, excludes = [], stayOnFS = True, preservePath = False, syncMode = False, ignoreErrors = False, changeJournal = None, findNewState = None):
     
     
     
@@ -727,23 +2186,157 @@ def backup_strategy_4 (hostName, sourceDir, destinationDir, *, excludes = [], ig
 # This is the main entry point for other scripts if this file is used as
 # a module. The parameters passed to this method will come form the list
 # of parameters if this file is started as a script.
-def backup (hostName, sourceDirs, destinationDir, *, strategy = None, excludes = [], days_off = 1, stayOnFS = True, preservePath = False, syncMode = False, ignoreErrors = False):
+@traced()
+def backup (hostName, sourceDirs, destinationDir, *, strategy = None, excludes = [], days_off = 1, stayOnFS = True, preservePath = False, syncMode = False, ignoreErrors = False, changeJournal = None, findNewState = None):
     # Defines for each backup strategy the function that implements it,
     # and a string pattern that can be used for globbing the destination
     # directory for backups.
     strategies = {1: backup_strategy_1, 2: backup_strategy_2, 3: backup_strategy_3, 4: backup_strategy_4}
 
-    # Turn all path-strings into Path-instances
+    # Turn all path-strings into Path-instances; object stores are given
+    # by their URLs.
     _src = [Path (p) for p in sourceDirs]
-    _dst = Path (destinationDir)
-    _excludes = [Path (p) for p in excludes]
+    toObjectStore = objectstore.is_object_store_url (destinationDir)
+    _dst = destinationDir if toObjectStore else Path (destinationDir)
+    _excludes = filters.as_rules (excludes)
 
-    if strategy is None:
+    if (toObjectStore):
+        if (strategy not in [None, 1]):
+            write_log ('Object stores only take the archives of strategy 1, not strategy {0}.'.format (strategy), LogLevel.ERROR)
+            return False
+        strategy = 1
+        strategies[1] = backup_to_object_store
+    elif strategy is None:
         strategy = _find_best_backup_strategy(_dst)
 
     write_log ('Starting backup with strategy \'{0}\' for host \'{1}\''.format (strategy, hostName))
+    if (env.encryption_key is not None and strategy != 1):
+        write_log ('Only the archives of strategy 1 are encrypted, the backup is written in the clear.', LogLevel.WARNING)
+
+    plan = runcmdutils.current_plan()
+    estimatedBytes = plan.estimatedBytes if plan else 0
+    started = datetime.datetime.now()
+    startTime = time.monotonic()
+    _reset_transfer()
+
+    with tracing.collect_phases() as phases:
+        result = strategies[strategy](hostName, _src, _dst, excludes = _excludes, stayOnFS = stayOnFS, preservePath = preservePath, syncMode = syncMode, ignoreErrors = ignoreErrors, changeJournal = changeJournal, findNewState = findNewState)
+
+    runs = {'host': hostName, 'strategy': strategy, 'destination': _dst if toObjectStore else _dst.full_path()}
+    if (plan):
+        # Predict the duration from the throughput of the previous runs.
+        previousRuns = history.read_runs (env.history_file, **runs) if env.history_file else []
+        plan.add_prediction (history.predict_duration (previousRuns, plan.estimatedBytes - estimatedBytes))
+    elif (result and env.history_file):
+        previousRuns = history.read_runs (env.history_file, **runs)
+        seconds = round (time.monotonic() - startTime, 3)
+        run = dict (runs, started = started.isoformat (timespec = 'seconds'), seconds = seconds, bytes = _transfer.bytes, files = _transfer.files,
+            throughput = round (_transfer.bytes / seconds) if seconds > 0 else 0,
+            commands = sum ([count for name, (_, count) in phases.items() if name in _commandSpans]),
+            phases = {name: round (s, 3) for name, (s, _) in sorted (phases.items()) if name not in _commandSpans})
+        scores = history.departures (previousRuns, run)
+        if (scores):
+            write_log (history.describe_departures (run, scores), LogLevel.WARNING)
+        try:
+            history.append_run (env.history_file, run)
+            if (env.metrics_file):
+                history.write_openmetrics (env.metrics_file, history.read_runs (env.history_file))
+        except OSError as e:
+            write_log ('The run cannot be recorded in the history file \'{0}\': {1}'.format (env.history_file, e), LogLevel.WARNING)
+
+    return result
+
+
+
+# The spans of runcmdutils that stand for a command each.
+_commandSpans = ['exec_cmd', 'exec_cmd_async']
+
+
+
+# Backs up the sources to several destinations, one after the other. The
+# sources are read once for all destinations as far as possible, see the
+# module fanout. Returns the result of the backup to each destination. Work
+# that is deferred by the backups, like committing the cursor of the change
+# journal, is only done if all of them succeeded, so that the next run
+# copies the changes to all destinations again otherwise.
+@traced()
+def backup_to_many (hostName, sourceDirs, destinationDirs, **kwargs):
+    if (len (destinationDirs) < 2 or runcmdutils.is_planning()):
+        return [backup (hostName, sourceDirs, destinationDir, **kwargs) for destinationDir in destinationDirs]
+
+    # The recorded transfers are kept next to the first local destination.
+    localDirs = [d for d in destinationDirs if not objectstore.is_object_store_url (d) and not Path (d).is_remote_path() and os.path.isdir (d)]
+    results = []
+    with fanout.recording (localDirs[0] if localDirs else None) as recording:
+        for destinationDir in destinationDirs:
+            recording.start_destination()
+            result = backup (hostName, sourceDirs, destinationDir, **kwargs)
+            if (result):
+                write_log ('The backup of host \'{0}\' to \'{1}\' succeeded.'.format (hostName, destinationDir))
+            else:
+                write_log ('The backup of host \'{0}\' to \'{1}\' failed.'.format (hostName, destinationDir), LogLevel.ERROR)
+            results.append (result)
+        if (all (results)):
+            recording.run_deferred()
+    return results
+
+
+
+# Plans a backup instead of executing it: the operations that would change
+# anything are listed in the returned plan, together with an estimate of
+# the data that would be copied and the predicted duration. If a plan is
+# already being made, e.g. for the backups of several hosts, the backup is
+# added to it. The arguments are the same as for backup().
+def plan_backup (hostName, sourceDirs, destinationDir, **kwargs):
+    if (runcmdutils.is_planning()):
+        backup (hostName, sourceDirs, destinationDir, **kwargs)
+        return runcmdutils.current_plan()
+
+    runcmdutils.start_plan()
+    try:
+        backup (hostName, sourceDirs, destinationDir, **kwargs)
+    finally:
+        plan = runcmdutils.finish_plan()
+    write_plan_report (plan)
+    return plan
+
+
+
+# Writes a plan to the log.
+def write_plan_report (plan):
+    lines = ['The backup would perform these operations:']
+    lines.extend (['  [{0}] {1}'.format (machine, description) for machine, description in plan.operations])
+    lines.append ('It would copy {0:.1f} MiB in {1} files.'.format (plan.estimatedBytes / 1048576, plan.estimatedFiles))
+    if (plan.unpredictedBackups):
+        lines.append ('The duration cannot be predicted, because there are no previous runs to learn from.')
+    else:
+        lines.append ('It would take about {0}.'.format (timedelta (seconds = round (plan.predictedSeconds))))
+    write_log ('\n'.join (lines), LogLevel.WARNING)
 
-    strategies[strategy](hostName, _src, _dst, excludes = _excludes, stayOnFS = stayOnFS, preservePath = preservePath, syncMode = syncMode, ignoreErrors = ignoreErrors)
+
+
+# Runs backup() in a worker thread of the running event loop, so that one
+# loop can wait for the backups of many hosts, e.g. with asyncio.gather().
+# This is not a coroutine that runs the backup itself: cancelling it does
+# not stop the backup, which runs to its end in the thread. All backups
+# share the global env and the environment of runcmdutils, which must not
+# be changed while any of them runs, so concurrent backups only differ in
+# their arguments.
+async def backup_async (hostName, sourceDirs, destinationDir, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor (None, functools.partial (backup, hostName, sourceDirs, destinationDir, **kwargs))
+
+
+
+# Combines the rules of the filter files, the exclude files and the excludes
+# given on the command line, in this order of precedence.
+def _read_rules():
+    rules = filters.RuleSet()
+    for filterFile in env.filter_files:
+        rules += filters.read_filter_file (filterFile)
+    for excludeFile in env.exclude_files:
+        rules += filters.read_exclude_file (excludeFile)
+    return rules + env.excluded_dirs
 
 
 
@@ -752,27 +2345,60 @@ def start_backup():
     # we query it from the system.
     if (env.host_name == None):
         env.host_name = _hostname()
-    backup (env.host_name, env.source_dirs, env.dest_dir, strategy = env.backup_strategy, excludes = env.excluded_dirs, stayOnFS = env.stay_on_file_system, preservePath = env.preserve_path, syncMode = env.sync_mode, ignoreErrors = env.ignore_errors)
+    try:
+        rules = _read_rules()
+    except (OSError, ValueError) as e:
+        write_log ('Reading the rules of the backup failed: {0}'.format (e), LogLevel.ERROR)
+        return
+    if (env.encryption_key_file):
+        try:
+            env.encryption_key = encryption.read_key (env.encryption_key_file)
+        except (OSError, encryption.EncryptionError) as e:
+            write_log ('Reading the key of the encryption failed: {0}'.format (e), LogLevel.ERROR)
+            return
+    options = {'strategy': env.backup_strategy, 'excludes': rules, 'stayOnFS': env.stay_on_file_system, 'preservePath': env.preserve_path, 'syncMode': env.sync_mode, 'ignoreErrors': env.ignore_errors, 'changeJournal': env.change_journal, 'findNewState': env.find_new_state}
+    if (env.dry_run):
+        for destDir in env.dest_dirs:
+            plan_backup (env.host_name, env.source_dirs, destDir, **options)
+    else:
+        backup_to_many (env.host_name, env.source_dirs, env.dest_dirs, **options)
 
 
 
 def inner_main(*args):
     args = parse_args (*args)
     init_env (args)
-    start_backup()
+
+    if (env.trace_file):
+        tracing.start_trace()
+    profiler = cProfile.Profile() if env.profile_file else None
+    if (profiler):
+        profiler.enable()
+    try:
+        start_backup()
+    finally:
+        if (profiler):
+            profiler.disable()
+            profiler.dump_stats (env.profile_file)
+        if (env.trace_file):
+            tracing.write_trace (env.trace_file)
+        runcmdutils.write_usage_summary()
     return 0
 
 
 
+# Aborts the backup. The run journal of the host is left in the phase the
+# backup was in, so that the next run can resume it.
 def signal_handler(sig, frame):
-    print('Backup aborted.')
-    sys.exit(0)
+    write_log ('Backup aborted by signal {0}, it will be resumed by the next run.'.format (sig), LogLevel.WARNING)
+    sys.exit(128 + sig)
 
 
 
 def main(*args):
-    write_log ('Current user of the script is: \'{0}\''.format (get_user_info()), level=LogLevel.DEBUG)
+    write_log ('Current user of the script is: \'{0}\'', LogLevel.DEBUG, get_user_info())
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
     return inner_main(*args)
 
 
@@ -0,0 +1,437 @@
+#!/usr/bin/python3
+
+# This module records the paths that change below a set of source
+# directories into a compact journal on disk. A backup that finds a
+# usable journal hands only those paths to rsync (via --files-from)
+# instead of letting rsync walk the whole source tree.
+#
+# The journal is written by a long running watcher process (see main()
+# at the end of this file) which uses recursive inotify watches. It is
+# a NUL-separated file of records:
+#
+#   btrcp-journal 1 <session> <segment>\0
+#   /absolute/path/of/a/changed/file\0
+#   ...
+#   !overflow\0
+#
+# The session is a random id which changes each time the watcher is
+# (re-)started, the segment is a counter which is incremented each time
+# the watcher starts a fresh journal after a backup has consumed all
+# records of the previous one. Records that do not start with a path
+# separator are markers; the only marker we know of is '!overflow',
+# which tells the reader that changes have been lost and a full scan
+# is needed.
+#
+# The reader keeps its position in a state file next to the journal
+# ('<journal>.state'), which contains the session, segment and byte
+# offset up to which the changes have been backed up successfully.
+
+
+
+import argparse
+import ctypes
+import errno
+import os
+import select
+import signal
+import struct
+import sys
+import uuid
+import runcmdutils
+from runcmdutils import write_log, LogLevel
+
+
+
+# This is the version of the script.
+script_version='1.0.0'
+
+# The magic string and format version at the beginning of each journal.
+_journalMagic = 'btrcp-journal'
+_journalVersion = '1'
+
+# The marker that is written to the journal when the watcher lost
+# track of some changes.
+_overflowMarker = '!overflow'
+
+# The suffix of the file which keeps the position of the reader.
+_stateSuffix = '.state'
+
+# The default number of records a journal segment may hold before the
+# watcher gives up and writes the overflow marker. A backup that has
+# to copy more files than that is better off with a full scan anyway.
+default_max_entries = 1000000
+
+# The default number of seconds the watcher waits for new events before
+# it flushes the journal and checks whether it can start a new segment.
+default_flush_interval = 5
+
+
+
+# Constants of the inotify API, see inotify(7).
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+# The events we subscribe to for each directory of the source trees.
+_watchMask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+
+# The layout of the fixed part of a struct inotify_event.
+_eventHeader = struct.Struct ('iIII')
+
+
+
+# Is raised if the journal cannot be used, e.g. because inotify is not
+# available on this system.
+class JournalError(Exception):
+    pass
+
+
+
+# Formats the header record of a journal.
+def _mk_header (session, segment):
+    return '{0} {1} {2} {3}'.format (_journalMagic, _journalVersion, session, segment)
+
+
+
+# Parses the header record of a journal and returns a tuple of the
+# session and the segment, or None if the header is not valid.
+def _parse_header (record):
+    parts = record.split (' ')
+    if (len (parts) != 4 or parts[0] != _journalMagic or parts[1] != _journalVersion):
+        return None
+    try:
+        return (parts[2], int (parts[3]))
+    except ValueError:
+        return None
+
+
+
+# Reads the state file of the journal reader. Returns a tuple of the
+# session, the segment and the offset, or None if there is no state yet.
+def _read_state (journalFile):
+    try:
+        with open (journalFile + _stateSuffix, 'r', encoding = 'UTF-8') as f:
+            parts = f.read().split()
+        return (parts[0], int (parts[1]), int (parts[2]))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+
+# Writes the state file of the journal reader atomically.
+def _write_state (journalFile, session, segment, offset):
+    stateFile = journalFile + _stateSuffix
+    with runcmdutils.atomic_write (stateFile, sync = True) as f:
+        f.write ('{0} {1} {2}\n'.format (session, segment, offset))
+
+
+
+# The cursor is what read_changes() hands out to the caller, and what the
+# caller passes back to commit_changes() after a successful backup.
+class JournalCursor:
+    __slots__ = ['journal_file', 'session', 'segment', 'offset']
+
+    def __init__ (self, journalFile, session, segment, offset):
+        self.journal_file = journalFile
+        self.session = session
+        self.segment = segment
+        self.offset = offset
+
+
+
+# Reads all changes from the journal that have not been committed by a
+# previous backup. Returns a tuple of the set of changed paths and a
+# cursor. If the journal cannot be used for an incremental backup, the
+# set of changes is None, which means that the caller has to fall back
+# to a full scan of its sources. The cursor is None if there is no
+# valid journal at all.
+def read_changes (journalFile):
+    try:
+        with open (journalFile, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        write_log ('The change journal \'{0}\' cannot be read: {1}'.format (journalFile, e), LogLevel.WARNING)
+        return (None, None)
+
+    # The journal ends with the last complete record, everything after
+    # the last NUL is a record the watcher is still writing.
+    end = data.rfind (b'\0') + 1
+    records = data[:end].split (b'\0')[:-1]
+    header = _parse_header (records[0].decode ('UTF-8', 'surrogateescape')) if records else None
+    if (header is None):
+        write_log ('The change journal \'{0}\' has no valid header.'.format (journalFile), LogLevel.WARNING)
+        return (None, None)
+
+    session, segment = header
+    cursor = JournalCursor (journalFile, session, segment, end)
+    state = _read_state (journalFile)
+
+    if (state is None):
+        write_log ('The change journal \'{0}\' has never been used for a backup before.'.format (journalFile))
+        return (None, cursor)
+    if (state[0] != session):
+        write_log ('The watcher of the change journal \'{0}\' has been restarted since the last backup.'.format (journalFile))
+        return (None, cursor)
+
+    # If the watcher started a new segment, the previous segment had been
+    # consumed completely, so we start at the beginning of the new one.
+    offset = 0
+    if (state[1] == segment):
+        offset = state[2]
+    elif (state[1] + 1 != segment):
+        write_log ('The change journal \'{0}\' skipped a segment since the last backup.'.format (journalFile), LogLevel.WARNING)
+        return (None, cursor)
+
+    changes = set()
+    pos = len (records[0]) + 1
+    for record in records[1:]:
+        nextPos = pos + len (record) + 1
+        if (nextPos > offset):
+            path = record.decode ('UTF-8', 'surrogateescape')
+            if (not path.startswith (os.sep)):
+                write_log ('The change journal \'{0}\' overflowed since the last backup.'.format (journalFile))
+                return (None, cursor)
+            changes.add (path)
+        pos = nextPos
+
+    return (changes, cursor)
+
+
+
+# Records that all changes up to the cursor have been backed up.
+def commit_changes (cursor):
+    if (cursor is None):
+        return
+    _write_state (cursor.journal_file, cursor.session, cursor.segment, cursor.offset)
+
+
+
+# Maps the absolute paths of a set of changes to paths relative to the
+# source directory. Paths which do not lie in the source directory are
+# dropped. The result is sorted, which makes rsync's job a bit easier.
+def changes_below (changes, sourceDir):
+    base = os.path.abspath (sourceDir).rstrip (os.sep)
+    prefix = base + os.sep
+    res = []
+    for c in changes:
+        if (c.startswith (prefix)):
+            res.append (c[len (prefix):])
+    res.sort()
+    return res
+
+
+
+# Returns a reference to the C library functions of the inotify API.
+def _load_inotify():
+    try:
+        libc = ctypes.CDLL (None, use_errno = True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError) as e:
+        raise JournalError ('inotify is not available on this system: {0}'.format (e))
+
+
+
+# Watches a set of directory trees with inotify and appends every path
+# that changes to the journal.
+class JournalWriter:
+
+    def __init__ (self, sourceDirs, journalFile, *, maxEntries = default_max_entries):
+        self.source_dirs = [os.path.abspath (d) for d in sourceDirs]
+        self.journal_file = journalFile
+        self.max_entries = maxEntries
+        self.session = uuid.uuid4().hex
+        self.segment = 0
+        self._libc = _load_inotify()
+        self._fd = None
+        self._journal = None
+        self._watches = {}
+        self._entries = 0
+        self._batch = set()
+        self._overflowed = False
+
+    # Opens a fresh journal segment. The journal is replaced atomically,
+    # so a reader either sees the complete old or the new segment.
+    def _start_segment (self):
+        if (self._journal is not None):
+            self._journal.close()
+        with runcmdutils.atomic_write (self.journal_file, 'wb', sync = True) as f:
+            f.write (_mk_header (self.session, self.segment).encode ('UTF-8') + b'\0')
+        self._journal = open (self.journal_file, 'ab')
+        self._entries = 0
+        self._batch = set()
+        self._overflowed = False
+
+    # Appends a path to the journal, unless it is already recorded in the
+    # current batch of events or the segment has overflowed. Paths are only
+    # left out within a batch: all of its events happened before any of its
+    # records can be read, whereas a change after a backup read the journal
+    # has to be recorded again, even if the path is already in the segment.
+    def _record (self, path):
+        if (self._overflowed or path in self._batch):
+            return
+        if (self._entries >= self.max_entries):
+            self._overflow ('the journal holds more than {0} paths'.format (self.max_entries))
+            return
+        self._batch.add (path)
+        self._entries += 1
+        self._journal.write (os.fsencode (path) + b'\0')
+
+    # Marks the current segment as overflowed, which forces the next
+    # backup to do a full scan.
+    def _overflow (self, reason):
+        if (self._overflowed):
+            return
+        write_log ('The change journal overflowed because {0}.'.format (reason), LogLevel.WARNING)
+        self._journal.write (_overflowMarker.encode ('UTF-8') + b'\0')
+        self._overflowed = True
+
+    # Adds an inotify watch for a single directory.
+    def _add_watch (self, path):
+        wd = self._libc.inotify_add_watch (self._fd, os.fsencode (path), _watchMask)
+        if (wd < 0):
+            err = ctypes.get_errno()
+            if (err == errno.ENOSPC):
+                self._overflow ('the inotify watch limit has been reached (see /proc/sys/fs/inotify/max_user_watches)')
+            elif (err not in [errno.ENOENT, errno.ENOTDIR, errno.EACCES]):
+                self._overflow ('adding a watch for \'{0}\' failed: {1}'.format (path, os.strerror (err)))
+            return
+        self._watches[wd] = path
+
+    # Adds watches for a directory and all directories below it. If
+    # 'record' is set, all files found are recorded as changed, which is
+    # needed for directories which have been created or moved into the
+    # watched trees after the watches were set up.
+    def _add_tree (self, root, *, record = False):
+        if (record):
+            self._record (root)
+        for dirPath, dirNames, fileNames in os.walk (root, onerror = lambda e: None):
+            self._add_watch (dirPath)
+            if (record):
+                for name in dirNames + fileNames:
+                    self._record (os.path.join (dirPath, name))
+
+    # Processes all events that have been read from the inotify descriptor.
+    def _process_events (self, buf):
+        self._batch = set()
+        pos = 0
+        while (pos + _eventHeader.size <= len (buf)):
+            wd, mask, cookie, length = _eventHeader.unpack_from (buf, pos)
+            pos += _eventHeader.size
+            name = buf[pos : pos + length].rstrip (b'\0')
+            pos += length
+
+            if (mask & IN_Q_OVERFLOW):
+                self._overflow ('the inotify event queue overflowed')
+                continue
+            if (mask & IN_IGNORED):
+                self._watches.pop (wd, None)
+                continue
+            dirPath = self._watches.get (wd)
+            if (dirPath is None):
+                continue
+            if (mask & (IN_DELETE_SELF | IN_MOVE_SELF)):
+                self._record (dirPath)
+                continue
+            path = os.path.join (dirPath, os.fsdecode (name)) if name else dirPath
+            if (mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO)):
+                self._add_tree (path, record = True)
+            else:
+                self._record (path)
+
+    # Starts a new segment if the last backup consumed all records of the
+    # current one, which keeps the journal small.
+    def _maybe_rotate (self):
+        if (not self._entries and not self._overflowed):
+            return
+        state = _read_state (self.journal_file)
+        if (state is None or state[0] != self.session or state[1] != self.segment):
+            return
+        if (state[2] < self._journal.tell()):
+            return
+        self.segment += 1
+        self._start_segment()
+
+    # Runs the watcher until it receives SIGTERM or SIGINT.
+    def run (self, *, flushInterval = default_flush_interval):
+        self._fd = self._libc.inotify_init1 (os.O_NONBLOCK | os.O_CLOEXEC)
+        if (self._fd < 0):
+            raise JournalError ('inotify_init1 failed: {0}'.format (os.strerror (ctypes.get_errno())))
+        try:
+            self._start_segment()
+            for sourceDir in self.source_dirs:
+                self._add_tree (sourceDir)
+            self._journal.flush()
+            write_log ('Watching {0} directories for changes, session \'{1}\'.'.format (len (self._watches), self.session))
+
+            while (True):
+                ready, _, _ = select.select ([self._fd], [], [], flushInterval)
+                if (ready):
+                    try:
+                        buf = os.read (self._fd, 1024 * 1024)
+                    except BlockingIOError:
+                        buf = b''
+                    self._process_events (buf)
+                self._journal.flush()
+                self._maybe_rotate()
+        finally:
+            if (self._journal is not None):
+                self._journal.close()
+            os.close (self._fd)
+
+
+
+def init_arg_parser():
+    parser = argparse.ArgumentParser(prog='btrcp-watch', description='Records changed paths of the backup sources in a journal for btrcp.')
+    parser.add_argument ('--source', '-s', dest = 'source_dirs', required = True, action = 'append', default = [], metavar='PATH', help='Specifies a source directory to watch. This option can be used multiple times in one command.')
+    parser.add_argument ('--journal', '-j', dest = 'journal_file', required = True, metavar='FILE', help='Specifies the journal file the changed paths are written to.')
+    parser.add_argument ('--max-entries', dest = 'max_entries', required = False, type = int, metavar = 'NUM', default = default_max_entries, help = 'sets the number of recorded paths after which the journal overflows and the next backup falls back to a full scan.')
+    parser.add_argument ('--flush-interval', dest = 'flush_interval', required = False, type = int, metavar = 'SECONDS', default = default_flush_interval, help = 'sets the number of seconds after which recorded changes are flushed to the journal.')
+    parser.add_argument ('--log-file', dest = 'log_file_name', required = False, metavar = 'FILENAME', help = 'Specifies the name of a log file.')
+    parser.add_argument ('--quiet', dest = 'silent_mode', required = False, action = 'store_const', const = True, help = 'Suppresses all console output of this script.')
+    parser.set_defaults (silent_mode = False)
+    parser.add_argument ('--version', action = 'version', version = '%(prog)s {0}'.format (script_version))
+    return parser
+
+
+
+def parse_args(*args):
+    parser = init_arg_parser()
+    return parser.parse_args(*args)
+
+
+
+def signal_handler(sig, frame):
+    sys.exit(0)
+
+
+
+def main(*args):
+    args = parse_args (*args)
+    if (args.silent_mode):
+        runcmdutils.remove_console_log_handler()
+    if (args.log_file_name):
+        runcmdutils.add_log_file_handler (args.log_file_name)
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    writer = JournalWriter (args.source_dirs, args.journal_file, maxEntries = args.max_entries)
+    writer.run (flushInterval = args.flush_interval)
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+
+# This module encrypts archives with authenticated encryption, so that they
+# can be kept on untrusted destinations. The data is split into chunks of
+# equal size, each of which is encrypted on its own with AES-256-GCM by a
+# pool of threads; the cipher releases the GIL, so the encryption scales
+# with the number of cores instead of being bound to a single one like
+# piping through gpg. Because the chunks are independent, any range of an
+# encrypted file can be decrypted without decrypting what lies before it,
+# e.g. the frames of a seekable archive that hold the files to restore.
+#
+# An encrypted file starts with a header
+#
+#   BTRCPENC <version> <chunk size> <salt>
+#
+# of 29 bytes: the magic string, the format version as one byte, the size
+# of the chunks as 4 bytes in big-endian order, and 16 random bytes. The
+# key of the file is derived from the key file and the salt with HKDF, so
+# that no two files share a key. Each chunk is followed by its 16 byte tag.
+# The nonce of a chunk is its number in 11 bytes followed by a byte that is
+# 1 for the last chunk and 0 for all others, and the header is passed as
+# associated data: chunks cannot be reordered, moved to other files, or
+# cut off at the end without failing to authenticate.
+#
+# A key file holds 32 random bytes, either raw or as 64 hex digits; see the
+# option --generate-key. The Python module cryptography must be installed.
+
+
+
+import argparse
+import collections
+import concurrent.futures
+import io
+import os
+import stat
+import struct
+import sys
+from runcmdutils import write_log, LogLevel
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+except ImportError:
+    AESGCM = None
+
+
+
+# This is the version of the script.
+script_version='1.0.0'
+
+# The magic string and format version at the beginning of each encrypted
+# file.
+_magic = b'BTRCPENC'
+_version = 1
+
+# The layout of the header.
+_header = struct.Struct ('>8sBI16s')
+
+# The number of bytes of the tag of each chunk.
+_tagSize = 16
+
+# The number of bytes of plain data in each chunk. Larger chunks have less
+# overhead, smaller chunks make random access cheaper.
+default_chunk_size = 1024 * 1024
+
+# The number of bytes of a key.
+key_size = 32
+
+
+
+# Is raised if a key cannot be read, or data cannot be decrypted.
+class EncryptionError(Exception):
+    pass
+
+
+
+def _check_available():
+    if (AESGCM is None):
+        raise EncryptionError ('Encryption needs the Python module cryptography, please install it.')
+
+
+
+# Reads the key from a key file.
+def read_key (keyFile):
+    _check_available()
+    with open (keyFile, 'rb') as f:
+        data = f.read()
+        mode = os.fstat (f.fileno()).st_mode
+    if (mode & (stat.S_IRWXG | stat.S_IRWXO)):
+        write_log ('The key file \'{0}\' can be read by other users.'.format (keyFile), LogLevel.WARNING)
+    if (len (data) != key_size):
+        try:
+            data = bytes.fromhex (data.decode ('ascii').strip())
+        except ValueError:
+            data = b''
+    if (len (data) != key_size):
+        raise EncryptionError ('The key file \'{0}\' does not hold a key of {1} bytes.'.format (keyFile, key_size))
+    return data
+
+
+
+# Writes a new random key to a key file, which must not exist yet and can
+# only be read by its owner.
+def generate_key (keyFile):
+    fd = os.open (keyFile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen (fd, 'w') as f:
+        f.write (os.urandom (key_size).hex() + '\n')
+
+
+
+def _make_header (chunkSize, salt):
+    return _header.pack (_magic, _version, chunkSize, salt)
+
+
+
+# Returns the chunk size and the cipher of a file from its header.
+def _parse_header (header, key):
+    if (len (header) != _header.size):
+        raise EncryptionError ('The encrypted file is truncated.')
+    magic, version, chunkSize, salt = _header.unpack (header)
+    if (magic != _magic or version != _version or chunkSize == 0):
+        raise EncryptionError ('The file has not been encrypted by btrcp, or by an unknown version.')
+    return (chunkSize, _file_cipher (key, salt))
+
+
+
+def _file_cipher (key, salt):
+    _check_available()
+    fileKey = HKDF (algorithm = hashes.SHA256(), length = key_size, salt = salt, info = _magic).derive (key)
+    return AESGCM (fileKey)
+
+
+
+def _nonce (index, last):
+    return index.to_bytes (11, 'big') + (b'\x01' if last else b'\x00')
+
+
+
+def _decrypt_chunk (cipher, header, index, last, data):
+    try:
+        return cipher.decrypt (_nonce (index, last), data, header)
+    except InvalidTag:
+        raise EncryptionError ('The chunk {0} cannot be decrypted: the key is wrong, or the file has been changed or truncated.'.format (index)) from None
+
+
+
+# Returns True if the file at the local path starts with the header of an
+# encrypted file.
+def is_encrypted (fileName):
+    try:
+        with open (fileName, 'rb') as f:
+            return f.read (len (_magic)) == _magic
+    except OSError:
+        return False
+
+
+
+# Encrypts the data written to it in chunks and writes them to the sink in
+# order. The chunks are encrypted concurrently by up to 'workers' threads;
+# a few more are held back, so that the memory stays bounded. close() must
+# be called to write the last chunk; it does not close the sink.
+class Writer:
+
+    def __init__ (self, sink, key, *, chunkSize = default_chunk_size, workers = None):
+        self._sink = sink
+        self._chunkSize = chunkSize
+        salt = os.urandom (16)
+        self._header = _make_header (chunkSize, salt)
+        self._cipher = _file_cipher (key, salt)
+        self._pool = concurrent.futures.ThreadPoolExecutor (max_workers = workers)
+        self._maxPending = 2 * (workers or os.cpu_count() or 1)
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._index = 0
+        self._sink.write (self._header)
+
+    def _submit (self, data, last):
+        self._pending.append (self._pool.submit (self._cipher.encrypt, _nonce (self._index, last), bytes (data), self._header))
+        self._index += 1
+        while (len (self._pending) > (0 if last else self._maxPending)):
+            self._sink.write (self._pending.popleft().result())
+
+    def write (self, data):
+        self._buffer.extend (data)
+        # The last chunk is marked, so a full chunk is only encrypted once
+        # more data follows it.
+        n = 0
+        while (len (self._buffer) - n > self._chunkSize):
+            self._submit (self._buffer[n : n + self._chunkSize], False)
+            n += self._chunkSize
+        del self._buffer[:n]
+        return len (data)
+
+    def close (self):
+        if (self._pool is None):
+            return
+        try:
+            self._submit (self._buffer, True)
+        finally:
+            self._pool.shutdown()
+            self._pool = None
+
+
+
+# Reads the plain data of an encrypted file. The file object must be
+# seekable; any range of the data can be read by seeking to it, and only
+# the chunks which hold that range are decrypted.
+class Reader:
+
+    def __init__ (self, f, key):
+        self._file = f
+        self._file.seek (0)
+        self._header = self._file.read (_header.size)
+        self._chunkSize, self._cipher = _parse_header (self._header, key)
+        body = self._file.seek (0, os.SEEK_END) - _header.size
+        self._chunks = (body + self._chunkSize + _tagSize - 1) // (self._chunkSize + _tagSize)
+        if (self._chunks == 0):
+            raise EncryptionError ('The encrypted file is truncated.')
+        self.size = body - self._chunks * _tagSize
+        self._position = 0
+        self._cached = (None, b'')
+
+    def _chunk (self, index):
+        if (self._cached[0] != index):
+            self._file.seek (_header.size + index * (self._chunkSize + _tagSize))
+            data = self._file.read (self._chunkSize + _tagSize)
+            self._cached = (index, _decrypt_chunk (self._cipher, self._header, index, index == self._chunks - 1, data))
+        return self._cached[1]
+
+    def read (self, size = -1):
+        end = self.size if size is None or size < 0 else min (self.size, self._position + size)
+        res = []
+        while (self._position < end):
+            index, offset = divmod (self._position, self._chunkSize)
+            data = self._chunk (index)[offset : offset + end - self._position]
+            res.append (data)
+            self._position += len (data)
+        return b''.join (res)
+
+    def seek (self, offset, whence = os.SEEK_SET):
+        if (whence == os.SEEK_CUR):
+            offset += self._position
+        elif (whence == os.SEEK_END):
+            offset += self.size
+        self._position = max (0, offset)
+        return self._position
+
+    def tell (self):
+        return self._position
+
+    def readable (self):
+        return True
+
+    def seekable (self):
+        return True
+
+    def close (self):
+        self._file.close()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *args):
+        self.close()
+
+
+
+# Opens a local file for reading. Encrypted files are decrypted with the
+# key, all others are read as they are.
+def open_file (fileName, key):
+    f = open (fileName, 'rb')
+    if (f.read (len (_magic)) != _magic):
+        f.seek (0)
+        return f
+    if (key is None):
+        f.close()
+        raise EncryptionError ('The file \'{0}\' is encrypted, please give the key file.'.format (fileName))
+    try:
+        return Reader (f, key)
+    except EncryptionError:
+        f.close()
+        raise
+
+
+
+# Encrypts the data read from the source stream into the sink.
+def encrypt_stream (source, sink, key, *, chunkSize = default_chunk_size, workers = None, readSize = default_chunk_size):
+    writer = Writer (sink, key, chunkSize = chunkSize, workers = workers)
+    try:
+        data = source.read (readSize)
+        while (data):
+            writer.write (data)
+            data = source.read (readSize)
+    finally:
+        writer.close()
+
+
+
+# Returns the encryption of the data as bytes.
+def encrypt_bytes (data, key):
+    sink = io.BytesIO()
+    encrypt_stream (io.BytesIO (data), sink, key, workers = 1)
+    return sink.getvalue()
+
+
+
+def _read_full (f, size):
+    res = []
+    while (size > 0):
+        data = f.read (size)
+        if (not data):
+            break
+        res.append (data)
+        size -= len (data)
+    return b''.join (res)
+
+
+
+# Decrypts the data read from the source stream into the sink, e.g. from a
+# pipe. Like the encryption, the chunks are decrypted by a pool of threads.
+def decrypt_stream (source, sink, key, *, workers = None):
+    header = _read_full (source, _header.size)
+    chunkSize, cipher = _parse_header (header, key)
+    maxPending = 2 * (workers or os.cpu_count() or 1)
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor (max_workers = workers) as pool:
+        index = 0
+        data = _read_full (source, chunkSize + _tagSize)
+        while (True):
+            # A chunk is the last one if nothing follows it.
+            following = _read_full (source, chunkSize + _tagSize) if len (data) == chunkSize + _tagSize else b''
+            last = not following
+            pending.append (pool.submit (_decrypt_chunk, cipher, header, index, last, data))
+            while (len (pending) > (0 if last else maxPending)):
+                sink.write (pending.popleft().result())
+            if (last):
+                break
+            index += 1
+            data = following
+
+
+
+def init_arg_parser():
+    parser = argparse.ArgumentParser(prog='btrcp-encryption', description='Generates keys for the encryption of archives written by btrcp, and encrypts or decrypts files.')
+    parser.add_argument ('--generate-key', dest = 'generate_key', required = False, metavar = 'FILE', help = 'writes a new random key to FILE, which must not exist yet.')
+    parser.add_argument ('--key-file', '-k', dest = 'key_file', required = False, metavar = 'FILE', help = 'Specifies the key file.')
+    parser.add_argument ('--decrypt', dest = 'decrypt', required = False, action = 'store_const', const = True, help = 'decrypts the input instead of encrypting it.')
+    parser.set_defaults (decrypt = False)
+    parser.add_argument ('--workers', dest = 'workers', required = False, type = int, metavar = 'NUM', default = None, help = 'sets the number of threads that encrypt or decrypt chunks, by default one per core.')
+    parser.add_argument ('input_file', metavar = 'INPUT', nargs = '?', default = '-', help = 'Specifies the file to read, by default the standard input.')
+    parser.add_argument ('output_file', metavar = 'OUTPUT', nargs = '?', default = '-', help = 'Specifies the file to write, by default the standard output.')
+    parser.add_argument ('--version', action = 'version', version = '%(prog)s {0}'.format (script_version))
+    return parser
+
+
+
+def parse_args(*args):
+    parser = init_arg_parser()
+    return parser.parse_args(*args)
+
+
+
+def main(*args):
+    args = parse_args (*args)
+    try:
+        if (args.generate_key):
+            generate_key (args.generate_key)
+            return 0
+        if (not args.key_file):
+            write_log ('Please give the key file with --key-file.', LogLevel.ERROR)
+            return 1
+        key = read_key (args.key_file)
+        source = sys.stdin.buffer if args.input_file == '-' else open (args.input_file, 'rb')
+        sink = sys.stdout.buffer if args.output_file == '-' else open (args.output_file, 'wb')
+        with source, sink:
+            if (args.decrypt):
+                decrypt_stream (source, sink, key, workers = args.workers)
+            else:
+                encrypt_stream (source, sink, key, workers = args.workers)
+    except (OSError, EncryptionError) as e:
+        write_log ('{0}'.format (e), LogLevel.ERROR)
+        return 1
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
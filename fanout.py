@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+# This module lets a backup to several destinations read its sources only
+# once. The first destination is backed up as usual, while each transfer
+# is recorded: the batch file rsync writes with --write-batch, or the
+# completed archive of tar. The backups to the other destinations replay
+# the recorded transfers in the same order, i.e. rsync applies the batch
+# with --read-batch and archives are copied from the first destination,
+# without reading the sources again. A transfer that cannot be replayed is
+# made from the sources instead.
+#
+# Each transfer is recorded with a key, which tells whether the transfer a
+# destination is about to make is the one that has been recorded, e.g. the
+# sources and options of an rsync call. rsync applies a batch blindly, so
+# the key of a batch also tells the tree the destination starts from; a
+# batch is only replayed on a destination that starts from the same tree.
+#
+# The recorded files may be as large as a whole backup, so they are kept in
+# a directory next to the first destination rather than in /tmp.
+#
+# Work that may only be done once all destinations got their backups, like
+# committing the cursor of the change journal, is deferred until the end of
+# the recording.
+
+
+
+import contextlib
+import os
+import shutil
+import tempfile
+import threading
+
+
+
+# The recording of the current thread.
+_current = threading.local()
+
+
+
+# The transfers recorded for the backups of one host to several
+# destinations.
+class Recording:
+    def __init__ (self, directory = None):
+        self.entries = []
+        self.deferred = []
+        self.directory = tempfile.mkdtemp (prefix = '.btrcp-fanout-', dir = directory)
+        self._cursor = 0
+        self._files = 0
+
+    # Starts replaying the recorded transfers from the first one.
+    def start_destination (self):
+        self._cursor = 0
+
+    # Returns what has been recorded for the next transfer, if it has the
+    # given kind and key, or None if the transfer has to be made.
+    def next (self, kind, key):
+        if (self._cursor < len (self.entries) and self.entries[self._cursor][:2] == (kind, key)):
+            self._cursor += 1
+            return self.entries[self._cursor - 1][2]
+        return None
+
+    # Records a transfer that has been made, so that it can be replayed.
+    def record (self, kind, key, artefact):
+        self.entries.insert (self._cursor, (kind, key, artefact))
+        self._cursor += 1
+
+    # Returns the name of a new file in the directory of the recording,
+    # which is removed together with the recording.
+    def new_file (self, prefix):
+        self._files += 1
+        return os.path.join (self.directory, '{0}-{1}'.format (prefix, self._files))
+
+    # Defers a function until all destinations got their backups.
+    def defer (self, fn):
+        self.deferred.append (fn)
+
+    # Calls the deferred functions.
+    def run_deferred (self):
+        for fn in self.deferred:
+            fn()
+        self.deferred = []
+
+    def close (self):
+        shutil.rmtree (self.directory, ignore_errors = True)
+
+
+
+# Returns the recording of the current thread, or None.
+def current():
+    return getattr (_current, 'recording', None)
+
+
+
+# Records the transfers of the current thread during the with-block, and
+# yields the recording. The files of the recording are kept in a new
+# directory below 'directory', or the directory for temporary files, and
+# are removed afterwards.
+@contextlib.contextmanager
+def recording (directory = None):
+    rec = Recording (directory)
+    _current.recording = rec
+    try:
+        yield rec
+    finally:
+        _current.recording = None
+        rec.close()
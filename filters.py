@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+
+# This module implements the include and exclude rules of a backup. The
+# rules are compiled once into a single regular expression, and handed to
+# rsync and tar as files instead of one argument per rule, so that
+# thousands of rules neither hit the limits of the command line nor slow
+# down the setup of each command.
+#
+# A rule is a pattern as rsync understands it:
+#
+# * a pattern starting with '/' is anchored at the root of the source,
+#   all other patterns match the end of a path,
+# * a pattern ending with '/' only matches directories,
+# * '*' matches anything but '/', '**' matches anything, '?' matches a
+#   single character other than '/', and '[...]' a character class.
+#
+# The first rule that matches a path decides whether it is included or
+# excluded; paths no rule matches are included. An excluded directory is
+# excluded with all of its contents.
+#
+# Filter files list one rule per line, as '+ PATTERN' (include) or
+# '- PATTERN' (exclude). Exclude files list one exclude pattern per line.
+# Empty lines and lines starting with '#' or ';' are ignored in both.
+#
+# Each directory of a source can hold a file named '.btrcpignore' with one
+# exclude pattern per line, which applies to the contents of that
+# directory and of all directories below it.
+
+
+
+import contextlib
+import os
+import re
+import tempfile
+from runcmdutils import write_log, LogLevel
+
+
+
+# The name of the files that exclude paths in the directory they are in and
+# below it.
+ignore_file_name = '.btrcpignore'
+
+
+
+# Returns a pattern that matches the path literally.
+def literal_pattern (path):
+    return ''.join (['\\' + c if c in '*?[\\' else c for c in path])
+
+
+
+# Translates a pattern into a regular expression, which matches the path
+# relative to the root of the source with a leading '/'.
+def _translate (pattern):
+    anchored = pattern.startswith ('/')
+    body = pattern.strip ('/')
+    res = []
+    i = 0
+    while (i < len (body)):
+        c = body[i]
+        if (body.startswith ('**', i)):
+            res.append ('.*')
+            i += 2
+            continue
+        if (c == '*'):
+            res.append ('[^/]*')
+        elif (c == '?'):
+            res.append ('[^/]')
+        elif (c == '\\' and i + 1 < len (body)):
+            i += 1
+            res.append (re.escape (body[i]))
+        elif (c == '['):
+            end = body.find (']', i + 2)
+            if (end < 0):
+                res.append ('\\[')
+            else:
+                cls = body[i + 1 : end]
+                if (cls.startswith ('!')):
+                    cls = '^' + cls[1:]
+                res.append ('[' + cls.replace ('\\', '\\\\') + ']')
+                i = end
+        else:
+            res.append (re.escape (c))
+        i += 1
+    return ('' if anchored else '(?:.*/)?') + ''.join (res)
+
+
+
+# A single include or exclude rule.
+class Rule:
+    def __init__ (self, pattern, *, include = False):
+        self.pattern = pattern
+        self.include = include
+        self.dirOnly = pattern.endswith ('/') and len (pattern) > 1
+
+    def __repr__ (self):
+        return '{0} {1}'.format ('+' if self.include else '-', self.pattern)
+
+
+
+# An ordered list of rules. The rules are compiled when a path is first
+# matched against them.
+class RuleSet:
+    def __init__ (self, rules = []):
+        self.rules = list (rules)
+        self._regex = None
+
+    def __bool__ (self):
+        return bool (self.rules)
+
+    def __len__ (self):
+        return len (self.rules)
+
+    def __repr__ (self):
+        return 'RuleSet({0})'.format (self.rules)
+
+    # Returns a new rule set with the rules of both.
+    def __add__ (self, other):
+        return RuleSet (self.rules + as_rules (other).rules)
+
+    # Returns True if the set has include rules, which tar does not support.
+    def has_includes (self):
+        return any ([r.include for r in self.rules])
+
+    def _compile (self):
+        # Each rule is an alternative of its own group. Alternatives are
+        # tried from left to right, so the group that matches is the first
+        # matching rule.
+        self._regex = re.compile ('|'.join (['(?P<r{0}>/{1}{2})'.format (i, _translate (r.pattern), '(?=/$)' if r.dirOnly else '(?=/?$)') for i, r in enumerate (self.rules)]) or '(?!)', re.DOTALL)
+
+    # Returns the first rule matching the path, which is relative to the
+    # root of the source, or None.
+    def match (self, relPath, *, isDir = False):
+        if (self._regex is None):
+            self._compile()
+        m = self._regex.match ('/' + relPath.strip ('/') + ('/' if isDir else ''))
+        return self.rules[int (m.lastgroup[1:])] if m else None
+
+    # Returns True if the path, relative to the root of the source, is
+    # excluded by the rules or lies in a directory that is.
+    def is_excluded (self, relPath, *, isDir = False):
+        parts = [p for p in relPath.split ('/') if p]
+        for i in range (1, len (parts) + 1):
+            rule = self.match ('/'.join (parts[:i]), isDir = isDir or i < len (parts))
+            if (rule is not None and not rule.include):
+                return True
+        return False
+
+    # Writes the rules in the format of rsync's filter files.
+    def write_rsync_filter (self, f):
+        f.write (''.join (['{0}\n'.format (r) for r in self.rules]))
+
+    # Writes the exclude rules as patterns for tar's --exclude-from.
+    def write_tar_excludes (self, f):
+        f.write (''.join (['{0}\n'.format (r.pattern.rstrip ('/') if r.pattern != '/' else r.pattern) for r in self.rules if not r.include]))
+
+
+
+# Returns the rules given either as a rule set, or as a list of exclude
+# patterns.
+def as_rules (excludes):
+    if (isinstance (excludes, RuleSet)):
+        return excludes
+    return RuleSet ([Rule (str (e)) for e in excludes])
+
+
+
+def _read_lines (fileName):
+    with open (fileName, 'r', encoding = 'UTF-8', errors = 'surrogateescape') as f:
+        return [line.rstrip ('\n') for line in f if line.strip() and not line.startswith (('#', ';'))]
+
+
+
+# Reads a filter file with '+ PATTERN' and '- PATTERN' lines.
+def read_filter_file (fileName):
+    rules = []
+    for line in _read_lines (fileName):
+        if (line.startswith (('+ ', '- '))):
+            rules.append (Rule (line[2:], include = line[0] == '+'))
+        else:
+            raise ValueError ('The line \'{0}\' of the filter file \'{1}\' is neither an include nor an exclude rule.'.format (line, fileName))
+    return RuleSet (rules)
+
+
+
+# Reads a file of exclude patterns, one on each line.
+def read_exclude_file (fileName):
+    return RuleSet ([Rule (line) for line in _read_lines (fileName)])
+
+
+
+# Writes a temporary file with the function given, and yields its name. The
+# file is removed after the with-block. NamedTemporaryFile only takes an
+# error handler from Python 3.8 on, which the paths need.
+@contextlib.contextmanager
+def _temporary_rules_file (prefix, write):
+    fd, fileName = tempfile.mkstemp (prefix = prefix)
+    try:
+        with os.fdopen (fd, 'w', encoding = 'UTF-8', errors = 'surrogateescape') as f:
+            write (f)
+        yield fileName
+    finally:
+        os.unlink (fileName)
+
+
+
+# Yields the arguments that make rsync apply the rules and the ignore files
+# of the sources. The rules are written to a temporary filter file that
+# exists as long as the with-block.
+@contextlib.contextmanager
+def rsync_filter_args (rules):
+    args = ['--filter', ':- {0}'.format (ignore_file_name)]
+    if (not rules):
+        yield args
+        return
+    with _temporary_rules_file ('btrcp-filter-', rules.write_rsync_filter) as fileName:
+        yield ['--filter', 'merge {0}'.format (fileName)] + args
+
+
+
+# Yields the arguments that make tar apply the exclude rules and the ignore
+# files of the sources. tar has no include rules, they are dropped.
+@contextlib.contextmanager
+def tar_exclude_args (rules):
+    args = ['--exclude-ignore-recursive={0}'.format (ignore_file_name)]
+    if (rules.has_includes()):
+        write_log ('tar does not support include rules, they are ignored for archives.', LogLevel.WARNING)
+    if (not rules):
+        yield args
+        return
+    with _temporary_rules_file ('btrcp-exclude-', rules.write_tar_excludes) as fileName:
+        yield ['--exclude-from', fileName] + args
+
+
+
+# Filters local paths through the rules and the ignore files of the
+# directories they lie in. The ignore files are read once.
+class PathFilter:
+    def __init__ (self, rules):
+        self.rules = as_rules (rules)
+        self._ignoreFiles = {}
+
+    def _ignore_rules (self, directory):
+        rules = self._ignoreFiles.get (directory)
+        if (rules is None):
+            ignoreFile = os.path.join (directory, ignore_file_name)
+            rules = read_exclude_file (ignoreFile) if os.path.isfile (ignoreFile) else RuleSet()
+            self._ignoreFiles[directory] = rules
+        return rules
+
+    # Returns True if the path, which lies in the source 'root', is excluded.
+    # Patterns anchored with '/' match the path relative to the root, as
+    # for rsync, or the absolute path, as for tar.
+    def is_excluded (self, path, root, *, isDir = False):
+        root = os.path.abspath (root)
+        path = os.path.abspath (path)
+        relPath = os.path.relpath (path, root) if path != root else ''
+        if (relPath.startswith ('..')):
+            relPath = ''
+        if (self.rules and (self.rules.is_excluded (path, isDir = isDir) or (relPath and self.rules.is_excluded (relPath, isDir = isDir)))):
+            return True
+        # The ignore files of the directories from the root down to the
+        # path apply to the rest of the path below them.
+        directory = root
+        parts = [p for p in relPath.split (os.sep) if p]
+        for i in range (len (parts)):
+            ignore = self._ignore_rules (directory)
+            if (ignore and ignore.is_excluded ('/'.join (parts[i:]), isDir = isDir)):
+                return True
+            directory = os.path.join (directory, parts[i])
+        return False
@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+
+# This module keeps the history of completed backup runs. Each run is a
+# JSON object on a line of its own in the history file, e.g.
+#
+#   {"host": "web", "strategy": 2, "destination": "/mnt/backup", "started": "2022-01-01T12:00:00",
+#    "seconds": 81.5, "bytes": 104857600, "files": 1234, "throughput": 1286596, "commands": 14,
+#    "phases": {"_rsync": 78.2, "_execute_retention_plan": 0.4}}
+#
+# where 'bytes' and 'files' are the amount of data that has been copied,
+# 'throughput' is the number of bytes copied per second, 'commands' the
+# number of commands that have been run, and 'phases' the seconds spent in
+# each phase of the backup (see tracing.collect_phases()). Runs recorded by
+# older versions lack the last three fields.
+#
+# The history is used to predict how long a planned backup will take, and
+# to tell runs whose throughput or duration departs from the runs before
+# them. Run as a script, it shows the trends of the runs of each host, and
+# writes the last runs as metrics in the OpenMetrics text format, e.g. for
+# the textfile collector of the Prometheus node_exporter.
+
+
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import sys
+import runcmdutils
+from runcmdutils import write_log, LogLevel
+
+
+
+# The history file used if none is given on the command line.
+default_history_file = os.path.join (runcmdutils.state_dir(), 'history.jsonl')
+
+# This is the version of the script.
+script_version='1.0.0'
+
+# The number of most recent runs used to predict the duration of a backup.
+prediction_runs = 5
+
+# The number of runs before a run its baseline is taken from, and the
+# number of runs the baseline needs at least.
+baseline_runs = 10
+baseline_min_runs = 3
+
+# A run departs from its baseline if the robust z-score of its throughput
+# or duration, i.e. its distance from the median of the baseline in units
+# of the scaled median absolute deviation, exceeds this value, and if it
+# differs from that median by at least the given fraction. The latter keeps
+# very steady series from being flagged for small changes.
+departure_score = 3.5
+departure_min_change = 0.25
+
+# The fields which tell the series a run belongs to.
+series_fields = ['host', 'strategy', 'destination']
+
+
+
+# Appends a run to the history file.
+def append_run (historyFile, run):
+    directory = os.path.dirname (historyFile)
+    if (directory):
+        os.makedirs (directory, exist_ok = True)
+    with open (historyFile, 'a', encoding = 'UTF-8') as f:
+        f.write (json.dumps (run, sort_keys = True) + '\n')
+
+
+
+# Returns the runs of the history file that match all given fields, oldest
+# first. Lines which cannot be parsed are skipped.
+def read_runs (historyFile, **fields):
+    runs = []
+    try:
+        with open (historyFile, 'r', encoding = 'UTF-8') as f:
+            for line in f:
+                try:
+                    run = json.loads (line)
+                except ValueError:
+                    continue
+                if (isinstance (run, dict) and all ([run.get (k) == v for k, v in fields.items()])):
+                    runs.append (run)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        write_log ('The history file \'{0}\' cannot be read: {1}'.format (historyFile, e), LogLevel.WARNING)
+    return runs
+
+
+
+# Predicts how many seconds it takes to copy 'bytes' from the throughput
+# of the most recent runs. Returns None if there is no usable run.
+def predict_duration (runs, bytes):
+    throughputs = [r['bytes'] / r['seconds'] for r in runs[-prediction_runs:] if r.get ('seconds', 0) > 0 and r.get ('bytes', 0) > 0]
+    if (not throughputs):
+        return None
+    return bytes / statistics.median (throughputs)
+
+
+
+def _throughput (run):
+    if (run.get ('seconds', 0) > 0 and run.get ('bytes', 0) > 0):
+        return run['bytes'] / run['seconds']
+    return None
+
+
+
+def _duration (run):
+    return run.get ('seconds')
+
+
+
+_metrics = {'throughput': _throughput, 'duration': _duration}
+
+
+
+# Returns how far the run departs from the runs before it, as a dictionary
+# that maps 'throughput' and 'duration' to the robust z-score of the run,
+# for those metrics which depart significantly. The score is negative if
+# the value of the run is below the baseline. 'previousRuns' are the runs
+# of the same series, oldest first.
+def departures (previousRuns, run):
+    res = {}
+    for metric, value_of in _metrics.items():
+        value = value_of (run)
+        baseline = [v for v in [value_of (r) for r in previousRuns[-baseline_runs:]] if v is not None]
+        if (value is None or len (baseline) < baseline_min_runs):
+            continue
+        median = statistics.median (baseline)
+        deviation = 1.4826 * statistics.median ([abs (v - median) for v in baseline])
+        if (median <= 0 or abs (value - median) < departure_min_change * median):
+            continue
+        # Without any deviation in the baseline, every change that is big
+        # enough departs from it.
+        score = (value - median) / deviation if deviation > 0 else float ('inf') if value > median else float ('-inf')
+        if (abs (score) > departure_score):
+            res[metric] = score
+    return res
+
+
+
+# Returns the key of the series of a run.
+def series_of (run):
+    return tuple ([run.get (f) for f in series_fields])
+
+
+
+# Groups the runs by their series, keeping the order of the runs.
+def group_runs (runs):
+    groups = {}
+    for run in runs:
+        groups.setdefault (series_of (run), []).append (run)
+    return groups
+
+
+
+# Describes the departures of a run in words, e.g. for the log.
+def describe_departures (run, scores):
+    words = []
+    for metric, score in sorted (scores.items()):
+        words.append ('{0} {1}'.format (metric, 'dropped' if score < 0 else 'rose'))
+    return 'The backup of host \'{0}\' started {1} departs from the previous runs: {2}.'.format (run.get ('host'), run.get ('started'), ', '.join (words))
+
+
+
+# Returns the trend of a series of runs as a dictionary with the number of
+# runs, the last run, the median duration and throughput of the recent
+# runs, the change of the median throughput of the recent runs against
+# the runs before them, and the runs which departed from their baselines.
+def trend (runs):
+    recent = runs[-baseline_runs:]
+    earlier = runs[-2 * baseline_runs:-baseline_runs]
+    throughputs = [t for t in [_throughput (r) for r in recent] if t is not None]
+    earlierThroughputs = [t for t in [_throughput (r) for r in earlier] if t is not None]
+    change = None
+    if (throughputs and earlierThroughputs and statistics.median (earlierThroughputs) > 0):
+        change = statistics.median (throughputs) / statistics.median (earlierThroughputs) - 1
+    flagged = []
+    for i, run in enumerate (runs):
+        scores = departures (runs[:i], run)
+        if (scores):
+            flagged.append ((run, scores))
+    durations = [d for d in [_duration (r) for r in recent] if d is not None]
+    return {
+        'runs': len (runs),
+        'last': runs[-1],
+        'duration': statistics.median (durations) if durations else None,
+        'throughput': statistics.median (throughputs) if throughputs else None,
+        'change': change,
+        'departures': flagged
+    }
+
+
+
+def _format_bytes (value):
+    if (value is None):
+        return '-'
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if (value < 1024):
+            return '{0:.1f} {1}'.format (value, unit)
+        value /= 1024
+    return '{0:.1f} TiB'.format (value)
+
+
+
+# Returns the trends of the series of runs as text, one block per series.
+def format_stats (runs, *, departuresShown = 5):
+    lines = []
+    for key, series in sorted (group_runs (runs).items(), key = lambda g: [str (k) for k in g[0]]):
+        t = trend (series)
+        lines.append ('{0} (strategy {1}) to {2}:'.format (*key))
+        lines.append ('  {0} runs, the last one started {1}'.format (t['runs'], t['last'].get ('started', '-')))
+        lines.append ('  median of the last {0} runs: {1} in {2}, {3}/s'.format (min (t['runs'], baseline_runs),
+            _format_bytes (statistics.median ([r.get ('bytes', 0) for r in series[-baseline_runs:]])),
+            '-' if t['duration'] is None else datetime.timedelta (seconds = round (t['duration'])), _format_bytes (t['throughput'])))
+        if (t['change'] is not None):
+            lines.append ('  throughput {0:+.0%} against the {1} runs before'.format (t['change'], baseline_runs))
+        for run, scores in t['departures'][-departuresShown:]:
+            lines.append ('  departed: {0} {1}'.format (run.get ('started', '-'), ', '.join (['{0} {1:+.1f}'.format (m, s) for m, s in sorted (scores.items())])))
+    return '\n'.join (lines)
+
+
+
+def _escape_label (value):
+    return str (value).replace ('\\', '\\\\').replace ('"', '\\"').replace ('\n', '\\n')
+
+
+
+def _labels (**labels):
+    return '{' + ','.join (['{0}="{1}"'.format (k, _escape_label (v)) for k, v in labels.items()]) + '}'
+
+
+
+def _timestamp (run):
+    try:
+        return datetime.datetime.fromisoformat (run['started']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+
+# Returns the last run of each series as metrics in the OpenMetrics text
+# format, together with the number of runs and whether the last run
+# departed from its baseline.
+def format_openmetrics (runs):
+    gauges = [
+        ('btrcp_last_run_timestamp_seconds', 'seconds', 'Start of the last backup run.', _timestamp),
+        ('btrcp_last_run_duration_seconds', 'seconds', 'Duration of the last backup run.', _duration),
+        ('btrcp_last_run_copied_bytes', 'bytes', 'Amount of data copied by the last backup run.', lambda r: r.get ('bytes')),
+        ('btrcp_last_run_copied_files', '', 'Number of files copied by the last backup run.', lambda r: r.get ('files')),
+        ('btrcp_last_run_throughput_bytes_per_second', '', 'Bytes copied per second by the last backup run.', _throughput),
+        ('btrcp_last_run_commands', '', 'Number of commands run by the last backup run.', lambda r: r.get ('commands'))
+    ]
+    groups = sorted (group_runs (runs).items(), key = lambda g: [str (k) for k in g[0]])
+    lines = []
+    for name, unit, help, value_of in gauges:
+        lines.append ('# TYPE {0} gauge'.format (name))
+        if (unit):
+            lines.append ('# UNIT {0} {1}'.format (name, unit))
+        lines.append ('# HELP {0} {1}'.format (name, help))
+        for key, series in groups:
+            value = value_of (series[-1])
+            if (value is not None):
+                lines.append ('{0}{1} {2}'.format (name, _labels (**dict (zip (series_fields, key))), value))
+
+    lines.append ('# TYPE btrcp_last_run_phase_seconds gauge')
+    lines.append ('# UNIT btrcp_last_run_phase_seconds seconds')
+    lines.append ('# HELP btrcp_last_run_phase_seconds Time spent in each phase of the last backup run.')
+    for key, series in groups:
+        for phase, seconds in sorted (series[-1].get ('phases', {}).items()):
+            lines.append ('btrcp_last_run_phase_seconds{0} {1}'.format (_labels (**dict (zip (series_fields, key)), phase = phase), seconds))
+
+    lines.append ('# TYPE btrcp_last_run_departure gauge')
+    lines.append ('# HELP btrcp_last_run_departure 1 if the metric of the last backup run departs from the runs before it.')
+    for key, series in groups:
+        scores = departures (series[:-1], series[-1])
+        for metric in _metrics:
+            lines.append ('btrcp_last_run_departure{0} {1}'.format (_labels (**dict (zip (series_fields, key)), metric = metric), 1 if metric in scores else 0))
+
+    lines.append ('# TYPE btrcp_recorded_runs gauge')
+    lines.append ('# HELP btrcp_recorded_runs Number of completed backup runs in the history.')
+    for key, series in groups:
+        lines.append ('btrcp_recorded_runs{0} {1}'.format (_labels (**dict (zip (series_fields, key))), len (series)))
+    lines.append ('# EOF')
+    return '\n'.join (lines) + '\n'
+
+
+
+# Writes the metrics of the runs to a file. The file is replaced at once,
+# so that a collector never reads it half written.
+def write_openmetrics (metricsFile, runs):
+    with runcmdutils.atomic_write (metricsFile, makeDirs = True) as f:
+        f.write (format_openmetrics (runs))
+
+
+
+def init_arg_parser():
+    parser = argparse.ArgumentParser(prog='btrcp-stats', description='Shows the trends of the backup runs recorded by btrcp, and writes them as metrics.')
+    parser.add_argument ('command', metavar = 'COMMAND', choices = ['stats', 'metrics'], help = '\'stats\' shows the trends of the runs of each host, \'metrics\' writes the last runs in the OpenMetrics text format.')
+    parser.add_argument ('--history', dest = 'history_file', required = False, metavar = 'FILE', default = default_history_file, help = 'sets the file the runs have been recorded in. Default is {0}.'.format (default_history_file.replace ('%', '%%')))
+    parser.add_argument ('--hostname', dest = 'host_name', required = False, metavar = 'NAME', default = None, help = 'only shows the runs of this host.')
+    parser.add_argument ('--output', '-o', dest = 'output_file', required = False, metavar = 'FILE', default = None, help = 'writes the metrics to FILE instead of the standard output, e.g. into the directory of the textfile collector of node_exporter.')
+    parser.add_argument ('--version', action = 'version', version = '%(prog)s {0}'.format (script_version))
+    return parser
+
+
+
+def parse_args(*args):
+    parser = init_arg_parser()
+    return parser.parse_args(*args)
+
+
+
+def main(*args):
+    args = parse_args (*args)
+    runs = read_runs (args.history_file, **({'host': args.host_name} if args.host_name else {}))
+    if (args.command == 'metrics'):
+        if (args.output_file):
+            write_openmetrics (args.output_file, runs)
+        else:
+            sys.stdout.write (format_openmetrics (runs))
+        return 0
+    if (not runs):
+        write_log ('There are no runs in the history file \'{0}\'.'.format (args.history_file), LogLevel.WARNING)
+        return 1
+    print (format_stats (runs))
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
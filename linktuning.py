@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+
+# This module tunes rsync and ssh to the link between this machine and a
+# remote destination. It measures the round trip time and the throughput
+# over the ssh machine of the destination, and derives from that
+#
+# * whether rsync compresses the data, with which algorithm and level,
+# * whether rsync copies whole files or only the changed blocks, and
+# * the cipher ssh uses.
+#
+# Slow links (WAN) are bound by bandwidth, so compression and the delta
+# transfer pay off. Fast links (LAN) are bound by CPU, so both are turned
+# off and ssh uses a cipher with hardware support.
+#
+# The measurements are cached per destination host in a JSON file, and
+# repeated once they are older than a number of days.
+
+
+
+import datetime
+import json
+import os
+import time
+import runcmdutils
+from runcmdutils import write_log, LogLevel, run_cmd, mk_cmd, exec_cmd
+
+
+
+# The cache file used if none is given.
+default_cache_file = os.path.join (runcmdutils.state_dir(), 'link-tuning.json')
+
+# The number of days after which a link is measured again.
+default_max_age_days = 7
+
+# The amount of data sent to measure the throughput of a link.
+sample_size = 16 * 1048576
+
+# Links that are at least this fast (in bytes per second), with a round
+# trip time of at most lan_rtt seconds, are treated as LAN.
+lan_throughput = 50 * 1048576
+lan_rtt = 0.005
+
+# Links that are slower than this (in bytes per second) compress harder.
+slow_throughput = 5 * 1048576
+
+# The cipher ssh uses on LAN links; AES-GCM is accelerated by most CPUs.
+lan_cipher = 'aes128-gcm@openssh.com'
+
+# The round trip time is the minimum of this many round trips.
+rtt_samples = 5
+
+
+
+# The measured properties of a link and the options chosen for it.
+class LinkProfile:
+    def __init__ (self, rtt, throughput, measured, rsyncOptions):
+        self.rtt = rtt
+        self.throughput = throughput
+        self.measured = measured
+        self.rsyncOptions = rsyncOptions
+
+    def to_dict (self):
+        return {'rtt': self.rtt, 'throughput': self.throughput, 'measured': self.measured.isoformat (timespec = 'seconds'), 'rsyncOptions': self.rsyncOptions}
+
+    @staticmethod
+    def from_dict (d):
+        return LinkProfile (float (d['rtt']), float (d['throughput']), datetime.datetime.fromisoformat (d['measured']), list (d['rsyncOptions']))
+
+
+
+# Measures the round trip time of the machine in seconds, through a shell
+# session that is kept open, so the time to connect is not counted.
+def measure_rtt (machine):
+    with machine.session() as session:
+        session.run ('true')
+        rtts = []
+        for _ in range (rtt_samples):
+            start = time.monotonic()
+            session.run ('true')
+            rtts.append (time.monotonic() - start)
+    return min (rtts)
+
+
+
+# Measures the throughput to the machine in bytes per second, by sending
+# incompressible data to it. The time to connect is measured separately
+# and not counted.
+def measure_throughput (machine):
+    start = time.monotonic()
+    exec_cmd (mk_cmd (['true'], machine = machine))
+    connectTime = time.monotonic() - start
+
+    data = os.urandom (sample_size)
+    start = time.monotonic()
+    proc = mk_cmd (['dd', 'of=/dev/null', 'bs=1M', 'status=none'], machine = machine).popen()
+    proc.communicate (data)
+    elapsed = time.monotonic() - start - connectTime
+    if (proc.returncode != 0):
+        return None
+    return sample_size / max (elapsed, 0.001)
+
+
+
+# Returns the compression algorithms an rsync supports, or an empty list
+# if it is too old to tell (before 3.2).
+def _rsync_compress_choices (machine = None):
+    res = run_cmd (['rsync', '--version'], machine = machine)
+    lines = res.stdout.splitlines()
+    for i, line in enumerate (lines):
+        if (line.strip().lower().startswith ('compress list') and i + 1 < len (lines)):
+            return lines[i + 1].split()
+    return []
+
+
+
+# Returns True if ssh can connect to the machine with the given cipher.
+# The probe is run by the ssh command of the machine, so it uses the same
+# user, port and options, e.g. the known hosts file.
+def _ssh_supports_cipher (machine, cipher):
+    # This probe changes nothing, so it runs even while a backup is planned.
+    proc = machine.popen (['true'], ssh_opts = ['-o', 'BatchMode=yes', '-c', cipher])
+    proc.communicate()
+    return proc.returncode == 0
+
+
+
+# Chooses the rsync options for a link with the given round trip time and
+# throughput. 'compressChoices' are the algorithms both rsyncs support.
+def choose_rsync_options (rtt, throughput, compressChoices, *, cipher = None):
+    if (throughput >= lan_throughput and rtt <= lan_rtt):
+        options = ['--whole-file']
+        if (cipher):
+            options.extend (['-e', 'ssh -c {0}'.format (cipher)])
+        return options
+
+    options = ['--no-whole-file', '--compress']
+    level = 3 if throughput < slow_throughput else 1
+    if ('zstd' in compressChoices):
+        options.extend (['--compress-choice=zstd', '--compress-level={0}'.format (level)])
+    elif ('lz4' in compressChoices and throughput >= slow_throughput):
+        options.append ('--compress-choice=lz4')
+    else:
+        options.append ('--compress-level={0}'.format (level))
+    return options
+
+
+
+# Measures the link to the machine of a remote path and returns its
+# profile. 'host' names the destination in the log.
+def measure_link (host, machine):
+    rtt = measure_rtt (machine)
+    throughput = measure_throughput (machine)
+    if (throughput is None):
+        return None
+    localChoices = _rsync_compress_choices()
+    remoteChoices = _rsync_compress_choices (machine)
+    compressChoices = [c for c in localChoices if c in remoteChoices]
+    cipher = lan_cipher if (throughput >= lan_throughput and rtt <= lan_rtt and _ssh_supports_cipher (machine, lan_cipher)) else None
+    options = choose_rsync_options (rtt, throughput, compressChoices, cipher = cipher)
+    write_log ('The link to {0} has a round trip time of {1:.1f} ms and a throughput of {2:.1f} MiB/s, rsync uses the options {3}.'.format (host, rtt * 1000, throughput / 1048576, ' '.join (options)))
+    return LinkProfile (rtt, throughput, datetime.datetime.now(), options)
+
+
+
+# Reads the cached link profiles. Returns an empty dictionary if there is
+# no cache or it cannot be read.
+def _read_cache (cacheFile):
+    try:
+        with open (cacheFile, 'r', encoding = 'UTF-8') as f:
+            return {host: LinkProfile.from_dict (d) for host, d in json.load (f).items()}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        write_log ('The link tuning cache \'{0}\' cannot be read: {1}'.format (cacheFile, e), LogLevel.WARNING)
+        return {}
+
+
+
+def _write_cache (cacheFile, profiles):
+    with runcmdutils.atomic_write (cacheFile, makeDirs = True) as f:
+        json.dump ({host: p.to_dict() for host, p in profiles.items()}, f, indent = 1, sort_keys = True)
+
+
+
+# Returns the rsync options for the link to a remote host. The link is
+# measured if the cache has no profile of it, or the profile is older than
+# 'maxAgeDays'. Returns an empty list if the link cannot be measured.
+def rsync_options (host, machine, *, cacheFile = default_cache_file, maxAgeDays = default_max_age_days):
+    profiles = _read_cache (cacheFile)
+    profile = profiles.get (host)
+    if (profile is not None and datetime.datetime.now() - profile.measured <= datetime.timedelta (days = maxAgeDays)):
+        return profile.rsyncOptions
+
+    try:
+        profile = measure_link (host, machine)
+    except Exception as e:
+        write_log ('Measuring the link to {0} failed: {1}'.format (host, e), LogLevel.WARNING)
+        profile = None
+    if (profile is None):
+        return []
+
+    profiles[host] = profile
+    try:
+        _write_cache (cacheFile, profiles)
+    except OSError as e:
+        write_log ('The link tuning cache \'{0}\' cannot be written: {1}'.format (cacheFile, e), LogLevel.WARNING)
+    return profile.rsyncOptions
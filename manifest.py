@@ -0,0 +1,440 @@
+#!/usr/bin/python3
+
+# This module writes manifests of backups and verifies backups against
+# them. A manifest lists each file of a backup with its size, mtime and
+# a fast hash of its contents. It is a text file with a header line
+#
+#   btrcp-manifest 1 <algorithm>
+#
+# followed by one line per file
+#
+#   <hash> <size> <mtime in ns> <path>
+#
+# where the path is relative to the root of the backup, and backslashes
+# and line breaks in it are escaped. Symbolic links are listed with the
+# hash of their target.
+#
+# Manifests are kept next to the backup they describe, i.e. the manifest
+# of the snapshot 'host/2022-01-01-12-00' is 'host/2022-01-01-12-00.manifest'
+# and the manifest of the archive 'host/2022-01-01-12-00.tar.gz' is
+# 'host/2022-01-01-12-00.tar.gz.manifest'.
+
+
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import hashlib
+import os
+import random
+import stat
+import sys
+import tarfile
+import runcmdutils
+from runcmdutils import write_log, LogLevel
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+
+# This is the version of the script.
+script_version='1.0.0'
+
+# The magic string and format version at the beginning of each manifest.
+_manifestMagic = 'btrcp-manifest'
+_manifestVersion = '1'
+
+# The suffix of manifest files.
+manifest_suffix = '.manifest'
+
+# The suffix of the file which records the files that have been verified
+# by the last run of verify().
+_verifiedSuffix = '.verified'
+
+# The size of the blocks files are read in when hashing them.
+_blockSize = 1024 * 1024
+
+# The number of files that are handed to a worker process at once. Small
+# files are cheap to hash, so sending them one at a time would make the
+# process pool spend most of its time on communication.
+_batchSize = 64
+
+
+
+# Is raised if a manifest cannot be read or uses an unknown hash algorithm.
+class ManifestError(Exception):
+    pass
+
+
+
+# Returns the name of the fastest hash algorithm that is available. xxh3 is
+# used if the xxhash module has been installed, BLAKE2 otherwise.
+def default_algorithm():
+    return 'xxh3_128' if xxhash is not None else 'blake2b'
+
+
+
+# Creates a new hash object of the given algorithm.
+def _mk_hasher (algorithm):
+    if (algorithm == 'xxh3_128'):
+        if (xxhash is None):
+            raise ManifestError ('The manifest uses xxh3, please install the Python module xxhash.')
+        return xxhash.xxh3_128()
+    if (algorithm == 'blake2b'):
+        return hashlib.blake2b (digest_size = 16)
+    raise ManifestError ('Unknown hash algorithm \'{0}\'.'.format (algorithm))
+
+
+
+# Hashes the contents of a file-like object.
+def hash_stream (stream, algorithm):
+    hasher = _mk_hasher (algorithm)
+    block = stream.read (_blockSize)
+    while (block):
+        hasher.update (block)
+        block = stream.read (_blockSize)
+    return hasher.hexdigest()
+
+
+
+# Hashes a file, or the target of a symbolic link.
+def hash_file (path, algorithm):
+    if (os.path.islink (path)):
+        hasher = _mk_hasher (algorithm)
+        hasher.update (os.fsencode (os.readlink (path)))
+        return hasher.hexdigest()
+    with open (path, 'rb') as f:
+        return hash_stream (f, algorithm)
+
+
+
+# Hashes a batch of files in a worker process. Returns a list of tuples of
+# the path and its hash, where the hash is None if the file could not be read.
+def _hash_batch (batch):
+    root, paths, algorithm = batch
+    res = []
+    for p in paths:
+        try:
+            res.append ((p, hash_file (os.path.join (root, p), algorithm)))
+        except OSError:
+            res.append ((p, None))
+    return res
+
+
+
+# Hashes the files (given relative to root) in a pool of worker processes.
+# Returns a dictionary that maps each path to its hash.
+def hash_files (root, paths, algorithm, *, workers = None):
+    batches = [(root, paths[i : i + _batchSize], algorithm) for i in range (0, len (paths), _batchSize)]
+    hashes = {}
+    if (len (batches) <= 1 or workers == 1):
+        for batch in batches:
+            hashes.update (_hash_batch (batch))
+        return hashes
+    with ProcessPoolExecutor (max_workers = workers) as executor:
+        for res in executor.map (_hash_batch, batches):
+            hashes.update (res)
+    return hashes
+
+
+
+# Walks the directory tree and returns a dictionary which maps the path of
+# each file (relative to root) to the stat result of that file. Only files
+# and symbolic links are listed, as directories have no contents to hash.
+def scan_tree (root):
+    res = {}
+    for dirPath, dirNames, fileNames in os.walk (root):
+        for name in fileNames + [d for d in dirNames if os.path.islink (os.path.join (dirPath, d))]:
+            path = os.path.join (dirPath, name)
+            try:
+                st = os.lstat (path)
+            except OSError:
+                continue
+            if (stat.S_ISREG (st.st_mode) or stat.S_ISLNK (st.st_mode)):
+                res[os.path.relpath (path, root)] = st
+    return res
+
+
+
+def _escape (path):
+    return path.replace ('\\', '\\\\').replace ('\n', '\\n')
+
+
+
+def _unescape (path):
+    res = []
+    i = 0
+    while (i < len (path)):
+        c = path[i]
+        if (c == '\\' and i + 1 < len (path)):
+            i += 1
+            c = '\n' if path[i] == 'n' else path[i]
+        res.append (c)
+        i += 1
+    return ''.join (res)
+
+
+
+# An entry of a manifest.
+class ManifestEntry:
+    __slots__ = ['hash', 'size', 'mtime']
+
+    def __init__ (self, hash, size, mtime):
+        self.hash = hash
+        self.size = size
+        self.mtime = mtime
+
+
+
+# Writes a manifest. 'entries' is a dictionary that maps paths to instances
+# of ManifestEntry. The manifest is written to a temporary file first, so
+# that a manifest is never incomplete.
+def write_manifest (manifestFile, entries, algorithm):
+    with runcmdutils.atomic_write (manifestFile, errors = 'surrogateescape') as f:
+        f.write ('{0} {1} {2}\n'.format (_manifestMagic, _manifestVersion, algorithm))
+        for path in sorted (entries):
+            e = entries[path]
+            f.write ('{0} {1} {2} {3}\n'.format (e.hash, e.size, e.mtime, _escape (path)))
+
+
+
+# Reads a manifest. Returns a tuple of the hash algorithm and a dictionary
+# that maps paths to instances of ManifestEntry.
+def read_manifest (manifestFile):
+    entries = {}
+    with open (manifestFile, 'r', encoding = 'UTF-8', errors = 'surrogateescape') as f:
+        header = f.readline().split()
+        if (len (header) != 3 or header[0] != _manifestMagic or header[1] != _manifestVersion):
+            raise ManifestError ('\'{0}\' is not a manifest.'.format (manifestFile))
+        for line in f:
+            hash, size, mtime, path = line.rstrip ('\n').split (' ', 3)
+            entries[_unescape (path)] = ManifestEntry (hash, int (size), int (mtime))
+    return (header[2], entries)
+
+
+
+# Returns the name of the manifest of a backup, which is either a snapshot
+# directory or an archive.
+def manifest_file_of (backupPath):
+    return backupPath.rstrip (os.sep) + manifest_suffix
+
+
+
+# Creates the manifest of a backup directory. If the manifest of a previous
+# backup is given, the hashes of all files whose size and mtime have not
+# changed are taken from there, so only new and modified files are read.
+def create_manifest (backupDir, manifestFile, *, previousManifest = None, workers = None):
+    algorithm = default_algorithm()
+    previous = {}
+    if (previousManifest and os.path.isfile (previousManifest)):
+        try:
+            previousAlgorithm, previous = read_manifest (previousManifest)
+            if (previousAlgorithm != algorithm):
+                previous = {}
+        except (OSError, ValueError, ManifestError) as e:
+            write_log ('The previous manifest \'{0}\' cannot be used: {1}'.format (previousManifest, e), LogLevel.WARNING)
+
+    files = scan_tree (backupDir)
+    entries = {}
+    toHash = []
+    for path, st in files.items():
+        prev = previous.get (path)
+        if (prev is not None and prev.size == st.st_size and prev.mtime == st.st_mtime_ns):
+            entries[path] = prev
+        else:
+            toHash.append (path)
+
+    write_log ('Hashing {0} of {1} files for the manifest \'{2}\'.'.format (len (toHash), len (files), manifestFile))
+    for path, hash in hash_files (backupDir, toHash, algorithm, workers = workers).items():
+        if (hash is None):
+            write_log ('The file \'{0}\' cannot be read and is left out of the manifest.'.format (path), LogLevel.WARNING)
+            continue
+        st = files[path]
+        entries[path] = ManifestEntry (hash, st.st_size, st.st_mtime_ns)
+
+    write_manifest (manifestFile, entries, algorithm)
+    return entries
+
+
+
+# Creates the manifest of a tar archive by streaming through it once.
+def create_archive_manifest (archiveFile, manifestFile):
+    algorithm = default_algorithm()
+    entries = {}
+    # The archive is decompressed by the gzip module, because the stream
+    # mode of the tarfile module cannot read archives which consist of
+    # several gzip members, such as seekable archives.
+    with gzip.open (archiveFile, 'rb') as f, tarfile.open (fileobj = f, mode = 'r|') as tar:
+        for member in tar:
+            entries[member.name] = _hash_member (tar, member, algorithm)
+    entries = dict ([(p, e) for p, e in entries.items() if e is not None])
+    write_manifest (manifestFile, entries, algorithm)
+    return entries
+
+
+
+# Hashes a member of a tar archive. Returns None for members that have no
+# contents, such as directories.
+def _hash_member (tar, member, algorithm):
+    if (member.issym()):
+        hasher = _mk_hasher (algorithm)
+        hasher.update (os.fsencode (member.linkname))
+        hash = hasher.hexdigest()
+    elif (member.isfile()):
+        hash = hash_stream (tar.extractfile (member), algorithm)
+    else:
+        return None
+    return ManifestEntry (hash, member.size, int (member.mtime) * 1000000000)
+
+
+
+# Reads the record of the last verification, which maps paths to the
+# (size, mtime, ctime) of the files when they were last verified.
+def _read_verified (verifiedFile):
+    res = {}
+    try:
+        with open (verifiedFile, 'r', encoding = 'UTF-8', errors = 'surrogateescape') as f:
+            for line in f:
+                size, mtime, ctime, path = line.rstrip ('\n').split (' ', 3)
+                res[_unescape (path)] = (int (size), int (mtime), int (ctime))
+    except (OSError, ValueError):
+        pass
+    return res
+
+
+
+def _write_verified (verifiedFile, verified):
+    with runcmdutils.atomic_write (verifiedFile, errors = 'surrogateescape') as f:
+        for path in sorted (verified):
+            f.write ('{0} {1} {2} {3}\n'.format (*verified[path], _escape (path)))
+
+
+
+# Verifies a backup directory against its manifest. Returns a list of
+# problems found, each one being a tuple of the path and a description.
+# If 'sample' is given, only that fraction of the files is hashed. If
+# 'incremental' is set, only files whose size, mtime or ctime changed
+# since the last successful verification are hashed again.
+def verify_backup (backupDir, manifestFile, *, sample = None, incremental = False, workers = None):
+    algorithm, entries = read_manifest (manifestFile)
+    verifiedFile = manifestFile + _verifiedSuffix
+    lastVerified = _read_verified (verifiedFile) if incremental else {}
+    problems = []
+    stats = {}
+    toHash = []
+
+    for path, entry in entries.items():
+        try:
+            st = os.lstat (os.path.join (backupDir, path))
+        except OSError:
+            problems.append ((path, 'missing'))
+            continue
+        if (st.st_size != entry.size):
+            problems.append ((path, 'size {0} instead of {1}'.format (st.st_size, entry.size)))
+            continue
+        stats[path] = (st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+        if (lastVerified.get (path) != stats[path]):
+            toHash.append (path)
+
+    if (sample is not None and sample < 1.0):
+        toHash = random.sample (toHash, int (len (toHash) * sample))
+    write_log ('Hashing {0} of {1} files listed in the manifest \'{2}\'.'.format (len (toHash), len (entries), manifestFile))
+
+    hashes = hash_files (backupDir, toHash, algorithm, workers = workers)
+    verified = dict ([(p, s) for p, s in lastVerified.items() if p in stats and stats[p] == s])
+    for path, hash in hashes.items():
+        if (hash is None):
+            problems.append ((path, 'unreadable'))
+        elif (hash != entries[path].hash):
+            problems.append ((path, 'contents differ'))
+        else:
+            verified[path] = stats[path]
+
+    _write_verified (verifiedFile, verified)
+    return problems
+
+
+
+# Verifies a tar archive against its manifest. Archives can only be read
+# sequentially, so this always reads the whole archive.
+def verify_archive (archiveFile, manifestFile):
+    algorithm, entries = read_manifest (manifestFile)
+    problems = []
+    seen = set()
+    with gzip.open (archiveFile, 'rb') as f, tarfile.open (fileobj = f, mode = 'r|') as tar:
+        for member in tar:
+            expected = entries.get (member.name)
+            if (expected is None):
+                continue
+            seen.add (member.name)
+            actual = _hash_member (tar, member, algorithm)
+            if (actual is None or actual.hash != expected.hash or actual.size != expected.size):
+                problems.append ((member.name, 'contents differ'))
+    problems.extend ([(p, 'missing') for p in entries if p not in seen])
+    return problems
+
+
+
+# Verifies a backup, which is either a directory or an archive.
+def verify (backupPath, *, manifestFile = None, sample = None, incremental = False, workers = None):
+    if (manifestFile is None):
+        manifestFile = manifest_file_of (backupPath)
+    if (os.path.isdir (backupPath)):
+        problems = verify_backup (backupPath, manifestFile, sample = sample, incremental = incremental, workers = workers)
+    else:
+        problems = verify_archive (backupPath, manifestFile)
+    for path, problem in problems:
+        write_log ('Verification of \'{0}\' failed for \'{1}\': {2}'.format (backupPath, path, problem), LogLevel.ERROR)
+    if (not problems):
+        write_log ('The backup \'{0}\' matches its manifest.'.format (backupPath))
+    return problems
+
+
+
+def init_arg_parser():
+    parser = argparse.ArgumentParser(prog='btrcp-verify', description='Creates manifests of backups and verifies backups against them.')
+    parser.add_argument ('backup_path', metavar='PATH', help='Specifies the backup to verify, which is either a snapshot directory or an archive.')
+    parser.add_argument ('--manifest', '-m', dest = 'manifest_file', required = False, metavar='FILE', default = None, help='Specifies the manifest. By default the manifest is expected next to the backup.')
+    parser.add_argument ('--create', dest = 'create_manifest', required = False, action = 'store_const', const = True, help = 'creates the manifest of the backup instead of verifying it.')
+    parser.set_defaults (create_manifest = False)
+    parser.add_argument ('--sample', dest = 'sample', required = False, type = float, metavar = 'FRACTION', default = None, help = 'only hashes a random sample of the given fraction of the files.')
+    parser.add_argument ('--incremental', dest = 'incremental', required = False, action = 'store_const', const = True, help = 'only hashes files which changed since the last verification.')
+    parser.set_defaults (incremental = False)
+    parser.add_argument ('--workers', dest = 'workers', required = False, type = int, metavar = 'NUM', default = None, help = 'sets the number of worker processes used for hashing. Default is the number of CPUs.')
+    parser.add_argument ('--log-file', dest = 'log_file_name', required = False, metavar = 'FILENAME', help = 'Specifies the name of a log file.')
+    parser.add_argument ('--quiet', dest = 'silent_mode', required = False, action = 'store_const', const = True, help = 'Suppresses all console output of this script.')
+    parser.set_defaults (silent_mode = False)
+    parser.add_argument ('--version', action = 'version', version = '%(prog)s {0}'.format (script_version))
+    return parser
+
+
+
+def parse_args(*args):
+    parser = init_arg_parser()
+    return parser.parse_args(*args)
+
+
+
+def main(*args):
+    args = parse_args (*args)
+    if (args.silent_mode):
+        runcmdutils.remove_console_log_handler()
+    if (args.log_file_name):
+        runcmdutils.add_log_file_handler (args.log_file_name)
+    manifestFile = args.manifest_file or manifest_file_of (args.backup_path)
+    if (args.create_manifest):
+        if (os.path.isdir (args.backup_path)):
+            create_manifest (args.backup_path, manifestFile, workers = args.workers)
+        else:
+            create_archive_manifest (args.backup_path, manifestFile)
+        return 0
+    problems = verify (args.backup_path, manifestFile = manifestFile, sample = args.sample, incremental = args.incremental, workers = args.workers)
+    return 1 if problems else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
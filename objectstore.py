@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+
+# This module writes backups to S3-compatible object stores, like Amazon S3
+# or a local MinIO server. A destination is given as a URL
+#
+#   s3://<bucket>/<prefix>
+#
+# and the backups of each host are kept below '<prefix>/<host>/', with the
+# same names as in a host directory, e.g. '2022-01-01-12-00.tar.gz' and its
+# index '2022-01-01-12-00.tar.gz.idx', or the shards of a set below
+# '2022-01-01-12-00.shards/'. The endpoint of stores other than Amazon S3
+# is given separately, e.g. http://localhost:9000 for MinIO; credentials
+# are taken from the usual places of boto3, e.g. the environment variables
+# AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY.
+#
+# Archives are streamed into multipart uploads without a local staging
+# file. The stream is cut into parts of equal size, which are uploaded by a
+# pool of threads while the next parts are read. An upload only becomes
+# visible as an object once it has been completed; an interrupted upload
+# keeps its parts. When the upload is started again with the same data,
+# the parts that have already been uploaded are recognized by their MD5
+# hash and are not sent again.
+#
+# The Python module boto3 must be installed.
+
+
+
+import fnmatch
+import hashlib
+import collections
+import concurrent.futures
+from urllib.parse import urlparse
+from runcmdutils import write_log, LogLevel
+
+try:
+    import boto3
+    import botocore.config
+    import botocore.exceptions
+except ImportError:
+    boto3 = None
+
+
+
+# The size of the parts of multipart uploads. S3 needs at least 5 MiB for
+# all parts but the last, and allows 10000 parts, so the default allows
+# archives of up to 625 GiB.
+default_part_size = 64 * 1024 * 1024
+min_part_size = 5 * 1024 * 1024
+max_parts = 10000
+
+# The number of parts that are uploaded concurrently.
+default_workers = 4
+
+# The number of times a request is attempted before it fails.
+_maxAttempts = 8
+
+
+
+# Is raised if the object store cannot be used.
+class ObjectStoreError(Exception):
+    pass
+
+
+
+# The exceptions a request to the object store may raise.
+if (boto3 is not None):
+    errors = (ObjectStoreError, botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError)
+else:
+    errors = (ObjectStoreError,)
+
+
+
+# Returns True if the destination is the URL of an object store.
+def is_object_store_url (url):
+    return str (url).startswith ('s3://')
+
+
+
+# Returns the bucket and the prefix of an object store URL. The prefix is
+# empty or ends with '/'.
+def parse_url (url):
+    parts = urlparse (url)
+    if (parts.scheme != 's3' or not parts.netloc):
+        raise ObjectStoreError ('\'{0}\' is not a URL of the form s3://BUCKET/PREFIX.'.format (url))
+    prefix = parts.path.strip ('/')
+    return (parts.netloc, prefix + '/' if prefix else '')
+
+
+
+def _make_client (endpoint, workers):
+    if (boto3 is None):
+        raise ObjectStoreError ('Object store destinations need the Python module boto3, please install it.')
+    # Failed requests, e.g. of single parts, are retried with backoff.
+    config = botocore.config.Config (retries = {'max_attempts': _maxAttempts, 'mode': 'standard'}, max_pool_connections = max (10, 2 * workers))
+    return boto3.client ('s3', endpoint_url = endpoint, config = config)
+
+
+
+# A bucket of an object store, and the prefix the backups are kept below.
+# All keys are relative to the prefix.
+class Bucket:
+
+    def __init__ (self, url, *, endpoint = None, workers = default_workers, client = None):
+        self.name, self.prefix = parse_url (url)
+        self.workers = workers
+        self.client = client or _make_client (endpoint, workers)
+
+    def url (self, key = ''):
+        return 's3://{0}/{1}{2}'.format (self.name, self.prefix, key)
+
+    # Returns the names directly below the key, which ends with '/'. Names
+    # that hold further keys end with '/'.
+    def list_names (self, key):
+        names = []
+        args = {'Bucket': self.name, 'Prefix': self.prefix + key, 'Delimiter': '/'}
+        while (True):
+            res = self.client.list_objects_v2 (**args)
+            names.extend ([o['Key'][len (args['Prefix']):] for o in res.get ('Contents', [])])
+            names.extend ([p['Prefix'][len (args['Prefix']):] for p in res.get ('CommonPrefixes', [])])
+            if (not res.get ('IsTruncated')):
+                return names
+            args['ContinuationToken'] = res['NextContinuationToken']
+
+    # Returns the keys of all objects below the key.
+    def list_keys (self, key):
+        keys = []
+        args = {'Bucket': self.name, 'Prefix': self.prefix + key}
+        while (True):
+            res = self.client.list_objects_v2 (**args)
+            keys.extend ([o['Key'][len (self.prefix):] for o in res.get ('Contents', [])])
+            if (not res.get ('IsTruncated')):
+                return keys
+            args['ContinuationToken'] = res['NextContinuationToken']
+
+    # Returns the contents of an object as text, or None if it does not
+    # exist.
+    def read_text (self, key):
+        data = self.read_bytes (key)
+        return data.decode ('UTF-8', errors = 'surrogateescape') if data is not None else None
+
+    def read_bytes (self, key):
+        try:
+            res = self.client.get_object (Bucket = self.name, Key = self.prefix + key)
+        except Exception as e:
+            if (getattr (e, 'response', {}).get ('Error', {}).get ('Code') in ['NoSuchKey', '404']):
+                return None
+            raise
+        return res['Body'].read()
+
+    def write_text (self, key, text):
+        self.write_bytes (key, text.encode ('UTF-8', errors = 'surrogateescape'))
+
+    def write_bytes (self, key, data):
+        self.client.put_object (Bucket = self.name, Key = self.prefix + key, Body = data)
+
+    # Deletes the objects, 1000 at a time, as S3 allows.
+    def delete_keys (self, keys):
+        keys = list (keys)
+        for i in range (0, len (keys), 1000):
+            objects = [{'Key': self.prefix + k} for k in keys[i : i + 1000]]
+            res = self.client.delete_objects (Bucket = self.name, Delete = {'Objects': objects, 'Quiet': True})
+            for error in res.get ('Errors', []):
+                write_log ('Deleting \'{0}\' failed: {1}'.format (error.get ('Key'), error.get ('Message')), LogLevel.ERROR)
+
+    # Returns the lists of the ids of the multipart uploads below the key, by
+    # their keys. A key can have several uploads, which are listed in the
+    # order they have been started.
+    def list_uploads (self, key):
+        uploads = {}
+        args = {'Bucket': self.name, 'Prefix': self.prefix + key}
+        while (True):
+            res = self.client.list_multipart_uploads (**args)
+            for upload in res.get ('Uploads', []):
+                uploads.setdefault (upload['Key'][len (self.prefix):], []).append (upload['UploadId'])
+            if (not res.get ('IsTruncated')):
+                return uploads
+            args['KeyMarker'] = res['NextKeyMarker']
+            args['UploadIdMarker'] = res['NextUploadIdMarker']
+
+    def abort_upload (self, key, uploadId):
+        self.client.abort_multipart_upload (Bucket = self.name, Key = self.prefix + key, UploadId = uploadId)
+
+    # Opens a multipart upload to the key for writing. If the id of an
+    # interrupted upload is given, it is resumed.
+    def open_writer (self, key, *, partSize = default_part_size, uploadId = None):
+        return MultipartWriter (self, key, partSize = partSize, workers = self.workers, uploadId = uploadId)
+
+
+
+# Writes a stream into a multipart upload. The data written to it is cut
+# into parts, which are uploaded by up to 'workers' threads; writing blocks
+# while that many parts are being uploaded, so that the memory stays
+# bounded. close() uploads the last part, and complete() makes the object
+# out of the parts. Until then the parts are kept by the store, so that an
+# upload can be resumed: parts of a resumed upload whose hash and size
+# match are not uploaded again.
+class MultipartWriter:
+
+    def __init__ (self, bucket, key, *, partSize = default_part_size, workers = default_workers, uploadId = None):
+        if (partSize < min_part_size):
+            raise ObjectStoreError ('The parts of multipart uploads must have at least {0} bytes.'.format (min_part_size))
+        self.bucket = bucket
+        self.key = key
+        self.name = bucket.url (key)
+        self._partSize = partSize
+        self._workers = workers
+        self._uploaded = {}
+        if (uploadId is not None):
+            self._uploaded = self._list_parts (uploadId)
+        else:
+            uploadId = bucket.client.create_multipart_upload (Bucket = bucket.name, Key = bucket.prefix + key)['UploadId']
+        self.upload_id = uploadId
+        self._pool = concurrent.futures.ThreadPoolExecutor (max_workers = workers)
+        self._pending = collections.deque()
+        self._parts = []
+        self._buffer = bytearray()
+        self.skipped_bytes = 0
+        self.uploaded_bytes = 0
+
+    def _list_parts (self, uploadId):
+        parts = {}
+        args = {'Bucket': self.bucket.name, 'Key': self.bucket.prefix + self.key, 'UploadId': uploadId}
+        while (True):
+            res = self.bucket.client.list_parts (**args)
+            for p in res.get ('Parts', []):
+                parts[p['PartNumber']] = (p['ETag'].strip ('"'), p['Size'])
+            if (not res.get ('IsTruncated')):
+                return parts
+            args['PartNumberMarker'] = res['NextPartNumberMarker']
+
+    def _upload_part (self, number, data):
+        res = self.bucket.client.upload_part (Bucket = self.bucket.name, Key = self.bucket.prefix + self.key, UploadId = self.upload_id, PartNumber = number, Body = data)
+        return res['ETag']
+
+    def _submit (self, data):
+        number = len (self._parts) + len (self._pending) + 1
+        if (number > max_parts):
+            raise ObjectStoreError ('The upload to \'{0}\' needs more than {1} parts, please use larger parts.'.format (self.name, max_parts))
+        data = bytes (data)
+        uploaded = self._uploaded.get (number)
+        if (uploaded is not None and uploaded == (hashlib.md5 (data).hexdigest(), len (data))):
+            future = concurrent.futures.Future()
+            future.set_result ('"{0}"'.format (uploaded[0]))
+            self.skipped_bytes += len (data)
+        else:
+            future = self._pool.submit (self._upload_part, number, data)
+            self.uploaded_bytes += len (data)
+        self._pending.append ((number, future))
+        while (len (self._pending) > self._workers):
+            self._finish_oldest()
+
+    def _finish_oldest (self):
+        number, future = self._pending.popleft()
+        self._parts.append ({'PartNumber': number, 'ETag': future.result()})
+
+    def write (self, data):
+        self._buffer.extend (data)
+        n = 0
+        while (len (self._buffer) - n >= self._partSize):
+            self._submit (self._buffer[n : n + self._partSize])
+            n += self._partSize
+        del self._buffer[:n]
+        return len (data)
+
+    # Uploads the rest of the data and waits for all parts.
+    def close (self):
+        if (self._pool is None):
+            return
+        try:
+            # An upload needs at least one part, which may be empty.
+            if (self._buffer or not (self._parts or self._pending)):
+                self._submit (self._buffer)
+            while (self._pending):
+                self._finish_oldest()
+        finally:
+            self._pool.shutdown()
+            self._pool = None
+
+    # Makes the object out of the uploaded parts.
+    def complete (self):
+        self.close()
+        self.bucket.client.complete_multipart_upload (Bucket = self.bucket.name, Key = self.bucket.prefix + self.key, UploadId = self.upload_id, MultipartUpload = {'Parts': self._parts})
+
+    # Drops the upload and its parts.
+    def abort (self):
+        try:
+            self.close()
+        except Exception:
+            pass
+        self.bucket.abort_upload (self.key, self.upload_id)
+
+
+
+# Returns the names of the backups among the names, which match one of the
+# patterns. Names of keys that hold further keys are returned without their
+# trailing '/'.
+def match_backups (names, patterns):
+    return [n.rstrip ('/') for n in names if any ([fnmatch.fnmatchcase (n.rstrip ('/'), p) for p in patterns])]
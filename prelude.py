@@ -64,20 +64,22 @@ def or_op (a, b):
 
 
 # An alternate implementation of the max function which also accepts
-# a mapping function that is applied to each element of the list before
+# a mapping function that is applied to each element of the iterable before
 # they are compared to each other. This method returns the original
-# element of the list which scored highest compared with all other
-# elements of that list.
-def _list_opt (lst, cmp, default, key_fn):
-    if (not lst):
+# element which scored best with respect to 'cmp' compared with all other
+# elements, or the default if there are no elements. Of several equally
+# good elements the first one is returned.
+def _list_opt (iterable, cmp, default, key_fn):
+    it = iter (iterable)
+    for res in it:
+        break
+    else:
         return default
 
-    res = lst[0]
     best = key_fn (res)
-
-    for l in lst:
+    for l in it:
         next = key_fn (l)
-        if (next > best):
+        if (cmp (next, best)):
             best = next
             res = l
 
@@ -85,13 +87,13 @@ def _list_opt (lst, cmp, default, key_fn):
 
 
 
-def max (lst, *, default = None, key_fn = identity):
-    return _list_opt (lst, gt, default = default, key_fn = key_fn)
+def max (iterable, *, default = None, key_fn = identity):
+    return _list_opt (iterable, gt, default = default, key_fn = key_fn)
 
 
 
-def min (lst, *, default = None, key_fn = identity):
-    return _list_opt (lst, lt, default = default, key_fn = key_fn)
+def min (iterable, *, default = None, key_fn = identity):
+    return _list_opt (iterable, lt, default = default, key_fn = key_fn)
 
 
 
@@ -125,45 +127,43 @@ def tail (lst):
 
 
 
-def fold():
-    pass
-
-
-
-def foldl (lst, fn, default = None):
-    if (not lst):
-        return default
-    lres = fn (default, head (lst))
-    return foldl (tail (lst), fn, default = lres)
+# Folds the elements from the left: foldl ([a, b, c], fn, d) is
+# fn (fn (fn (d, a), b), c). Any iterable can be folded, in linear time.
+def foldl (iterable, fn, default = None):
+    res = default
+    for x in iterable:
+        res = fn (res, x)
+    return res
 
 
 
-def foldr (lst, fn, default = None):
-    if (not lst):
-        return default
-    res = foldr (tail (lst), fn, default = head (lst))
-    return fn (default, res)
+# Folds the elements from the right: foldr ([a, b, c], fn, d) is
+# fn (a, fn (b, fn (c, d))). Iterables that cannot be reversed are read
+# into a list first.
+def foldr (iterable, fn, default = None):
+    try:
+        elements = reversed (iterable)
+    except TypeError:
+        elements = reversed (list (iterable))
+    res = default
+    for x in elements:
+        res = fn (x, res)
+    return res
 
 
 
-# Groups the elements of a list, The grouping is based
+# Groups consecutive elements of an iterable, The grouping is based
 # on equality of whatever the group-function returns. This function
-# packs the grouped results into a list of tuples where the first
-# element is the criteria that is shared by that group, and a list
-# of elements belonging to that group. The list of elements per group
-# has the same structure the input list had.
-def groupby (lst, group_fn):
-    return [(k, [g for g in grp]) for k, grp in itertools.groupby (lst, group_fn)]
+# yields tuples where the first element is the criteria that is shared
+# by that group, and a list of elements belonging to that group. Only
+# one group is held in memory at a time.
+def groupby (iterable, group_fn):
+    for k, grp in itertools.groupby (iterable, group_fn):
+        yield (k, list (grp))
 
 
 
-# Receives a list of lists and returns a single list with all elements
-# of the inner list concatenated into a single list.
-def concat (lst):
-    res = []
-    for l in lst:
-        res += l
-    return res
-    # Alternatively this could be impplemented like
-    #return foldl (lst, add, [])
-
+# Receives an iterable of iterables and yields all elements of the inner
+# iterables, one after the other.
+def concat (iterable):
+    return itertools.chain.from_iterable (iterable)
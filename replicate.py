@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+
+# This script replicates the snapshots of a host written by strategy 3 of
+# btrcp to a second BTRFS file system, usually on an off-site server. The
+# snapshots are sent with 'btrfs send' and received with 'btrfs receive'
+# over SSH. Each snapshot is sent incrementally, relative to a snapshot the
+# replica already has:
+#
+# * the snapshot it has been taken of, as recorded by btrcp, or
+# * the snapshot that has been sent before it.
+#
+# The replication resumes after the newest snapshot both sides have. A
+# snapshot that has been received partially by an interrupted run is not
+# read-only yet; it is removed and sent again. After the new snapshots have
+# been sent, the retention plan of btrcp is applied to the replica.
+
+
+
+import argparse
+import sys
+import time
+import btrcp
+import runcmdutils
+from runcmdutils import Path, write_log, LogLevel, mk_cmd
+
+
+
+# This is the version of the script.
+script_version='1.0.0'
+
+
+
+# Returns the completed snapshots of the host directory by name. Completed
+# snapshots of older versions of btrcp, which have not been made read-only,
+# are made read-only now, as btrfs send requires.
+def find_snapshots (hostDir):
+    incomplete = btrcp._find_incomplete_backup (hostDir, 3)
+    snapshots = {}
+    for snapshot in hostDir.glob (btrcp._snapshot_pattern()):
+        if ((incomplete is not None and snapshot.get_last_part() == incomplete.get_last_part()) or not btrcp._path_is_btrfs_subvolume (snapshot)):
+            continue
+        if (not btrcp._btrfs_is_read_only (snapshot)):
+            write_log ('Making the completed snapshot \'{0}\' read-only.'.format (snapshot))
+            if (btrcp._set_btrfs_read_only (snapshot) != 0):
+                write_log ('The snapshot \'{0}\' cannot be made read-only and is not replicated.'.format (snapshot), LogLevel.WARNING)
+                continue
+        snapshots[snapshot.get_last_part()] = snapshot
+    return snapshots
+
+
+
+# Returns the names of the snapshots the replica has received completely.
+# Snapshots that have been received partially are removed.
+def find_replicated (replicaHostDir):
+    replicated = set()
+    for snapshot in replicaHostDir.glob (btrcp._snapshot_pattern()):
+        if (btrcp._btrfs_is_read_only (snapshot)):
+            replicated.add (snapshot.get_last_part())
+        else:
+            write_log ('Removing the partially received snapshot \'{0}\'.'.format (snapshot.full_path()), LogLevel.WARNING)
+            btrcp._delete_btrfs_subvolume (snapshot)
+    return replicated
+
+
+
+# Returns the names of the snapshots to send, oldest first, each with the
+# name of the snapshot it is sent relative to, or None if it has to be sent
+# completely. 'names' are the snapshots of the host, 'replicated' the ones
+# the replica has, and 'parents' the recorded parents of the snapshots.
+def plan_sends (names, replicated, parents):
+    names = sorted (names)
+    last = max ([n for n in names if n in replicated], default = None)
+    available = set (replicated) & set (names)
+    sends = []
+    for name in names:
+        if (last is not None and name <= last):
+            continue
+        parent = parents.get (name)
+        sends.append ((name, parent if parent in available else last))
+        available.add (name)
+        last = name
+    return sends
+
+
+
+# Sends a snapshot relative to its parent, if given, and receives it in the
+# host directory of the replica.
+def send_snapshot (snapshot, parent, replicaHostDir):
+    args = ['btrfs', 'send'] + (['-p', str(parent)] if parent is not None else []) + [str(snapshot)]
+    description = 'send the snapshot {0}{1} to {2}'.format (snapshot.full_path(), ' relative to {0}'.format (parent.get_last_part()) if parent is not None else '', replicaHostDir.full_path())
+    if (runcmdutils.is_planning()):
+        runcmdutils.plan_operation (description, machine = replicaHostDir.get_context())
+        return True
+    write_log ('Going to {0}.'.format (description))
+    start = time.monotonic()
+    send = mk_cmd (args, machine = snapshot.get_context())
+    receive = mk_cmd (['btrfs', 'receive', str(replicaHostDir)], machine = replicaHostDir.get_context())
+    res = (send | receive).run (retcode = None)
+    if (res[0] != 0):
+        write_log ('Sending the snapshot \'{0}\' failed with exit code {1}: {2}'.format (snapshot, res[0], res[2]), LogLevel.ERROR)
+        return False
+    write_log ('Sent the snapshot \'{0}\' in {1:.1f} seconds.'.format (snapshot, time.monotonic() - start))
+    return True
+
+
+
+# Replicates the snapshots of a host to the replica directory, which holds
+# a directory for each host like the destination directory of btrcp.
+# Returns False if a snapshot cannot be sent; the next run resumes from
+# the last snapshot that has been sent.
+def replicate (hostName, destinationDir, replicaDir):
+    hostDir = destinationDir.join (hostName)
+    replicaHostDir = replicaDir.join (hostName)
+    snapshots = find_snapshots (hostDir)
+    if (not snapshots):
+        write_log ('There are no completed snapshots of host \'{0}\' to replicate.'.format (hostName), LogLevel.WARNING)
+        return True
+    if (btrcp._mkdir (replicaHostDir) != 0):
+        write_log ('The directory \'{0}\' cannot be created on the replica.'.format (replicaHostDir.full_path()), LogLevel.ERROR)
+        return False
+
+    replicated = find_replicated (replicaHostDir)
+    sends = plan_sends (snapshots.keys(), replicated, btrcp._read_parents (hostDir))
+    write_log ('{0} snapshots of host \'{1}\' are sent to the replica.'.format (len (sends), hostName))
+    for name, parentName in sends:
+        if (not send_snapshot (snapshots[name], snapshots.get (parentName), replicaHostDir)):
+            received = replicaHostDir.join (name)
+            if (received.exists()):
+                btrcp._delete_btrfs_subvolume (received)
+            return False
+
+    btrcp._execute_retention_plan (replicaHostDir, pattern = btrcp._snapshot_pattern())
+    return True
+
+
+
+def init_arg_parser():
+    parser = argparse.ArgumentParser(prog='btrcp-replicate', description='Replicates the snapshots written by btrcp to another BTRFS file system.')
+    parser.add_argument ('--dest-dir', '-d', dest = 'dest_dir', required = True, metavar='PATH', help='Specifies the directory the backups have been written to.')
+    parser.add_argument ('--hostname', dest = 'host_names', required = True, action = 'append', default = [], metavar = 'NAME', help = 'sets the name of the host whose snapshots are replicated. This option can be used multiple times in one command.')
+    parser.add_argument ('--replica', '-r', dest = 'replica_dir', required = True, metavar='PATH', help='Specifies the (remote) directory on BTRFS the snapshots are replicated to, e.g. ssh://root@offsite/mnt/replica.')
+    parser.add_argument ('--days-off', dest = 'days_off', required = False, type = int, metavar = 'NUM', default = btrcp.env.days_off, help = 'sets the number of days to offset the retention strategy of the replica, i.e. deletion of snapshots will only start after NUM days.')
+    parser.add_argument ('--dry-run', dest = 'dry_run', required = False, action = 'store_const', const = True, help = 'lists the snapshots that would be sent and removed without changing anything.')
+    parser.set_defaults (dry_run = False)
+    parser.add_argument ('--log-file', dest = 'log_file_name', required = False, metavar = 'FILENAME', help = 'Specifies the name of a log file.')
+    parser.add_argument ('--quiet', dest = 'silent_mode', required = False, action = 'store_const', const = True, help = 'Suppresses all console output of this script.')
+    parser.set_defaults (silent_mode = False)
+    parser.add_argument ('--version', action = 'version', version = '%(prog)s {0}'.format (script_version))
+    return parser
+
+
+
+def parse_args(*args):
+    parser = init_arg_parser()
+    return parser.parse_args(*args)
+
+
+
+def main(*args):
+    args = parse_args (*args)
+    if (args.silent_mode):
+        runcmdutils.remove_console_log_handler()
+    if (args.log_file_name):
+        runcmdutils.add_log_file_handler (args.log_file_name)
+    btrcp.env.days_off = args.days_off
+    if (args.dry_run):
+        runcmdutils.start_plan()
+    try:
+        results = [replicate (hostName, Path (args.dest_dir), Path (args.replica_dir)) for hostName in args.host_names]
+    finally:
+        if (args.dry_run):
+            btrcp.write_plan_report (runcmdutils.finish_plan())
+    return 0 if all (results) else 1
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
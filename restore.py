@@ -0,0 +1,402 @@
+#!/usr/bin/python3
+
+# This script restores files from backups written by btrcp. It finds the
+# backup of a host for a given timestamp (or the latest one) and copies
+# the selected paths to a target directory, choosing the fastest way the
+# backup and the target allow:
+#
+# * a complete read-only snapshot is sent with 'btrfs send | btrfs receive'
+#   if the target is on BTRFS as well,
+# * files are cloned with reflinks if backup and target are on the same
+#   local BTRFS file system,
+# * archives are extracted, using their index if they are seekable; of a
+#   set of shards only the shards holding the selected paths are extracted,
+#   and encrypted archives are decrypted with the key file given,
+# * everything else is copied by several rsync processes in parallel,
+#   each one working on a share of the files of about the same size.
+
+
+
+import argparse
+import concurrent.futures
+import os
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import archive
+import btrcp
+import encryption
+import manifest
+import runcmdutils
+import shards
+from shards import split_into_shares
+from runcmdutils import Path, write_log, LogLevel, run_cmd, mk_cmd
+
+
+
+# This is the version of the script.
+script_version='1.0.0'
+
+# The default number of rsync processes that copy files in parallel.
+default_workers = 4
+
+# The number of seconds between two reports of the throughput.
+_reportInterval = 10
+
+
+
+# Returns True if a backup has been completed, i.e. it is not the target of
+# an incomplete backup recorded in the run journal of the host.
+def _is_complete_backup (hostDir, backup, strategy):
+    incomplete = btrcp._find_incomplete_backup (hostDir, strategy)
+    return incomplete is None or incomplete.get_last_part() != backup.get_last_part()
+
+
+
+# Finds the backup of a host. The timestamp is either formatted like the
+# names of the backups, or 'latest'. Returns a Path that points to a
+# snapshot directory, an archive, a set of shards, or the host directory of
+# strategy 2.
+def find_backup (hostName, destinationDir, timestamp):
+    hostDir = destinationDir.join (hostName)
+    if (not hostDir.is_dir()):
+        write_log ('There are no backups of host \'{0}\' in \'{1}\'.'.format (hostName, destinationDir.full_path()), LogLevel.ERROR)
+        return None
+
+    if (timestamp == 'latest'):
+        snapshot = btrcp._get_most_recent_backup_dir (hostName, destinationDir)
+        if (snapshot is not None and not _is_complete_backup (hostDir, snapshot, 3)):
+            write_log ('The most recent backup \'{0}\' is incomplete, using the one before.'.format (snapshot))
+            snapshots = sorted (hostDir.glob ('{0}/'.format (btrcp.env.timestampGlobPattern)), key = lambda p: p.get_last_part())
+            snapshot = snapshots[-2] if len (snapshots) > 1 else None
+        archives = sorted (hostDir.glob ('{0}.tar.gz'.format (btrcp.env.timestampGlobPattern)) + hostDir.glob ('{0}{1}'.format (btrcp.env.timestampGlobPattern, shards.set_suffix)), key = lambda p: p.get_last_part())
+        candidates = [b for b in [snapshot, archives[-1] if archives else None] if b is not None]
+        if (candidates):
+            return max (candidates, key = lambda p: p.get_last_part())
+        # Strategy 2 keeps a single backup in the host directory itself.
+        return hostDir
+
+    for name in [timestamp, timestamp + '.tar.gz', timestamp + shards.set_suffix]:
+        backup = hostDir.join (name)
+        if (backup.exists()):
+            return backup
+    write_log ('There is no backup of host \'{0}\' with the timestamp \'{1}\'.'.format (hostName, timestamp), LogLevel.ERROR)
+    return None
+
+
+
+# Lists the files of a backup directory below the selected paths. Returns
+# a tuple of a list of (size, path) tuples for all files and a list of all
+# directories, both relative to the backup directory.
+def _list_backup (backup, paths):
+    roots = [os.path.join (str (backup), p.strip (os.sep)) for p in paths] or [str (backup)]
+    args = ['find'] + roots + ['-printf', '%y %s %p\\0']
+    res = mk_cmd (args, machine = backup.get_context()).run (retcode = None)
+    if (res[0] != 0):
+        write_log ('Listing the backup \'{0}\' failed: {1}'.format (backup, res[2]), LogLevel.ERROR)
+        return None
+    files = []
+    dirs = []
+    base = str (backup).rstrip (os.sep) + os.sep
+    for record in res[1].split ('\0'):
+        if (not record):
+            continue
+        kind, size, path = record.split (' ', 2)
+        rel = path[len (base):] if path.startswith (base) else ''
+        if (not rel):
+            continue
+        if (kind == 'd'):
+            dirs.append (rel)
+        else:
+            files.append ((int (size), rel))
+    return (files, dirs)
+
+
+
+# Adds up the bytes and files reported by the rsync processes, and writes
+# the throughput to the log from time to time.
+class _Progress:
+
+    def __init__ (self, totalBytes, totalFiles):
+        self.total_bytes = totalBytes
+        self.total_files = totalFiles
+        self.bytes = 0
+        self.files = 0
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._reporter = threading.Thread (target = self._report_periodically, daemon = True)
+        self._reporter.start()
+
+    def add (self, size):
+        with self._lock:
+            self.bytes += size
+            self.files += 1
+
+    def report (self):
+        elapsed = max (time.monotonic() - self._start, 0.001)
+        write_log ('Restored {0} of {1} files, {2:.1f} of {3:.1f} MiB ({4:.1f} MiB/s).'.format (self.files, self.total_files, self.bytes / 1048576, self.total_bytes / 1048576, self.bytes / 1048576 / elapsed))
+
+    def _report_periodically (self):
+        while (not self._stopped.wait (_reportInterval)):
+            self.report()
+
+    def stop (self):
+        self._stopped.set()
+        self.report()
+
+
+
+# Runs one rsync process on a share of the files, and feeds the sizes of
+# the files it transferred into the progress. The errors are read by a
+# thread of their own, so rsync never blocks on a full stderr pipe while
+# its output is read.
+def _rsync_share (source, target, share, progress, results, idx):
+    with tempfile.NamedTemporaryFile (prefix = 'btrcp-restore-', suffix = '.lst') as filesFrom:
+        filesFrom.write (b''.join ([os.fsencode (p) + b'\0' for p in share]))
+        filesFrom.flush()
+        args = ['rsync', '-a', '-A', '--sparse', '--files-from', filesFrom.name, '--from0', '--out-format=%l %n', source, target]
+        write_log ('Executing command \'{0}\'', LogLevel.DEBUG, runcmdutils.CommandLine (args))
+        proc = mk_cmd (args).popen()
+        errors = []
+        reader = threading.Thread (target = lambda: errors.append (proc.stderr.read()), daemon = True)
+        reader.start()
+        for line in proc.stdout:
+            size = line.split (b' ', 1)[0]
+            if (size.isdigit()):
+                progress.add (int (size))
+        proc.wait()
+        reader.join()
+        stderr = b''.join (errors)
+        if (stderr):
+            write_log (stderr.decode ('UTF-8', 'replace'), LogLevel.ERROR)
+        results[idx] = proc.returncode
+
+
+
+# Returns the argument rsync expects for a directory that may be remote.
+def _rsync_location (path):
+    return (path.full_path() if path.is_remote_path() else path.path).rstrip (os.sep) + os.sep
+
+
+
+# Copies the selected paths of a backup directory with several rsync
+# processes in parallel. The attributes of the directories are set in a
+# last pass, because the parallel copies would change their mtimes.
+def restore_with_rsync (backup, paths, target, *, workers = default_workers):
+    if (backup.is_remote_path() and target.is_remote_path()):
+        write_log ('Either the backup or the target must be local.', LogLevel.ERROR)
+        return False
+    listing = _list_backup (backup, paths)
+    if (listing is None):
+        return False
+    files, dirs = listing
+    shares = split_into_shares (files, workers)
+    write_log ('Restoring {0} files with {1} rsync processes.'.format (len (files), len (shares)))
+
+    source = _rsync_location (backup)
+    dest = _rsync_location (target)
+    progress = _Progress (sum ([s for s, p in files]), len (files))
+    results = [None] * len (shares)
+    threads = [threading.Thread (target = _rsync_share, args = (source, dest, share, progress, results, i)) for i, share in enumerate (shares)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    progress.stop()
+
+    if (dirs):
+        results.append (None)
+        _rsync_share (source, dest, dirs, progress, results, len (results) - 1)
+    failed = [r for r in results if r != 0]
+    if (failed):
+        write_log ('{0} of the rsync processes failed.'.format (len (failed)), LogLevel.ERROR)
+    return not failed
+
+
+
+# Returns True if the path lies on a BTRFS file system.
+def _is_on_btrfs (path):
+    res = run_cmd (['stat', '-f', '--format=%T', str(path)], machine = path.get_context())
+    return res.returncode == 0 and res.stdout.strip() == 'btrfs'
+
+
+
+# Returns True if the path is a read-only BTRFS subvolume.
+def _is_read_only_subvolume (path):
+    return btrcp._path_is_btrfs_subvolume (path) and btrcp._btrfs_is_read_only (path)
+
+
+
+# Sends a read-only snapshot to the target directory, where it is received
+# as a new subvolume.
+def restore_with_btrfs_send (backup, target):
+    write_log ('Sending the snapshot \'{0}\' to \'{1}\'.'.format (backup, target.full_path()))
+    start = time.monotonic()
+    send = mk_cmd (['btrfs', 'send', str(backup)], machine = backup.get_context())
+    receive = mk_cmd (['btrfs', 'receive', str(target)], machine = target.get_context())
+    res = (send | receive).run (retcode = None)
+    if (res[0] != 0):
+        write_log ('Sending the snapshot failed with exit code {0}: {1}'.format (res[0], res[2]), LogLevel.ERROR)
+        return False
+    write_log ('Received the snapshot as \'{0}\' in {1:.1f} seconds.'.format (target.join (backup.get_last_part()), time.monotonic() - start))
+    return True
+
+
+
+# Clones the selected paths of a local backup into a local target on the
+# same BTRFS file system. No data is copied, the files share their extents.
+def restore_with_reflinks (backup, paths, target):
+    for p in (paths or ['.']):
+        rel = os.path.normpath (p.strip (os.sep))
+        targetDir = target.join (os.path.dirname (rel))
+        btrcp._mkdir (targetDir)
+        res = run_cmd (['cp', '-a', '--reflink=always', str (backup.join (rel)), str (targetDir) + os.sep])
+        if (res.returncode != 0):
+            return False
+    return True
+
+
+
+# Extracts the selected paths from an archive. Seekable archives are read
+# through their index, all others are extracted by tar. Encrypted archives
+# are decrypted with the key.
+def restore_from_archive (backup, paths, target, *, key = None):
+    if (backup.is_remote_path() or target.is_remote_path()):
+        write_log ('Archives can only be restored from and to local directories.', LogLevel.ERROR)
+        return False
+    encrypted = encryption.is_encrypted (backup.path)
+    if (encrypted and key is None):
+        write_log ('The archive \'{0}\' is encrypted, please give the key file with --key-file.'.format (backup), LogLevel.ERROR)
+        return False
+    btrcp._mkdir (target)
+    indexFile = archive.index_file_of (backup.path)
+    try:
+        if (paths and os.path.isfile (indexFile)):
+            count = archive.extract (backup.path, paths, target.path, indexFile = indexFile, key = key)
+            write_log ('Extracted {0} members from \'{1}\'.'.format (count, backup))
+            return count > 0
+        if (encrypted):
+            return _extract_encrypted (backup, paths, target, key)
+    except (OSError, EOFError, KeyError, tarfile.TarError, encryption.EncryptionError, manifest.ManifestError) as e:
+        write_log ('Extracting from the archive \'{0}\' failed: {1}'.format (backup, e), LogLevel.ERROR)
+        return False
+    res = run_cmd (['tar', '--numeric-owner', '-xzf', str(backup), '-C', str(target)] + [p.strip (os.sep) for p in paths])
+    return res.returncode == 0
+
+
+
+# Decrypts an archive into tar, which extracts the selected paths.
+def _extract_encrypted (backup, paths, target, key):
+    tarProc = mk_cmd (['tar', '--numeric-owner', '-xzf', '-', '-C', str(target)] + [p.strip (os.sep) for p in paths]).popen (stdout = None, stderr = None)
+    try:
+        with open (backup.path, 'rb') as f:
+            encryption.decrypt_stream (f, tarProc.stdin, key)
+    finally:
+        tarProc.stdin.close()
+        exitCode = tarProc.wait()
+    return exitCode == 0
+
+
+
+# Extracts the selected paths from a set of shards. The list of the set
+# tells which shards hold the paths, and those are extracted concurrently.
+# If a shard number is given, only that shard is extracted.
+def restore_from_shards (backup, paths, target, *, shard = None, workers = default_workers, key = None):
+    if (backup.is_remote_path() or target.is_remote_path()):
+        write_log ('Shards can only be restored from and to local directories.', LogLevel.ERROR)
+        return False
+    try:
+        shardList = shards.parse_list (archive.read_text (backup.join (shards.list_name).path, key = key))
+    except (OSError, manifest.ManifestError, encryption.EncryptionError) as e:
+        write_log ('The list of the shards in \'{0}\' cannot be read: {1}'.format (backup, e), LogLevel.ERROR)
+        return False
+    if (shard is not None):
+        name = shards.shard_file_name (shard)
+        shardList = [s for s in shardList if s[0] == name]
+        if (not shardList):
+            write_log ('The backup \'{0}\' has no shard {1}.'.format (backup, shard), LogLevel.ERROR)
+            return False
+    selection = shards.select_shards (shardList, paths)
+    if (not selection):
+        write_log ('None of the shards of \'{0}\' holds the selected paths.'.format (backup), LogLevel.ERROR)
+        return False
+    write_log ('Extracting {0} of {1} shards.'.format (len (selection), len (shardList)))
+
+    with concurrent.futures.ThreadPoolExecutor (max_workers = max (1, min (workers, len (selection)))) as pool:
+        results = list (pool.map (lambda s: restore_from_archive (backup.join (s[0]), s[1], target, key = key), selection))
+    return all (results)
+
+
+
+# Restores the selected paths of a backup to the target. If no paths are
+# given, the whole backup is restored. A shard number selects a single
+# shard of a set of shards.
+def restore (backup, paths, target, *, workers = default_workers, shard = None, key = None):
+    start = time.monotonic()
+    if (backup.get_last_part().endswith (shards.set_suffix) and backup.is_dir()):
+        ok = restore_from_shards (backup, paths, target, shard = shard, workers = workers, key = key)
+    elif (shard is not None):
+        write_log ('The backup \'{0}\' is not a set of shards.'.format (backup), LogLevel.ERROR)
+        ok = False
+    elif (backup.is_file()):
+        ok = restore_from_archive (backup, paths, target, key = key)
+    elif (not paths and _is_read_only_subvolume (backup) and target.is_dir() and _is_on_btrfs (target)):
+        ok = restore_with_btrfs_send (backup, target)
+    elif (not backup.is_remote_path() and not target.is_remote_path() and _is_on_btrfs (backup) and target.is_dir() and _is_on_btrfs (target) and restore_with_reflinks (backup, paths, target)):
+        ok = True
+    else:
+        btrcp._mkdir (target)
+        ok = restore_with_rsync (backup, paths, target, workers = workers)
+    write_log ('Restoring \'{0}\' {1} after {2:.1f} seconds.'.format (backup, 'succeeded' if ok else 'failed', time.monotonic() - start))
+    return ok
+
+
+
+def init_arg_parser():
+    parser = argparse.ArgumentParser(prog='btrcp-restore', description='Restores files from backups written by btrcp.')
+    parser.add_argument ('--dest-dir', '-d', dest = 'dest_dir', required = True, metavar='PATH', help='Specifies the directory the backups have been written to.')
+    parser.add_argument ('--hostname', dest = 'host_name', required = True, metavar = 'NAME', help = 'sets the name of the host whose backup is restored.')
+    parser.add_argument ('--timestamp', dest = 'timestamp', required = False, metavar = 'TIMESTAMP', default = 'latest', help = 'selects the backup by its timestamp, e.g. 2022-01-31-12-00. Default is the latest backup.')
+    parser.add_argument ('--path', '-p', dest = 'paths', required = False, action = 'append', default = [], metavar='PATH', help='Specifies a path in the backup to restore. This option can be used multiple times in one command. By default the whole backup is restored.')
+    parser.add_argument ('--target', '-t', dest = 'target_dir', required = True, metavar='PATH', help='Specifies the (remote) directory the files are restored to.')
+    parser.add_argument ('--shard', dest = 'shard', required = False, type = int, metavar = 'NUM', default = None, help = 'restores only from shard NUM of a backup that has been written as a set of shards.')
+    parser.add_argument ('--workers', dest = 'workers', required = False, type = int, metavar = 'NUM', default = default_workers, help = 'sets the number of rsync processes that copy files in parallel.')
+    parser.add_argument ('--key-file', '-k', dest = 'key_file', required = False, metavar = 'FILE', default = None, help = 'Specifies the key file the archives of the backup have been encrypted with.')
+    parser.add_argument ('--log-file', dest = 'log_file_name', required = False, metavar = 'FILENAME', help = 'Specifies the name of a log file.')
+    parser.add_argument ('--quiet', dest = 'silent_mode', required = False, action = 'store_const', const = True, help = 'Suppresses all console output of this script.')
+    parser.set_defaults (silent_mode = False)
+    parser.add_argument ('--version', action = 'version', version = '%(prog)s {0}'.format (script_version))
+    return parser
+
+
+
+def parse_args(*args):
+    parser = init_arg_parser()
+    return parser.parse_args(*args)
+
+
+
+def main(*args):
+    args = parse_args (*args)
+    if (args.silent_mode):
+        runcmdutils.remove_console_log_handler()
+    if (args.log_file_name):
+        runcmdutils.add_log_file_handler (args.log_file_name)
+    try:
+        key = encryption.read_key (args.key_file) if args.key_file else None
+    except (OSError, encryption.EncryptionError) as e:
+        write_log ('Reading the key file failed: {0}'.format (e), LogLevel.ERROR)
+        return 1
+    backup = find_backup (args.host_name, Path (args.dest_dir), args.timestamp)
+    if (backup is None):
+        return 1
+    write_log ('Restoring from the backup \'{0}\'.'.format (backup.full_path()))
+    return 0 if restore (backup, args.paths, Path (args.target_dir), workers = args.workers, shard = args.shard, key = key) else 1
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,13 +3,25 @@
 
 
 
+import asyncio
+import atexit
+import concurrent.futures
+import contextlib
 from enum import Enum
+import functools
+import json
 import logging
+import logging.handlers
 import os
 import glob
+import queue
+import signal
 from signal import SIG_DFL
 import plumbum as pb
 import sys
+import threading
+import time
+import tracing
 import subprocess
 from urllib.parse import urlparse
 
@@ -35,27 +47,141 @@ _logFormatter = logging.Formatter(_logFormat)
 _stdoutHandler = logging.StreamHandler(stream = sys.stdout)
 _stderrHandler = logging.StreamHandler(stream = sys.stderr)
 
+# The logger itself only puts the log records into this queue. The listener
+# thread takes them out and passes them to the console and file handlers,
+# so a slow console or log disk never stalls the execution of commands.
+_logQueue = queue.SimpleQueue()
+_logListener = None
+
 # Stores the environment uesd to execute all commands.
 _env = None
 
 
 
+# The number of commands run_cmd_many() runs at the same time, unless
+# the caller sets a different limit.
+default_concurrency = 8
+
+
+
 # A class container for returning the results of shell-sub-process calls.
+# Each call returns its own instance.
 class ProcessResult:
-    __slots__ = []
+    __slots__ = ['returncode', 'stdout', 'stderr', 'usage']
+
+    def __init__ (self, returncode, stdout, stderr, usage = None):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.usage = usage
+
+
+
+# The resources a command has used. The wall time is always known; the CPU
+# times (in seconds), the maximum resident set size (in KiB) and the bytes
+# read from and written to storage are only known for local commands, and
+# are None otherwise.
+class ResourceUsage:
+    __slots__ = ['command', 'machine', 'wallTime', 'userTime', 'systemTime', 'maxRss', 'readBytes', 'writeBytes']
+
+    def __init__ (self, command, machine, wallTime, *, userTime = None, systemTime = None, maxRss = None, readBytes = None, writeBytes = None):
+        self.command = command
+        self.machine = machine
+        self.wallTime = wallTime
+        self.userTime = userTime
+        self.systemTime = systemTime
+        self.maxRss = maxRss
+        self.readBytes = readBytes
+        self.writeBytes = writeBytes
+
+
+
+# The resource usage of all commands that have been run so far, see
+# usage_summary().
+_usages = []
+_usagesLock = threading.Lock()
+
+
+
+# A message whose arguments are only formatted into it with str.format()
+# when the record is written by the listener thread. The result is kept
+# for the further handlers of the record.
+class _LazyMessage:
+    __slots__ = ['fmt', 'args', 'text']
+
+    def __init__ (self, fmt, args):
+        self.fmt = fmt
+        self.args = args
+        self.text = None
+
+    def __str__ (self):
+        if (self.text is None):
+            self.text = self.fmt.format (*self.args)
+        return self.text
+
+
+
+# Puts log records into the log queue as they are. The standard QueueHandler
+# formats each record before it is queued, which would happen in the thread
+# that writes the log message.
+class _QueueHandler (logging.handlers.QueueHandler):
+    def prepare (self, record):
+        return record
+
+
+
+# Formats log records as JSON objects, one per line.
+class _JsonFormatter (logging.Formatter):
+    def format (self, record):
+        entry = {
+            'time': self.formatTime (record),
+            'level': record.levelname,
+            'message': record.getMessage(),
+            'thread': record.threadName
+        }
+        if (record.exc_info):
+            entry['exception'] = self.formatException (record.exc_info)
+        return json.dumps (entry)
 
 
 
 def init_logger():
-    global _logger_is_initialized
+    global _logger_is_initialized, _logListener
     if (_logger_is_initialized == True):
         return
     _logger_is_initialized = True
     _stdoutHandler.setFormatter (_logFormatter)
     _stderrHandler.setFormatter (_logFormatter)
-    _log.addHandler (_stdoutHandler)
-    #log.addHandler (stderrHandler)
+    _log.addHandler (_QueueHandler (_logQueue))
     _log.setLevel (logging.INFO)
+    # Handlers of parent loggers would be called by the thread that writes
+    # the log message.
+    _log.propagate = False
+    _logListener = logging.handlers.QueueListener (_logQueue, _stdoutHandler)
+    _logListener.start()
+    atexit.register (flush_log)
+
+
+
+# Writes all log records that are still queued. This is called at exit,
+# but can be called any time to make sure the log is complete.
+def flush_log():
+    if (_logListener is None):
+        return
+    _logListener.stop()
+    _logListener.start()
+
+
+
+# Returns the handlers the log listener passes the log records to.
+def _log_handlers():
+    return list (_logListener.handlers)
+
+
+
+# Replaces the handlers of the log listener.
+def _set_log_handlers (handlers):
+    _logListener.handlers = tuple (handlers)
 
 
 
@@ -63,7 +189,7 @@ def init_logger():
 def add_log_file_handler (fileName):
     fileHandler = logging.FileHandler (fileName, mode = 'a', encoding = 'UTF-8')
     fileHandler.setFormatter (_logFormatter)
-    _log.addHandler (fileHandler)
+    _set_log_handlers (_log_handlers() + [fileHandler])
 
 
 
@@ -71,12 +197,19 @@ def add_log_file_handler (fileName):
 # is called when the option '--silent' has been given to this script.
 def remove_console_log_handler():
     global _stdoutHandler, _stderrHandler
-    if (_stdoutHandler != None):
-        _log.removeHandler (_stdoutHandler)
-        _stdoutHandler = None
-    if (_stderrHandler != None):
-        _log.removeHandler (_stderrHandler)
-        _stderrHandler = None
+    _set_log_handlers ([h for h in _log_handlers() if h not in (_stdoutHandler, _stderrHandler)])
+    _stdoutHandler = None
+    _stderrHandler = None
+
+
+
+# Writes all log records as JSON objects, one per line, instead of plain
+# text lines.
+def use_json_log_records():
+    global _logFormatter
+    _logFormatter = _JsonFormatter()
+    for handler in _log_handlers():
+        handler.setFormatter (_logFormatter)
 
 
 class LogLevel(Enum):
@@ -97,9 +230,13 @@ def set_log_level(loglevel):
 
 
 
-def write_log (msg, level = LogLevel.INFO):
-    log_functions = { LogLevel.DEBUG: _log.debug, LogLevel.INFO: _log.info, LogLevel.WARNING: _log.warning, LogLevel.CRITICAL: _log.critical, LogLevel.ERROR: _log.error }
-    log_functions[level](msg)
+# Writes a log message. If arguments are given, the message is a format
+# string for str.format(), which is only applied if the message is written
+# at all, e.g. write_log ('Copying \'{0}\'', LogLevel.DEBUG, path).
+def write_log (msg, level = LogLevel.INFO, *args):
+    if (not _log.isEnabledFor (level.value)):
+        return
+    _log.log (level.value, _LazyMessage (msg, args) if args else msg)
 
 
 
@@ -152,66 +289,125 @@ def _get_local_machine_context():
 
 
 
+# The machine a path lies on, which is shared by all paths that name the
+# same user, host and port. The plumbum machine is only selected when it
+# is first needed, so creating paths of remote hosts does not connect.
+class _Location:
+    __slots__ = ['username', 'hostname', 'port', '_machine']
+
+    def __init__ (self, username, hostname, port, machine):
+        self.username = username
+        self.hostname = hostname
+        self.port = port
+        self._machine = machine
+
+    def machine (self):
+        if (self._machine is None):
+            self._machine = _select_machine_context (self.username, self.hostname, port = self.port)
+        return self._machine
+
+
+
+# The interned locations, keyed by user, host, port and explicitly given
+# machine.
+_locations = {}
+_locationsLock = threading.Lock()
+
+def _intern_location (username, hostname, port, machine = None):
+    key = (username, hostname, port, id (machine))
+    location = _locations.get (key)
+    if (location is None):
+        with _locationsLock:
+            location = _locations.setdefault (key, _Location (username, hostname, port, machine))
+    return location
+
+
+
+# Parses the part of a path URL before its path, e.g. 'ssh://user@host:22'.
+# Many paths share the same few prefixes, so each one is parsed only once.
+@functools.lru_cache (maxsize = 1024)
+def _parse_prefix (prefix):
+    parsedUri = urlparse (prefix)
+    return _intern_location (parsedUri.username, parsedUri.hostname, parsedUri.port)
+
+
+
+# Splits a path string into its location and the path on that machine.
+# Strings without a ':' are local paths and are not parsed at all.
+def _parse_path (path):
+    if (':' not in path):
+        return (_intern_location (None, None, None), path)
+    # Add a scheme, if no scheme was given, assuming that it is SSH
+    if ('://' not in path):
+        path = 'ssh://' + path
+    slash = path.find ('/', path.index ('://') + 3)
+    if (slash < 0):
+        return (_parse_prefix (path), '')
+    return (_parse_prefix (path[:slash]), path[slash:])
+
+
+
 # This path-class represents all we need to know about paths that are
-# used in this module or script.
+# used in this module or script. Paths are immutable values: joining,
+# globbing and the like return new paths, which share the location of the
+# path they have been derived from. The plumbum path is only created when
+# the file system is accessed.
 class Path(object):
-    path = None
-    _machinePath = None
-    _machineContext = None
-    _hostname = None
-    _port = None
-    _username = None
+    __slots__ = ['path', '_location', '_machinePath']
 
     def __init__ (self, path = None, * , machine = None):
         if (path is not None and not isinstance (path, str)):
             raise EnvironmentError()
         # For the copy constructor, just return
         if (not path):
-            self.path = None
-            self._machineContext = None
-            self._hostname = None
-            self._username = None
-            return
-
-        # Add a scheme, if no scheme was given, assumint that it is SSH
-        if (':' in path):
-            if ('://' not in path):
-                path = 'ssh://' + path
-
-        parsedUri = urlparse (path)
-        self._hostname = parsedUri.hostname
-        self._username = parsedUri.username
-        self._port = parsedUri.port
-        if (machine):
-            self._machineContext = machine
+            location, path = (_intern_location (None, None, None, machine) if machine else None), None
         else:
-            self._machineContext = _select_machine_context (parsedUri.username, parsedUri.hostname)
-        #self.path = self._machineContext.env.expanduser (parsedUri.path)
-        self.path = parsedUri.path
-        self._machinePath = self._machineContext.path (parsedUri.path)
+            location, path = _parse_path (path)
+            if (machine):
+                location = _intern_location (location.username, location.hostname, location.port, machine)
+        object.__setattr__ (self, 'path', path)
+        object.__setattr__ (self, '_location', location)
+        object.__setattr__ (self, '_machinePath', None)
+
+    def __setattr__ (self, name, value):
+        raise AttributeError ('Path instances are immutable.')
+
+    def __eq__ (self, other):
+        return isinstance (other, Path) and self.path == other.path and self._location is other._location
+
+    def __hash__ (self):
+        return hash ((self.path, id (self._location)))
+
+    def __repr__ (self):
+        return 'Path({0!r})'.format (self.full_path())
 
     # This is the copy-constructor.
     def _copy (self, path):
         if (not isinstance (path, str)):
             raise EnvironmentError()
-        newPath = Path()
-        newPath.path = path
-        newPath._machinePath = self._machineContext.path (path)
-        newPath._machineContext = self._machineContext
-        newPath._hostname = self._hostname
-        newPath._port = self._port
-        newPath._username = self._username
+        newPath = object.__new__ (Path)
+        object.__setattr__ (newPath, 'path', path)
+        object.__setattr__ (newPath, '_location', self._location)
+        object.__setattr__ (newPath, '_machinePath', None)
         return newPath
 
+    # Returns the plumbum path, which is created on first use.
+    def _pb_path (self):
+        machinePath = self._machinePath
+        if (machinePath is None):
+            machinePath = self.get_context().path (self.path)
+            object.__setattr__ (self, '_machinePath', machinePath)
+        return machinePath
+
     # Expands user-directories which in Linux this is represented by a tilde (~)
     # into an absolute path.
     def expanduser (self):
-        expanded_path = self._machineContext.env.expanduser (self.path)
+        expanded_path = self.get_context().env.expanduser (self.path)
         return self._copy (expanded_path)
 
     # Returns True if the path points to a remote machine.
     def is_remote_path (self):
-        return True if self._hostname else False
+        return self._location is not None and bool (self._location.hostname)
 
     # Returns True if the given path represents the root of the file system.
     def is_root (self):
@@ -219,15 +415,27 @@ class Path(object):
 
     # Returns true if the object this path represents exist.
     def exists (self):
-        return self._machinePath.exists()
+        return self._pb_path().exists()
 
     # Returns true if the path represents a directory
     def is_dir (self):
-        return self._machinePath.is_dir()
+        return self._pb_path().is_dir()
 
     # Returns True if the path represents a file.
     def is_file (self):
-        return self._machinePath.is_file()
+        return self._pb_path().is_file()
+
+    # Returns the contents of the file this path represents as a string.
+    def read (self):
+        return self._pb_path().read (encoding = 'UTF-8')
+
+    # Replaces the contents of the file this path represents with the string
+    # given as parameter.
+    def write (self, data):
+        if (is_planning()):
+            plan_operation ('write {0}'.format (self.full_path()), machine = self.get_context())
+            return
+        self._pb_path().write (data, encoding = 'UTF-8')
 
     # Returns the last part of this Path, which is either
     # the file name the path points to, or the folder name
@@ -241,17 +449,17 @@ class Path(object):
     # instance compared to the path which is given as parameter.
     # To make is more consistent with conventions about absolute
     # paths, the string returned will not start with a slash or
-    # os-separator character.
+    # os-separator character. Returns None if this path does not
+    # lie below the given one.
     def strip_base (self, path):
-        res = None
         if (not isinstance (path, Path)):
             raise EnvironmentError()
-        p = path.path
-        if (self.path.startswith (p)):
-            res = self.path[len (p):]
-            if (res.startswith (os.sep)):
-                res = res[1:]
-        return res
+        base = path.path.rstrip (os.sep)
+        if (self.path == base):
+            return ''
+        if (self.path.startswith (base + os.sep)):
+            return self.path[len (base):].lstrip (os.sep)
+        return None
 
     # Joins multiple path fragments together to a single path.
     def join (self, *args):
@@ -260,28 +468,45 @@ class Path(object):
     # Enumerates all files and folders containes in the directory
     # this path represents.
     def glob (self, pattern = None):
-        # We need os.path.join to join the path and the pattern,
-        # because the plumbum-lib has a prolem with patterns that
-        # end with a os.path.sep character.
-        globPath = self.path
         if pattern is None:
             pattern = '*'
 
-        self._machineContext.cwd.chdir(globPath)
-
-        return [self._copy (g) for g in self._machineContext.cwd.glob(pattern)]
+        # Local directories are globbed directly, which does not create a
+        # plumbum path for each entry. Globbing relative to the path instead
+        # of changing the working directory keeps this safe for backups
+        # running in parallel threads.
+        if (not self.is_remote_path()):
+            return [self._copy (g.rstrip (os.sep) or os.sep) for g in glob.glob (os.path.join (glob.escape (self.path), pattern))]
+        return [self._copy (str (g)) for g in self._pb_path().glob (pattern)]
 
     # Changes the working directory to the path this instance represents.
     def change_work_dir (self):
-        return self._machineContext.cwd(self._machinePath)
+        return self.get_context().cwd(self._pb_path())
 
     # Returns the machine context this path is defined in.
     def get_context (self):
-        return self._machineContext
-
-    # Returns the full path representation as a string.
+        return self._location.machine() if self._location is not None else None
+
+    # Returns '[user@]host[:port]' of a remote path, or None for a local
+    # path. The user and the port are left out if the path names none.
+    def get_host (self):
+        if (not self.is_remote_path()):
+            return None
+        host = self._location.hostname
+        if (self._location.username is not None):
+            host = '{0}@{1}'.format (self._location.username, host)
+        if (self._location.port is not None):
+            host = '{0}:{1}'.format (host, self._location.port)
+        return host
+
+    # Returns the full path representation as a string, '[user@]host:path'
+    # for a remote path. The user is left out if the path names none.
     def full_path (self):
-        return '{0}@{1}:{2}'.format(self._username, self._hostname, self.path) if self.is_remote_path() else self.path
+        if (not self.is_remote_path()):
+            return self.path
+        if (self._location.username is None):
+            return '{0}:{1}'.format (self._location.hostname, self.path)
+        return '{0}@{1}:{2}'.format (self._location.username, self._location.hostname, self.path)
 
     def __str__ (self):
         # Returns the path description in full detail as a string.
@@ -293,7 +518,7 @@ class Path(object):
     # Returns the plumbum-path instance this path-instance is wrapping.
     def pbPath(self):
         # Returns the Plumbum path representation of this Path instance
-        return self._machinePath
+        return self._pb_path()
 
 
 
@@ -303,10 +528,23 @@ def get_machine (username, hostname, *, port = None, password = None, hostkey =
 
 
 
+# The command line of a command for log messages, which is only joined
+# when it is written.
+class CommandLine:
+    __slots__ = ['args']
+
+    def __init__ (self, args):
+        self.args = args
+
+    def __str__ (self):
+        return ' '.join ([a if isinstance (a, str) else str(a) for a in self.args])
+
+
+
 # Creates a command wrapper which contains the command name and its arguments.
 # This wrapper can then be piped or directly executed by calling its run() method.
 def mk_cmd (args, *, machine = None, stdin = None):
-    write_log ('Building command \'{0}\''.format(' '.join ([a if isinstance (a, str) else str(a) for a in args])), level = LogLevel.DEBUG)
+    write_log ('Building command \'{0}\'', LogLevel.DEBUG, CommandLine (args))
 
     # Figure out on which machine we will execute the command.
     # If no machine is given, then we will run the command on the 
@@ -326,40 +564,372 @@ def mk_cmd (args, *, machine = None, stdin = None):
 def exec_cmd (cmd):
     global _env
 
-    write_log ('Executing command \'{0}\''. format(str(cmd)), level = LogLevel.INFO)
-
-    res = cmd.run (retcode = None, env = _env)
+    write_log ('Executing command \'{0}\'', LogLevel.INFO, cmd)
+
+    machineName = _machine_name (cmd)
+    with tracing.span ('exec_cmd', machine = machineName, command = cmd) as spanArgs:
+        startTime = time.monotonic()
+        proc = cmd.popen (env = _env)
+        res = _wait_for_process (proc, cmd, machineName, startTime)
+        spanArgs['returncode'] = res.returncode
+
+    return res
+
+
+
+# Reads the output of a process started from a command wrapper until it
+# exits, and returns its ProcessResult including the resource usage. The
+# process is reaped with wait4() to get its rusage; before that, the I/O
+# counters are read from /proc while the process is a zombie.
+def _wait_for_process (proc, cmd, machineName, startTime):
+    outputs = {}
+
+    # Commands never get input from us, other than the redirected stdin
+    # data of mk_cmd().
+    if (proc.stdin):
+        proc.stdin.close()
+
+    def read_output (name, stream):
+        outputs[name] = stream.read() if stream else b''
+
+    readers = [threading.Thread (target = read_output, args = ('stderr', proc.stderr), daemon = True)]
+    readers[0].start()
+    read_output ('stdout', proc.stdout)
+    readers[0].join()
+
+    rusage = None
+    ioCounters = {}
+    try:
+        os.waitid (os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        ioCounters = _read_proc_io (proc.pid)
+        _, status, rusage = os.wait4 (proc.pid, 0)
+        proc.returncode = -os.WTERMSIG (status) if os.WIFSIGNALED (status) else os.WEXITSTATUS (status)
+    except ChildProcessError:
+        # Someone else reaped the process, e.g. after killing it.
+        proc.wait()
+    wallTime = time.monotonic() - startTime
+
+    for stream in [proc.stdout, proc.stderr]:
+        if (stream): stream.close()
+
+    encoding = getattr (proc, 'custom_encoding', None) or 'UTF-8'
+    stdout = outputs['stdout'].decode (encoding, 'ignore') if isinstance (outputs['stdout'], bytes) else outputs['stdout']
+    stderr = outputs['stderr'].decode (encoding, 'ignore') if isinstance (outputs['stderr'], bytes) else outputs['stderr']
+
+    # The rusage of remote commands would be the one of the ssh client.
+    if (machineName == 'localhost' and rusage is not None):
+        usage = ResourceUsage (str(cmd), machineName, wallTime, userTime = rusage.ru_utime, systemTime = rusage.ru_stime, maxRss = rusage.ru_maxrss,
+            readBytes = ioCounters.get ('read_bytes'), writeBytes = ioCounters.get ('write_bytes'))
+    else:
+        usage = ResourceUsage (str(cmd), machineName, wallTime)
+    with _usagesLock:
+        _usages.append (usage)
 
     # Log the output
-    stdout = res[1]
     if (stdout): write_log (stdout, level = LogLevel.INFO)
-    stderr = res[2]
     if (stderr): write_log (stderr, level = LogLevel.ERROR)
 
-    # Create a new instance to return the results of the subprocess call.
-    procRes = ProcessResult
-    procRes.returncode = res[0]
-    procRes.stdout = stdout
-    procRes.stderr = stderr
-
     # Return the result of the shell-command.
-    return procRes
+    return ProcessResult (proc.returncode, stdout, stderr, usage)
+
+
+
+# Reads the I/O counters of a process from /proc/<pid>/io. Returns an empty
+# dictionary if they are not available.
+def _read_proc_io (pid):
+    try:
+        with open ('/proc/{0}/io'.format (pid)) as f:
+            return {k: int (v) for k, v in (line.split (':') for line in f if ':' in line)}
+    except (OSError, ValueError):
+        return {}
+
+
+
+# Returns a table of the 'count' commands which took the most wall time
+# so far, or None if no commands have been run.
+def usage_summary (count = 10):
+    with _usagesLock:
+        usages = sorted (_usages, key = lambda u: u.wallTime, reverse = True)[:count]
+    if (not usages):
+        return None
+
+    def fmt (value, unit = ''):
+        return '-' if value is None else '{0}{1}'.format (value, unit)
+
+    rows = [('wall', 'user', 'sys', 'max rss', 'read', 'written', 'machine', 'command')]
+    for u in usages:
+        rows.append (('{0:.2f}s'.format (u.wallTime),
+            fmt (None if u.userTime is None else '{0:.2f}'.format (u.userTime), 's'),
+            fmt (None if u.systemTime is None else '{0:.2f}'.format (u.systemTime), 's'),
+            fmt (u.maxRss, 'K'), fmt (u.readBytes), fmt (u.writeBytes), u.machine, u.command))
+    widths = [max (len (r[i]) for r in rows) for i in range (len (rows[0]) - 1)]
+    return '\n'.join (' '.join ([c.rjust (w) for c, w in zip (r, widths)] + [r[-1]]) for r in rows)
+
+
+
+# Writes the table of the most expensive commands to the log.
+def write_usage_summary (count = 10):
+    summary = usage_summary (count)
+    if (summary):
+        write_log ('The commands that took the most time:\n{0}', LogLevel.INFO, summary)
 
 
 
 # Calls a shell command. If 'stdin' is given, it will be passed through
-# the stdin-pipe of the shell to the command. If 'dryRun' is set to True
-# the command is not executed, but instead an empty result with a return-code
-# of 0 and empty stdout and stderr results is returned.
+# the stdin-pipe of the shell to the command. While a plan is made (see
+# start_plan()), commands that change anything are not executed, but added
+# to the plan instead, and an empty result with a return-code of 0 and
+# empty stdout and stderr results is returned.
 def run_cmd (args, *, machine = None, stdin = None):
     global _env
 
+    if (_is_planned (args, machine)):
+        return ProcessResult (0, '', '')
+
     cmd = mk_cmd (args, machine = machine, stdin = stdin)
 
     return exec_cmd (cmd)
 
 
 
+# The operations a backup would perform, which are collected instead of
+# executing them. 'estimatedBytes' and 'estimatedFiles' sum up how much
+# data the transfers of the plan would copy, as far as that is known.
+# 'predictedSeconds' sums up the predicted durations of the backups in the
+# plan; 'unpredictedBackups' counts the backups without a prediction.
+class Plan:
+    def __init__ (self):
+        self.operations = []
+        self.estimatedBytes = 0
+        self.estimatedFiles = 0
+        self.predictedSeconds = 0
+        self.unpredictedBackups = 0
+
+    def add_operation (self, machine, description):
+        self.operations.append ((machine, description))
+
+    def add_estimate (self, bytes, files):
+        self.estimatedBytes += bytes
+        self.estimatedFiles += files
+
+    def add_prediction (self, seconds):
+        if (seconds is None):
+            self.unpredictedBackups += 1
+        else:
+            self.predictedSeconds += seconds
+
+
+
+# The plan that is currently made, or None if commands are executed.
+_plan = None
+
+# Commands that only inspect the system. They are executed while a plan
+# is made, because the plan depends on their results.
+_readOnlyCommands = {'cat', 'df', 'du', 'find', 'hostname', 'ls', 'lxc-info', 'lxc-ls', 'readlink', 'stat', 'test', 'which'}
+_readOnlyBtrfsCommands = {('subvolume', 'show'), ('subvolume', 'list'), ('subvolume', 'find-new'), ('property', 'get'), ('filesystem', 'usage'), ('qgroup', 'show')}
+
+
+
+# Starts to make a plan: from now on, commands that would change anything
+# are added to the plan instead of executing them.
+def start_plan():
+    global _plan
+    _plan = Plan()
+    return _plan
+
+
+
+# Stops making the plan and returns it.
+def finish_plan():
+    global _plan
+    plan, _plan = _plan, None
+    return plan
+
+
+
+# Returns True while a plan is made.
+def is_planning():
+    return _plan is not None
+
+
+
+# Returns the plan that is currently made, or None.
+def current_plan():
+    return _plan
+
+
+
+# Adds an operation, which is not a command, to the plan.
+def plan_operation (description, *, machine = None):
+    name = _machine_name_of (machine)
+    _plan.add_operation (name, description)
+    write_log ('Planned on {0}: {1}', LogLevel.INFO, name, description)
+
+
+
+# Returns True if a command only inspects the system.
+def _is_read_only (args):
+    name = os.path.basename (str (args[0]))
+    if (name == 'rsync'):
+        return '--dry-run' in args or '--version' in args
+    if (name == 'btrfs'):
+        return tuple (args[1:3]) in _readOnlyBtrfsCommands
+    return name in _readOnlyCommands
+
+
+
+# Adds the command to the plan and returns True, if a plan is made and the
+# command would change anything.
+def _is_planned (args, machine):
+    if (_plan is None or _is_read_only (args)):
+        return False
+    plan_operation (str (CommandLine (args)), machine = machine)
+    return True
+
+
+
+# Returns the name of a machine for log messages and plans.
+def _machine_name_of (machine):
+    return getattr (machine, 'host', 'localhost') if machine is not None else 'localhost'
+
+
+
+# Kills a process that has been started by exec_cmd_async() together with
+# all processes it started itself. This kills the local ssh client of a
+# remote command, but not the command on the remote machine: without a
+# terminal (ssh -tt) the remote side does not notice that the client is
+# gone until it writes to it.
+def _kill_process (proc):
+    try:
+        os.killpg (proc.pid, signal.SIGKILL)
+    except OSError:
+        proc.kill()
+
+
+
+# Returns the name of the machine a command wrapper runs on, for tracing.
+def _machine_name (cmd):
+    # Commands with redirected stdin wrap the actual command.
+    cmd = getattr (cmd, 'cmd', cmd)
+    return _machine_name_of (getattr (cmd, 'remote', None))
+
+
+
+# Executes a command wrapper as created by mk_cmd() without blocking the
+# event loop. If the command does not finish within 'timeout' seconds, or
+# the coroutine is cancelled, the process is killed and the exception
+# (asyncio.TimeoutError or asyncio.CancelledError) is raised.
+async def exec_cmd_async (cmd, *, timeout = None):
+    global _env
+
+    write_log ('Executing command \'{0}\'', LogLevel.INFO, cmd)
+
+    # Each command gets a session of its own, so we can kill it together
+    # with its children without touching our own process group.
+    machineName = _machine_name (cmd)
+    startTime = time.monotonic()
+    proc = cmd.popen (env = _env, start_new_session = True)
+    loop = asyncio.get_running_loop()
+    with tracing.span ('exec_cmd_async', machine = machineName, command = cmd) as spanArgs:
+        # The worker thread reaps the process, also after it has been killed.
+        waiting = loop.run_in_executor (None, _wait_for_process, proc, cmd, machineName, startTime)
+        try:
+            res = await asyncio.wait_for (asyncio.shield (waiting), timeout)
+        except BaseException:
+            write_log ('Killing command \'{0}\'', LogLevel.WARNING, cmd)
+            _kill_process (proc)
+            await asyncio.wait ([waiting])
+            spanArgs['returncode'] = 'killed'
+            raise
+        spanArgs['returncode'] = res.returncode
+
+    return res
+
+
+
+# This is the asynchronous version of run_cmd(), see exec_cmd_async().
+async def run_cmd_async (args, *, machine = None, stdin = None, timeout = None):
+    if (_is_planned (args, machine)):
+        return ProcessResult (0, '', '')
+    cmd = mk_cmd (args, machine = machine, stdin = stdin)
+    return await exec_cmd_async (cmd, timeout = timeout)
+
+
+
+# Runs independent commands concurrently, but never more than 'limit' at a
+# time. Each command is either a list of arguments, or a tuple of a list
+# of arguments and the machine to run it on. The results are returned in
+# the order of the commands. If one of the commands raises an exception,
+# all other commands are cancelled and their processes killed.
+async def run_cmd_many (commands, *, machine = None, limit = default_concurrency, timeout = None):
+    semaphore = asyncio.Semaphore (limit)
+
+    async def run_one (command):
+        args, cmdMachine = command if isinstance (command, tuple) else (command, machine)
+        async with semaphore:
+            return await run_cmd_async (args, machine = cmdMachine, timeout = timeout)
+
+    tasks = [asyncio.ensure_future (run_one (c)) for c in commands]
+    try:
+        return await asyncio.gather (*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather (*tasks, return_exceptions = True)
+        raise
+
+
+
+# Runs independent commands concurrently from synchronous code, see
+# run_cmd_many(). The event loops of asyncio cannot be nested, so if this is
+# called from within a running event loop, the commands run in an event
+# loop of their own in another thread. The calling loop is blocked until
+# they are done; coroutines should await run_cmd_many() instead.
+def run_cmds (commands, *, machine = None, limit = default_concurrency, timeout = None):
+    run = lambda: asyncio.run (run_cmd_many (commands, machine = machine, limit = limit, timeout = timeout))
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return run()
+    with concurrent.futures.ThreadPoolExecutor (max_workers = 1) as pool:
+        return pool.submit (run).result()
+
+
+
+# Returns the directory btrcp keeps its state in, e.g. the history of the
+# runs: 'btrcp' below $XDG_STATE_HOME, which defaults to ~/.local/state.
+def state_dir():
+    return os.path.join (os.environ.get ('XDG_STATE_HOME', os.path.join (os.path.expanduser ('~'), '.local', 'state')), 'btrcp')
+
+
+
+# Writes a local file atomically. The with-block writes to a temporary file
+# next to it, which replaces the file once the block is done, so a reader
+# sees either the old or the complete new file. If the block fails, the
+# file is left as it is. 'sync' flushes the data to the disk before the
+# file is replaced, 'makeDirs' creates the directory of the file.
+@contextlib.contextmanager
+def atomic_write (fileName, mode = 'w', *, errors = None, sync = False, makeDirs = False):
+    directory = os.path.dirname (fileName)
+    if (makeDirs and directory):
+        os.makedirs (directory, exist_ok = True)
+    tmpFile = fileName + '.tmp'
+    try:
+        with open (tmpFile, mode, encoding = None if 'b' in mode else 'UTF-8', errors = errors) as f:
+            yield f
+            if (sync):
+                f.flush()
+                os.fsync (f.fileno())
+        os.replace (tmpFile, fileName)
+    except BaseException:
+        try:
+            os.unlink (tmpFile)
+        except OSError:
+            pass
+        raise
+
+
+
 # Copies via scp from src to dst.
 # NOTE that both parameters must be instances of plumbum.Path
 def scp (src, dst):
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+
+# This module splits the sources of an archive backup (strategy 1) into
+# shards of about the same size, which are written as separate archives by
+# parallel tar processes. The shards of one backup form a set, which is a
+# directory named after the timestamp of the backup:
+#
+#   host/2022-01-01-12-00.shards/shard-001.tar.gz
+#   host/2022-01-01-12-00.shards/shard-002.tar.gz
+#   host/2022-01-01-12-00.shards/shards
+#
+# The file 'shards' lists the members of each shard. It has a header line
+#
+#   btrcp-shards 1
+#
+# followed by a line 'S <shard file>' for each shard, and a line 'M <name>'
+# for each member of that shard, where the name is the member name in the
+# archive with backslashes and line breaks escaped. With this list, single
+# files can be restored from the shards that hold them.
+
+
+
+import os
+import filters
+import manifest
+from runcmdutils import write_log, LogLevel, mk_cmd
+
+
+
+# The suffix of the directory of a set of shards.
+set_suffix = '.shards'
+
+# The name of the file listing the members of the shards.
+list_name = 'shards'
+
+# The magic string and format version at the beginning of each list.
+_listMagic = 'btrcp-shards'
+_listVersion = '1'
+
+
+
+# Returns the file name of a shard, counting from 1.
+def shard_file_name (number):
+    return 'shard-{0:03d}.tar.gz'.format (number)
+
+
+
+# Splits the files into shares of about the same size. The largest files
+# are handed out first, each one to the share that is the smallest so far.
+# Each file is a tuple of its size and its path.
+def split_into_shares (files, count):
+    shares = [(0, []) for i in range (count)]
+    for size, path in sorted (files, reverse = True):
+        idx = min (range (count), key = lambda i: shares[i][0])
+        total, share = shares[idx]
+        share.append (path)
+        shares[idx] = (total + size, share)
+    return [share for total, share in shares if share]
+
+
+
+# Lists the entries of the local source directories. Returns a tuple of a
+# list of (size, path) tuples for all entries that are not directories,
+# and a list of all directories, with absolute paths. Returns None if the
+# sources cannot be listed.
+def list_sources (sourceDirs):
+    args = ['find'] + [str (s) for s in sourceDirs] + ['-printf', '%y %s %p\\0']
+    res = mk_cmd (args).run (retcode = None)
+    if (res[0] != 0):
+        write_log ('Listing the sources failed: {0}'.format (res[2]), LogLevel.ERROR)
+        return None
+    files = []
+    dirs = []
+    for record in res[1].split ('\0'):
+        if (not record):
+            continue
+        kind, size, path = record.split (' ', 2)
+        if (kind == 'd'):
+            dirs.append (path)
+        else:
+            files.append ((int (size), path))
+    return (files, dirs)
+
+
+
+# Splits the sources into at most 'count' shares of about the same size.
+# The directories are added to the first share, so that their metadata is
+# archived once. Paths excluded by the rules or the ignore files of the
+# sources are left out. Returns a list of lists of absolute paths, or None.
+def split_sources (sourceDirs, count, *, excludes = []):
+    listing = list_sources (sourceDirs)
+    if (listing is None):
+        return None
+    pathFilter = filters.PathFilter (excludes)
+    def included (path, isDir):
+        root = next ((s for s in sourceDirs if path == s or path.startswith (os.path.join (s, ''))), path)
+        return not pathFilter.is_excluded (path, root, isDir = isDir)
+    files = [f for f in listing[0] if included (f[1], False)]
+    dirs = [d for d in listing[1] if included (d, True)]
+    shares = split_into_shares (files, count) or [[]]
+    shares[0] = dirs + shares[0]
+    return shares
+
+
+
+# Returns the member name tar gives to a path.
+def member_name (path):
+    return path.lstrip (os.sep)
+
+
+
+# Formats the list of the members of the shards, given as a list of tuples
+# of the file name of each shard and the paths it holds.
+def format_list (shards):
+    lines = ['{0} {1}'.format (_listMagic, _listVersion)]
+    for name, paths in shards:
+        lines.append ('S {0}'.format (name))
+        lines.extend (['M {0}'.format (manifest._escape (member_name (p))) for p in paths])
+    return '\n'.join (lines) + '\n'
+
+
+
+# Parses the list of the members of the shards. Returns a list of tuples
+# of the file name of each shard and the member names it holds.
+def parse_list (text):
+    lines = text.split ('\n')
+    header = lines[0].split (' ')
+    if (len (header) != 2 or header[0] != _listMagic or header[1] != _listVersion):
+        raise manifest.ManifestError ('The list of shards has no valid header.')
+    shards = []
+    for line in lines[1:]:
+        if (line.startswith ('S ')):
+            shards.append ((line[2:], []))
+        elif (line.startswith ('M ') and shards):
+            shards[-1][1].append (manifest._unescape (line[2:]))
+    return shards
+
+
+
+# Selects the shards to restore the paths from. Returns a list of tuples
+# of the file name of each shard holding members at or below one of the
+# paths, and those of the paths it holds, so that tar is not asked for
+# members a shard does not have. All shards are selected with an empty
+# list of paths if no paths are given.
+def select_shards (shards, paths):
+    if (not paths):
+        return [(name, []) for name, members in shards]
+    selection = []
+    for name, members in shards:
+        held = [p for p in paths if _holds (members, p.strip ('/'))]
+        if (held):
+            selection.append ((name, held))
+    return selection
+
+
+
+def _holds (members, path):
+    return any ([m == path or m.startswith (path + '/') for m in members])
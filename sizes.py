@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+
+# This module keeps the sizes of the backups of a host, so that they are
+# taken from metadata instead of walking the backups or their sources. The
+# sizes are kept in the file '.btrcp-sizes' of each host directory, as a
+# JSON object which maps the name of each backup to its sizes, e.g.
+#
+#   {"2022-01-01-12-00": {"exclusive": 52428800, "id": 257, "referenced": 1073741824, "transferred": 52428800}}
+#
+# 'referenced' is the amount of data the backup refers to, 'exclusive' the
+# amount of data only the backup refers to, which is freed when it is
+# removed, and 'transferred' the amount of data that has been copied to
+# create it. Sizes which are not known are left out.
+#
+# The sizes of snapshots are read from the quota groups of BTRFS, if quotas
+# are enabled on the destination; 'id' is the id of the subvolume of the
+# snapshot. Without quotas, the sizes of a snapshot are estimated from the
+# statistics of rsync when it is created: what has been copied is exclusive
+# to the new snapshot. An archive refers to exactly its own data.
+
+
+
+import json
+from runcmdutils import write_log, LogLevel
+
+
+
+# The name of the file with the sizes of the backups of a host.
+sizes_file_name = '.btrcp-sizes'
+
+
+
+# Returns the sizes of the backups from the contents of a sizes file.
+# Contents which cannot be parsed are ignored, the sizes are measured again
+# by the next backups.
+def parse_sizes (text):
+    try:
+        backupSizes = json.loads (text)
+    except ValueError as e:
+        write_log ('The sizes of the backups cannot be read: {0}'.format (e), LogLevel.WARNING)
+        return {}
+    if (not isinstance (backupSizes, dict)):
+        return {}
+    return {name: s for name, s in backupSizes.items() if isinstance (s, dict)}
+
+
+
+def format_sizes (backupSizes):
+    return json.dumps (backupSizes, sort_keys = True, indent = 1) + '\n'
+
+
+
+# Returns the referenced and exclusive sizes of the subvolumes from the
+# output of 'btrfs qgroup show --raw', by subvolume id. Only the quota
+# groups of level 0 belong to a single subvolume.
+def parse_qgroups (output):
+    qgroups = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if (len (fields) < 3 or not fields[0].startswith ('0/')):
+            continue
+        try:
+            qgroups[int (fields[0][2:])] = (int (fields[1]), int (fields[2]))
+        except ValueError:
+            continue
+    return qgroups
+
+
+
+
+# The number of most recent backups the size of the next backup is
+# estimated from.
+estimate_backups = 5
+
+
+
+# Estimates the size of the next backup as the largest value of 'key' of
+# the most recent backups, e.g. 'transferred' for snapshots, which grow by
+# what is copied into them, or 'referenced' for archives. Returns 0 if none
+# of them is known.
+def estimate_next (backupSizes, key):
+    recent = [backupSizes[name].get (key) for name in sorted (backupSizes)[-estimate_backups:]]
+    return max ([s for s in recent if s is not None], default = 0)
+
+
+
+# Estimates how much space the backups take together. The data the
+# snapshots share is counted once, with the most recent backup, which
+# refers to all of its data; each older backup adds its exclusive data.
+# Unknown sizes count as 0.
+def used_size (backupSizes):
+    if (not backupSizes):
+        return 0
+    newest = backupSizes[max (backupSizes)]
+    exclusive = sum ([s.get ('exclusive', 0) for s in backupSizes.values()])
+    return exclusive + max (0, newest.get ('referenced', 0) - newest.get ('exclusive', 0))
@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# The modules of btrcp live in the root folder of the repository.
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), '..'))
@@ -0,0 +1,68 @@
+import gzip
+import os
+import pytest
+import tarfile
+
+import archive
+import encryption
+import runcmdutils
+
+
+def test_extract_single_members_from_seekable_archive (tmp_path):
+    source = tmp_path / 'src'
+    (source / 'dir').mkdir (parents = True)
+    for i in range (50):
+        (source / 'dir' / 'f{0}'.format (i)).write_bytes (os.urandom (10000))
+    archiveFile = tmp_path / 'a.tar.gz'
+    assert archive.create_seekable_archive (runcmdutils.Path (str (archiveFile)), [str (source)], frameSize = 32768) == 0
+
+    frames, members = archive.read_index (archive.index_file_of (str (archiveFile)))
+    assert len (frames) > 1
+    with gzip.open (str (archiveFile)) as f, tarfile.open (fileobj = f, mode = 'r|') as tar:
+        assert [m.name for m in tar] == [m.name for m in members]
+
+    name = str (source / 'dir' / 'f42').lstrip ('/')
+    assert archive.extract (str (archiveFile), [name], str (tmp_path / 'out')) == 1
+    assert (tmp_path / 'out' / name).read_bytes() == (source / 'dir' / 'f42').read_bytes()
+
+
+def test_hard_links_are_extracted_without_their_targets (tmp_path):
+    source = tmp_path / 'src'
+    (source / 'a' / 'b').mkdir (parents = True)
+    (source / 'hard').write_bytes (os.urandom (100000))
+    os.link (str (source / 'hard'), str (source / 'a' / 'b' / 'small'))
+    os.link (str (source / 'hard'), str (source / 'a' / 'other'))
+    archiveFile = tmp_path / 'a.tar.gz'
+    assert archive.create_seekable_archive (runcmdutils.Path (str (archiveFile)), [str (source)], frameSize = 32768) == 0
+    base = str (source).lstrip ('/')
+
+    out = tmp_path / 'out'
+    assert archive.extract (str (archiveFile), [base + '/a/b/small'], str (out)) == 1
+    assert (out / base / 'a' / 'b' / 'small').read_bytes() == (source / 'hard').read_bytes()
+
+    # Both links get the data, and are linked to each other.
+    out = tmp_path / 'out-dir'
+    archive.extract (str (archiveFile), [base + '/a'], str (out))
+    small = out / base / 'a' / 'b' / 'small'
+    assert small.read_bytes() == (source / 'hard').read_bytes()
+    assert os.path.samefile (str (small), str (out / base / 'a' / 'other'))
+    assert not (out / base / 'hard').exists()
+
+
+def test_encrypted_seekable_archive (tmp_path):
+    pytest.importorskip ('cryptography')
+    source = tmp_path / 'src'
+    source.mkdir()
+    for i in range (20):
+        (source / 'f{0}'.format (i)).write_bytes (os.urandom (10000))
+    key = os.urandom (encryption.key_size)
+    archiveFile = tmp_path / 'a.tar.gz'
+    assert archive.create_seekable_archive (runcmdutils.Path (str (archiveFile)), [str (source)], frameSize = 32768, key = key) == 0
+    assert encryption.is_encrypted (str (archiveFile)) and encryption.is_encrypted (archive.index_file_of (str (archiveFile)))
+
+    with pytest.raises (encryption.EncryptionError):
+        archive.list_members (str (archiveFile))
+    name = str (source / 'f13').lstrip ('/')
+    assert name in [m.name for m in archive.list_members (str (archiveFile), key = key)]
+    assert archive.extract (str (archiveFile), [name], str (tmp_path / 'out'), key = key) == 1
+    assert (tmp_path / 'out' / name).read_bytes() == (source / 'f13').read_bytes()
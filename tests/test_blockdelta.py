@@ -0,0 +1,52 @@
+import os
+import shutil
+
+import blockdelta
+
+
+def test_sync_file_writes_only_changed_blocks (tmp_path):
+    blockSize = 4096
+    source = tmp_path / 'src' / 'disk.img'
+    source.parent.mkdir()
+    source.write_bytes (os.urandom (blockSize * 10 + 100))
+    first = str (tmp_path / 'b1' / 'disk.img')
+    blocks1 = blockdelta.blocks_dir_of (str (tmp_path / 'b1'))
+    index1 = blockdelta.index_file_of (blocks1, 'disk.img')
+
+    # Without a previous backup the whole file is written.
+    assert blockdelta.sync_file (str (source), first, index1, index1, blockSize = blockSize) == blockSize * 10 + 100
+    assert open (first, 'rb').read() == source.read_bytes()
+    assert blockdelta.is_unchanged (str (source), first, index1, blockSize = blockSize)
+
+    # The second backup starts as a copy of the first one, and only gets
+    # the changed and appended blocks.
+    second = str (tmp_path / 'b2' / 'disk.img')
+    os.makedirs (os.path.dirname (second))
+    shutil.copy2 (first, second)
+    index2 = blockdelta.index_file_of (blockdelta.blocks_dir_of (str (tmp_path / 'b2')), 'disk.img')
+    with open (source, 'r+b') as f:
+        f.seek (blockSize * 3 + 5)
+        f.write (b'changed')
+        f.seek (0, os.SEEK_END)
+        f.write (os.urandom (blockSize))
+    assert blockdelta.sync_file (str (source), second, index1, index2, blockSize = blockSize) == blockSize * 2 + 100
+    assert open (second, 'rb').read() == source.read_bytes()
+    assert os.stat (second).st_mtime_ns == os.stat (source).st_mtime_ns
+
+    # An unchanged file is not written at all.
+    assert blockdelta.sync_file (str (source), second, index2, index2, blockSize = blockSize) == 0
+
+
+def test_sync_file_without_index_compares_with_backup (tmp_path):
+    blockSize = 4096
+    source = tmp_path / 'disk.img'
+    source.write_bytes (os.urandom (blockSize * 4))
+    dest = tmp_path / 'backup.img'
+    data = bytearray (source.read_bytes())
+    data[blockSize * 2] ^= 0xff
+    dest.write_bytes (bytes (data) + b'tail')
+    index = str (tmp_path / 'disk.img.blk')
+
+    assert blockdelta.sync_file (str (source), str (dest), index, index, blockSize = blockSize) == blockSize
+    assert dest.read_bytes() == source.read_bytes()
+    assert blockdelta.read_index (index).digests == blockdelta.hash_blocks (str (source), blockSize = blockSize)
@@ -1,7 +1,164 @@
+import datetime
 
 import pytest
 
+import btrcp
+import runcmdutils
+import sizes
+
 
 def test_test():
     assert 1 == 1
 
+
+class _FakeResult:
+    def __init__ (self, returncode, stdout):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = ''
+
+
+def test_btrfs_find_new_parses_paths (monkeypatch):
+    out = ('inode 257 file offset 0 len 4096 disk start 0 offset 0 gen 12 flags INLINE etc/hosts\n'
+           'inode 258 file offset 0 len 8192 disk start 13631488 offset 0 gen 13 flags NONE home/a file with spaces\n'
+           'transid marker was 13\n')
+    monkeypatch.setattr (btrcp, 'run_cmd', lambda args, machine = None: _FakeResult (0, out))
+    paths = btrcp._btrfs_find_new (runcmdutils.Path ('/src'), 11)
+    assert paths == {'etc/hosts', 'home/a file with spaces'}
+    assert btrcp._btrfs_subvolume_generation (runcmdutils.Path ('/src')) == 13
+
+
+def test_parse_rsync_stats():
+    out = ('Number of files: 1,305 (reg: 1,200, dir: 105)\n'
+           'Number of created files: 12\n'
+           'Number of regular files transferred: 1,021\n'
+           'Total file size: 98,765,432 bytes\n'
+           'Total transferred file size: 12,345,678 bytes\n')
+    assert btrcp._parse_rsync_stats (out) == (12345678, 1021)
+    assert btrcp._parse_rsync_stats ('') == (0, 0)
+    assert btrcp._parse_rsync_total_size (out) == 98765432
+    assert btrcp._parse_rsync_total_size ('') is None
+
+
+def test_plan_lists_changes_without_executing(tmp_path):
+    target = tmp_path / 'created'
+    runcmdutils.start_plan()
+    try:
+        res = runcmdutils.run_cmd (['mkdir', str (target)])
+        probe = runcmdutils.run_cmd (['stat', '-c', '%F', str (tmp_path)])
+    finally:
+        plan = runcmdutils.finish_plan()
+    assert res.returncode == 0 and not target.exists()
+    assert probe.stdout.strip() == 'directory'
+    assert plan.operations == [('localhost', 'mkdir {0}'.format (target))]
+
+
+def test_retention_keeps_one_backup_per_period_of_a_long_history():
+    now = datetime.datetime.now().replace (minute = 0, second = 0, microsecond = 0)
+    files = [('b{0}'.format (i), now - datetime.timedelta (hours = 12 * i)) for i in range (20000)]
+    groups = btrcp._mk_delta_groups (files)
+    assert [delta for delta, grp in groups] == [btrcp.Deltas.Day, btrcp.Deltas.Week, btrcp.Deltas.Month, btrcp.Deltas.Year, None]
+    for delta, grp in groups:
+        removed = {f for f, t in btrcp._find_unretained_files (grp, delta)}
+        retained = [(f, t) for f, t in grp if f not in removed]
+        periods = [btrcp._ctime_to_delta_string (t, delta) for f, t in retained]
+        # One backup is retained per period, and it is the oldest one.
+        assert len (periods) == len (set (periods))
+        if (delta == btrcp.Deltas.Day):
+            assert all ([t.hour == min ([u.hour for g, u in grp if btrcp._ctime_to_delta_string (u, delta) == p]) for (f, t), p in zip (retained, periods)])
+
+
+def test_make_room_removes_the_oldest_backups_within_the_budget (tmp_path, monkeypatch):
+    names = ['2020-01-01-00-00.tar.gz', '2020-02-01-00-00.tar.gz', '2020-03-01-00-00.tar.gz', datetime.datetime.now().strftime ('%Y-%m-%d-%H-%M.tar.gz')]
+    for name in names:
+        (tmp_path / name).write_bytes (b'x')
+    (tmp_path / sizes.sizes_file_name).write_text (sizes.format_sizes ({name: {'referenced': 100, 'exclusive': 100} for name in names}))
+    hostDir = runcmdutils.Path (str (tmp_path))
+
+    # 400 bytes are used, the next archive takes about 100 more. The first
+    # backup of 2020 is kept by the retention plan.
+    monkeypatch.setattr (btrcp.env, 'host_budget', 300)
+    assert btrcp._make_room (hostDir, ['*.tar.gz'], estimateKey = 'referenced')
+    assert sorted ([p.name for p in tmp_path.glob ('*.tar.gz')]) == [names[0], names[3]]
+    assert sorted (sizes.parse_sizes ((tmp_path / sizes.sizes_file_name).read_text())) == [names[0], names[3]]
+
+    # Neither the kept nor the most recent backup is removed.
+    monkeypatch.setattr (btrcp.env, 'host_budget', 50)
+    assert not btrcp._make_room (hostDir, ['*.tar.gz'], estimateKey = 'referenced')
+    assert sorted ([p.name for p in tmp_path.glob ('*.tar.gz')]) == [names[0], names[3]]
+
+
+def test_make_room_checks_the_free_space_again (tmp_path, monkeypatch):
+    names = ['2020-0{0}-01-00-00.tar.gz'.format (i) for i in range (1, 6)] + [datetime.datetime.now().strftime ('%Y-%m-%d-%H-%M.tar.gz')]
+    for name in names:
+        (tmp_path / name).write_bytes (b'x')
+    (tmp_path / sizes.sizes_file_name).write_text (sizes.format_sizes ({name: {'referenced': 100, 'exclusive': 100} for name in names}))
+    hostDir = runcmdutils.Path (str (tmp_path))
+
+    # Each removal frees much less than its estimated exclusive size.
+    monkeypatch.setattr (btrcp, '_free_space', lambda path: (40 + 10 * (len (names) - len (list (tmp_path.glob ('*.tar.gz')))), 1000))
+    monkeypatch.setattr (btrcp.env, 'min_free_percent', 10)
+    assert not btrcp._make_room (hostDir, ['*.tar.gz'], estimateKey = 'referenced')
+    assert sorted ([p.name for p in tmp_path.glob ('*.tar.gz')]) == [names[0], names[-1]]
+
+    monkeypatch.setattr (btrcp, '_free_space', lambda path: (1000, 1000))
+    assert btrcp._make_room (hostDir, ['*.tar.gz'], estimateKey = 'referenced')
+
+
+def test_source_snapshots_freeze_each_subvolume_once (monkeypatch):
+    calls = []
+    monkeypatch.setattr (btrcp, '_find_btrfs_subvolume_root', lambda path: runcmdutils.Path ('/data'))
+    monkeypatch.setattr (btrcp, '_mkdir', lambda path: calls.append (('mkdir', path.path)) or 0)
+    monkeypatch.setattr (btrcp, '_create_btrfs_snapshot', lambda subvol, snapshot, readOnly = False: calls.append (('snapshot', subvol.path, snapshot.path, readOnly)) or 0)
+    monkeypatch.setattr (btrcp, '_delete_btrfs_subvolume', lambda path: calls.append (('delete', path.path)) or 0)
+    monkeypatch.setattr (btrcp, '_rm', lambda path, is_folder = False: calls.append (('rm', path.path)) or 0)
+    view = '/data/' + btrcp._source_snapshot_name()
+
+    sources = [runcmdutils.Path ('/data/home'), runcmdutils.Path ('/data/etc/hosts')]
+    with btrcp._source_snapshots (sources) as views:
+        assert calls == [('mkdir', view), ('snapshot', '/data', view + '/data', True)]
+        assert btrcp._frozen_path (sources[0], sources[0], views).path == view + '/data/home'
+        assert btrcp._frozen_path (sources[1], sources[1], views, relative = True).path == view + '/./data/etc/hosts'
+        assert btrcp._frozen_path (sources[0], sources[0], {}) == sources[0]
+    assert calls[2:] == [('delete', view + '/data'), ('rm', view)]
+
+
+def test_transfer_basis_tells_identical_destinations (tmp_path):
+    assert btrcp._transfer_basis (None) == ('', None)
+    backups = []
+    for dest in ['a', 'b']:
+        backup = tmp_path / dest / 'host' / '2022-01-01-12-00'
+        backup.mkdir (parents = True)
+        backups.append (runcmdutils.Path (str (backup)))
+    # Without manifests, the trees cannot be compared.
+    assert btrcp._transfer_basis (backups[0]) is None
+    for backup, hashValue in zip (backups, ['0', '0']):
+        (tmp_path / (backup.path + '.manifest')).write_text ('btrcp-manifest 1 sha256\n{0} 1 0 file\n'.format (hashValue))
+    assert btrcp._transfer_basis (backups[0]) == btrcp._transfer_basis (backups[1])
+    (tmp_path / (backups[1].path + '.manifest')).write_text ('btrcp-manifest 1 sha256\n1 1 0 file\n')
+    assert btrcp._transfer_basis (backups[0]) != btrcp._transfer_basis (backups[1])
+
+
+def test_parse_tar_listing_counts_regular_files():
+    listing = ('drwxr-xr-x 0/0               0 2022-01-01 12:00 src/\n'
+               '-rw-r--r-- 0/0               6 2022-01-01 12:00 src/a\n'
+               'lrwxrwxrwx 0/0               0 2022-01-01 12:00 src/l -> a\n'
+               '-rw-r--r-- 0/0            3000 2022-01-01 12:00 src/sub/with space\n'
+               'hrw-r--r-- 0/0               0 2022-01-01 12:00 src/h link to src/a\n'
+               'crw-rw-rw- 0/0             1,3 2022-01-01 12:00 src/null\n')
+    assert btrcp._parse_tar_listing (listing) == (3006, 2)
+
+
+def test_unencrypted_strategies_warn_once_the_strategy_is_chosen (tmp_path, monkeypatch):
+    warnings = []
+    monkeypatch.setattr (btrcp, 'write_log', lambda msg, level = None, *args: warnings.append (msg) if level == runcmdutils.LogLevel.WARNING else None)
+    monkeypatch.setattr (btrcp.env, 'encryption_key', b'k' * 32)
+    monkeypatch.setattr (btrcp.env, 'history_file', str (tmp_path / 'history.jsonl'))
+    monkeypatch.setattr (btrcp.env, 'metrics_file', None)
+    monkeypatch.setattr (btrcp, '_find_best_backup_strategy', lambda dest: 2)
+    for strategy in [1, 2]:
+        monkeypatch.setattr (btrcp, 'backup_strategy_{0}'.format (strategy), lambda *args, **kwargs: True)
+    btrcp.backup ('host', [str (tmp_path)], str (tmp_path), strategy = 1)
+    assert not [w for w in warnings if 'in the clear' in w]
+    btrcp.backup ('host', [str (tmp_path)], str (tmp_path))
+    assert [w for w in warnings if 'in the clear' in w]
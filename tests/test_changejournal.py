@@ -0,0 +1,64 @@
+import changejournal
+
+
+def _write_journal (path, session, segment, records):
+    data = changejournal._mk_header (session, segment).encode ('UTF-8') + b'\0'
+    data += b''.join ([r.encode ('UTF-8') + b'\0' for r in records])
+    path.write_bytes (data)
+
+
+def test_read_changes_needs_full_scan_without_state (tmp_path):
+    journal = tmp_path / 'journal'
+    _write_journal (journal, 'abc', 0, ['/src/a'])
+    changes, cursor = changejournal.read_changes (str (journal))
+    assert changes is None
+    assert cursor.session == 'abc'
+
+
+def test_read_changes_returns_uncommitted_paths (tmp_path):
+    journal = tmp_path / 'journal'
+    _write_journal (journal, 'abc', 0, ['/src/a'])
+    _, cursor = changejournal.read_changes (str (journal))
+    changejournal.commit_changes (cursor)
+    _write_journal (journal, 'abc', 0, ['/src/a', '/src/b', '/src/b'])
+    changes, _ = changejournal.read_changes (str (journal))
+    assert changes == {'/src/b'}
+
+
+def test_read_changes_falls_back_on_overflow_and_restart (tmp_path):
+    journal = tmp_path / 'journal'
+    _write_journal (journal, 'abc', 0, [])
+    _, cursor = changejournal.read_changes (str (journal))
+    changejournal.commit_changes (cursor)
+    _write_journal (journal, 'abc', 0, ['/src/a', changejournal._overflowMarker])
+    assert changejournal.read_changes (str (journal))[0] is None
+    _write_journal (journal, 'def', 0, ['/src/a'])
+    assert changejournal.read_changes (str (journal))[0] is None
+
+
+def test_changes_below ():
+    changes = {'/src/dir/b', '/src/dir/a/c', '/src/dirx', '/other'}
+    assert changejournal.changes_below (changes, '/src/dir/') == ['a/c', 'b']
+
+
+def test_change_after_a_commit_is_recorded_again (tmp_path):
+    journal = str (tmp_path / 'journal')
+    writer = changejournal.JournalWriter ([str (tmp_path)], journal)
+    writer._start_segment()
+    writer._watches[1] = '/src'
+    event = changejournal._eventHeader.pack (1, changejournal.IN_MODIFY, 0, 16) + b'a'.ljust (16, b'\0')
+    # Repeated events of one batch are recorded once.
+    writer._process_events (event + event)
+    writer._journal.flush()
+    _, cursor = changejournal.read_changes (journal)
+    changejournal.commit_changes (cursor)
+    assert changejournal.read_changes (journal)[0] == set()
+
+    # The file changes again after the backup read the journal: it is
+    # recorded again and the segment is not rotated away.
+    writer._process_events (event)
+    writer._journal.flush()
+    writer._maybe_rotate()
+    assert writer.segment == 0
+    assert changejournal.read_changes (journal)[0] == {'/src/a'}
+    writer._journal.close()
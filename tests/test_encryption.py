@@ -0,0 +1,50 @@
+import io
+import os
+import pytest
+
+import encryption
+
+pytest.importorskip ('cryptography')
+
+
+def _encrypt (data, key, chunkSize):
+    sink = io.BytesIO()
+    encryption.encrypt_stream (io.BytesIO (data), sink, key, chunkSize = chunkSize, workers = 3, readSize = 333)
+    return sink.getvalue()
+
+
+def test_chunks_decrypt_in_order_and_at_random():
+    key = os.urandom (encryption.key_size)
+    for size in [0, 1, 1024, 1025, 5000]:
+        data = os.urandom (size)
+        encrypted = _encrypt (data, key, 1024)
+        plain = io.BytesIO()
+        encryption.decrypt_stream (io.BytesIO (encrypted), plain, key, workers = 2)
+        assert plain.getvalue() == data
+        reader = encryption.Reader (io.BytesIO (encrypted), key)
+        assert reader.size == size
+        reader.seek (size // 2)
+        assert reader.read (1500) == data[size // 2 : size // 2 + 1500]
+
+
+def test_tampering_and_truncation_are_detected():
+    key = os.urandom (encryption.key_size)
+    encrypted = _encrypt (os.urandom (5000), key, 1024)
+    # Cut off the last chunk, flip a bit, and use another key.
+    for data, k in [(encrypted[:-(5000 - 4096) - 16], key), (encrypted[:100] + bytes ([encrypted[100] ^ 1]) + encrypted[101:], key), (encrypted, os.urandom (encryption.key_size))]:
+        with pytest.raises (encryption.EncryptionError):
+            encryption.decrypt_stream (io.BytesIO (data), io.BytesIO(), k)
+    with pytest.raises (encryption.EncryptionError):
+        encryption.Reader (io.BytesIO (encrypted[:-(5000 - 4096) - 16]), key).read()
+
+
+def test_key_files (tmp_path):
+    keyFile = str (tmp_path / 'key')
+    encryption.generate_key (keyFile)
+    assert os.stat (keyFile).st_mode & 0o777 == 0o600
+    assert len (encryption.read_key (keyFile)) == encryption.key_size
+    with pytest.raises (FileExistsError):
+        encryption.generate_key (keyFile)
+    (tmp_path / 'bad').write_text ('not a key\n')
+    with pytest.raises (encryption.EncryptionError):
+        encryption.read_key (str (tmp_path / 'bad'))
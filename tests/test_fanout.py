@@ -0,0 +1,37 @@
+import os
+
+import fanout
+
+
+def test_recording_replays_transfers_in_order():
+    with fanout.recording() as rec:
+        assert fanout.current() is rec
+        # The first destination makes and records all transfers.
+        assert rec.next ('rsync', 'a') is None
+        batch = rec.new_file ('batch')
+        open (batch, 'w').close()
+        rec.record ('rsync', 'a', batch)
+        rec.record ('rsync', 'b', 'batch-b')
+        committed = []
+        rec.defer (lambda: committed.append (True))
+
+        # The next one replays them, a transfer with another key is made
+        # again and recorded in its place.
+        rec.start_destination()
+        assert rec.next ('rsync', 'a') == batch
+        assert rec.next ('rsync', 'c') is None
+        rec.record ('rsync', 'c', 'batch-c')
+        assert rec.next ('rsync', 'b') == 'batch-b'
+        assert [e[1] for e in rec.entries] == ['a', 'c', 'b']
+
+        rec.run_deferred()
+        assert committed == [True]
+    assert fanout.current() is None
+    assert not os.path.exists (batch)
+
+
+def test_recording_keeps_its_files_in_the_given_directory (tmp_path):
+    with fanout.recording (str (tmp_path)) as rec:
+        assert os.path.dirname (rec.new_file ('batch')) == rec.directory
+        assert os.path.dirname (rec.directory) == str (tmp_path)
+    assert os.listdir (tmp_path) == []
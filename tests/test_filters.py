@@ -0,0 +1,63 @@
+import os
+import subprocess
+import filters
+
+
+def test_rules_match_like_rsync():
+    rules = filters.RuleSet ([filters.Rule ('keep.log', include = True), filters.Rule ('*.log'), filters.Rule ('/var/cache'), filters.Rule ('tmp/'), filters.Rule ('a/**/z'), filters.Rule ('file[0-9].txt')])
+    assert rules.is_excluded ('x/y.log')
+    assert not rules.is_excluded ('x/keep.log')
+    assert rules.is_excluded ('var/cache/apt/pkg')
+    assert not rules.is_excluded ('srv/var/cache')
+    # Directory rules only match directories, but exclude their contents.
+    assert rules.is_excluded ('home/tmp/file')
+    assert not rules.is_excluded ('home/tmp')
+    assert rules.is_excluded ('home/tmp', isDir = True)
+    assert rules.is_excluded ('a/b/c/z') and not rules.is_excluded ('b/z')
+    assert rules.is_excluded ('file1.txt') and not rules.is_excluded ('fileA.txt')
+    assert not filters.RuleSet().is_excluded ('anything')
+
+
+def test_literal_pattern_and_files (tmp_path):
+    rules = filters.as_rules ([filters.literal_pattern ('/data/a*[1].img')])
+    assert rules.is_excluded ('data/a*[1].img') and not rules.is_excluded ('data/ab[1].img')
+
+    filterFile = tmp_path / 'filter'
+    filterFile.write_text ('# comment\n+ important.tmp\n- *.tmp\n\n')
+    excludeFile = tmp_path / 'exclude'
+    excludeFile.write_text ('*.bak\n')
+    rules = filters.read_filter_file (str (filterFile)) + filters.read_exclude_file (str (excludeFile)) + ['/proc']
+    assert [str (r) for r in rules.rules] == ['+ important.tmp', '- *.tmp', '- *.bak', '- /proc']
+    with filters.rsync_filter_args (rules) as args:
+        assert open (args[1].split (' ', 1)[1]).read() == '+ important.tmp\n- *.tmp\n- *.bak\n- /proc\n'
+    with filters.tar_exclude_args (rules) as args:
+        assert open (args[1]).read() == '*.tmp\n*.bak\n/proc\n'
+    assert not os.path.exists (args[1])
+
+    # Names that are not UTF-8 are written as they are.
+    with filters.tar_exclude_args (filters.as_rules (['/data/' + os.fsdecode (b'\xff')])) as args:
+        assert open (args[1], 'rb').read() == b'/data/\xff\n'
+
+
+def test_path_filter_reads_ignore_files (tmp_path):
+    (tmp_path / 'src' / 'project' / 'build').mkdir (parents = True)
+    (tmp_path / 'src' / 'project' / filters.ignore_file_name).write_text ('build/\n*.o\n')
+    root = str (tmp_path / 'src')
+    pathFilter = filters.PathFilter (['/skip'])
+    assert pathFilter.is_excluded (root + '/project/build/out', root)
+    assert pathFilter.is_excluded (root + '/project/x/main.o', root)
+    assert not pathFilter.is_excluded (root + '/main.o', root)
+    assert not pathFilter.is_excluded (root + '/project/main.c', root)
+    assert pathFilter.is_excluded (root + '/skip/file', root)
+
+
+def test_tar_applies_ignore_files_to_subdirectories (tmp_path):
+    (tmp_path / 'src' / 'project' / 'sub' / 'deep').mkdir (parents = True)
+    (tmp_path / 'src' / 'project' / filters.ignore_file_name).write_text ('*.o\n')
+    for name in ['main.o', 'main.c', 'sub/deep/x.o', 'sub/deep/x.c']:
+        (tmp_path / 'src' / 'project' / name).write_text ('x')
+    with filters.tar_exclude_args (filters.RuleSet()) as args:
+        listing = subprocess.run (['tar', '-cf', '/dev/null', '--verbose'] + args + ['src'], cwd = tmp_path, capture_output = True, text = True, check = True).stdout
+    files = [line.rstrip ('/') for line in listing.splitlines()]
+    assert 'src/project/main.c' in files and 'src/project/sub/deep/x.c' in files
+    assert 'src/project/main.o' not in files and 'src/project/sub/deep/x.o' not in files
@@ -0,0 +1,37 @@
+import history
+
+
+def test_history_predicts_from_matching_runs(tmp_path):
+    historyFile = str (tmp_path / 'state' / 'history.jsonl')
+    history.append_run (historyFile, {'host': 'a', 'strategy': 2, 'seconds': 10, 'bytes': 1000})
+    history.append_run (historyFile, {'host': 'b', 'strategy': 2, 'seconds': 1, 'bytes': 1000})
+    history.append_run (historyFile, {'host': 'a', 'strategy': 2, 'seconds': 20, 'bytes': 4000})
+    with open (historyFile, 'a') as f:
+        f.write ('not json\n')
+
+    runs = history.read_runs (historyFile, host = 'a', strategy = 2)
+    assert [r['seconds'] for r in runs] == [10, 20]
+    # The median of 100 and 200 bytes per second.
+    assert history.predict_duration (runs, 3000) == 20
+    assert history.predict_duration ([], 3000) is None
+
+
+def test_departing_runs_are_flagged_and_exported():
+    runs = [{'host': 'a', 'strategy': 2, 'destination': '/d', 'started': '2022-01-0{0}T12:00:00'.format (i + 1), 'seconds': s, 'bytes': 1000 * s} for i, s in enumerate ([10, 11, 10, 12, 10])]
+    # Too few runs before to tell, and a run within the baseline.
+    assert history.departures (runs[:2], runs[2]) == {}
+    assert history.departures (runs[:4], runs[4]) == {}
+    slow = dict (runs[-1], started = '2022-01-06T12:00:00', seconds = 40, bytes = 10000, commands = 3, phases = {'_rsync': 39.5})
+    scores = history.departures (runs, slow)
+    assert sorted (scores) == ['duration', 'throughput']
+    assert scores['throughput'] < 0 < scores['duration']
+    assert 'departed: 2022-01-06T12:00:00' in history.format_stats (runs + [slow])
+
+    metrics = history.format_openmetrics (runs + [slow, dict (runs[0], host = 'b"c')])
+    labels = '{host="a",strategy="2",destination="/d"}'
+    assert 'btrcp_last_run_duration_seconds{0} 40\n'.format (labels) in metrics
+    assert 'btrcp_last_run_phase_seconds{host="a",strategy="2",destination="/d",phase="_rsync"} 39.5\n' in metrics
+    assert 'btrcp_last_run_departure{host="a",strategy="2",destination="/d",metric="throughput"} 1\n' in metrics
+    assert 'btrcp_recorded_runs{0} 6\n'.format (labels) in metrics
+    assert 'host="b\\"c"' in metrics
+    assert metrics.endswith ('# EOF\n')
@@ -0,0 +1,55 @@
+import datetime
+
+import linktuning
+import runcmdutils
+
+
+def test_lan_links_copy_whole_files_with_fast_cipher():
+    options = linktuning.choose_rsync_options (0.0004, 110 * 1048576, ['zstd', 'zlib'], cipher = 'aes128-gcm@openssh.com')
+    assert options == ['--whole-file', '-e', 'ssh -c aes128-gcm@openssh.com']
+
+
+def test_wan_links_compress_and_use_delta_transfer():
+    assert linktuning.choose_rsync_options (0.04, 2 * 1048576, ['zstd', 'lz4', 'zlib']) == ['--no-whole-file', '--compress', '--compress-choice=zstd', '--compress-level=3']
+    assert linktuning.choose_rsync_options (0.04, 20 * 1048576, ['zstd']) == ['--no-whole-file', '--compress', '--compress-choice=zstd', '--compress-level=1']
+    # Without a common algorithm, the level applies to zlib.
+    assert linktuning.choose_rsync_options (0.04, 2 * 1048576, []) == ['--no-whole-file', '--compress', '--compress-level=3']
+
+
+def test_cached_profiles_are_used_until_they_expire(tmp_path, monkeypatch):
+    cacheFile = str (tmp_path / 'links.json')
+    measured = []
+
+    def measure (host, machine):
+        measured.append (host)
+        return linktuning.LinkProfile (0.01, 1048576, datetime.datetime.now(), ['--compress'])
+
+    monkeypatch.setattr (linktuning, 'measure_link', measure)
+    assert linktuning.rsync_options ('u@h', None, cacheFile = cacheFile) == ['--compress']
+    assert linktuning.rsync_options ('u@h', None, cacheFile = cacheFile) == ['--compress']
+    assert measured == ['u@h']
+    linktuning.rsync_options ('u@h', None, cacheFile = cacheFile, maxAgeDays = -1)
+    assert measured == ['u@h', 'u@h']
+
+
+def test_cipher_probe_uses_the_ssh_command_of_the_machine():
+    calls = []
+
+    class Proc:
+        returncode = 0
+        def communicate (self):
+            return ('', '')
+
+    class Machine:
+        def popen (self, args, ssh_opts = ()):
+            calls.append ((args, list (ssh_opts)))
+            return Proc()
+
+    assert linktuning._ssh_supports_cipher (Machine(), 'aes128-gcm@openssh.com')
+    assert calls == [(['true'], ['-o', 'BatchMode=yes', '-c', 'aes128-gcm@openssh.com'])]
+
+
+def test_hosts_are_named_without_a_missing_user():
+    assert runcmdutils.Path ('backup@example.com:/srv').get_host() == 'backup@example.com'
+    assert runcmdutils.Path ('ssh://example.com:2222/srv').get_host() == 'example.com:2222'
+    assert runcmdutils.Path ('/srv').get_host() is None
@@ -0,0 +1,48 @@
+import json
+
+import runcmdutils
+from runcmdutils import LogLevel, write_log
+
+
+class _Counting:
+    def __init__ (self):
+        self.count = 0
+
+    def __str__ (self):
+        self.count += 1
+        return 'value'
+
+
+def test_write_log_formats_lazily_in_listener(tmp_path):
+    logFile = tmp_path / 'log'
+    runcmdutils.add_log_file_handler (str (logFile))
+    try:
+        arg = _Counting()
+        write_log ('skipped {0}', LogLevel.DEBUG, arg)
+        write_log ('written {0} {{braces}}', LogLevel.INFO, arg)
+        write_log ('{not a format}', LogLevel.INFO)
+        runcmdutils.flush_log()
+        assert arg.count == 1
+        lines = logFile.read_text().splitlines()
+        assert lines[0].endswith ('written value {braces}')
+        assert lines[1].endswith ('{not a format}')
+    finally:
+        runcmdutils._set_log_handlers ([h for h in runcmdutils._log_handlers() if getattr (h, 'baseFilename', None) != str (logFile)])
+
+
+def test_json_log_records(tmp_path):
+    logFile = tmp_path / 'log'
+    formatter = runcmdutils._logFormatter
+    runcmdutils.add_log_file_handler (str (logFile))
+    try:
+        runcmdutils.use_json_log_records()
+        write_log ('copied {0} files', LogLevel.WARNING, 3)
+        runcmdutils.flush_log()
+        record = json.loads (logFile.read_text().splitlines()[0])
+        assert record['level'] == 'WARNING'
+        assert record['message'] == 'copied 3 files'
+    finally:
+        runcmdutils._set_log_handlers ([h for h in runcmdutils._log_handlers() if getattr (h, 'baseFilename', None) != str (logFile)])
+        runcmdutils._logFormatter = formatter
+        for h in runcmdutils._log_handlers():
+            h.setFormatter (formatter)
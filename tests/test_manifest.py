@@ -0,0 +1,30 @@
+import manifest
+
+
+def test_verify_detects_changed_and_missing_files (tmp_path):
+    backup = tmp_path / 'backup'
+    (backup / 'dir').mkdir (parents = True)
+    (backup / 'dir' / 'a').write_text ('first')
+    (backup / 'dir' / 'b').write_text ('second')
+    (backup / 'name with\nnewline').write_text ('third')
+    manifestFile = manifest.manifest_file_of (str (backup))
+    manifest.create_manifest (str (backup), manifestFile, workers = 1)
+    assert manifest.verify (str (backup), workers = 1) == []
+
+    (backup / 'dir' / 'a').write_text ('FIRST')
+    (backup / 'dir' / 'b').unlink()
+    problems = dict (manifest.verify (str (backup), workers = 1))
+    assert problems == {'dir/a': 'contents differ', 'dir/b': 'missing'}
+
+
+def test_create_manifest_reuses_unchanged_hashes (tmp_path):
+    backup = tmp_path / 'backup'
+    backup.mkdir()
+    (backup / 'a').write_text ('first')
+    manifestFile = manifest.manifest_file_of (str (backup))
+    manifest.create_manifest (str (backup), manifestFile, workers = 1)
+    algorithm, entries = manifest.read_manifest (manifestFile)
+    entries['a'].hash = 'reused'
+    manifest.write_manifest (manifestFile, entries, algorithm)
+    entries = manifest.create_manifest (str (backup), manifestFile, previousManifest = manifestFile, workers = 1)
+    assert entries['a'].hash == 'reused'
@@ -0,0 +1,201 @@
+import datetime
+import hashlib
+import io
+import itertools
+import btrcp
+import objectstore
+import pytest
+from runcmdutils import Path
+
+
+# Keeps objects and multipart uploads in memory, like an S3 client.
+class FakeClient:
+    def __init__ (self):
+        self.objects = {}
+        self.uploads = {}
+        self.uploadedParts = []
+        self.completed = []
+        self._ids = itertools.count (1)
+
+    def create_multipart_upload (self, Bucket, Key):
+        uploadId = str (next (self._ids))
+        self.uploads[uploadId] = (Key, {})
+        return {'UploadId': uploadId}
+
+    def upload_part (self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploadedParts.append (PartNumber)
+        etag = '"{0}"'.format (hashlib.md5 (Body).hexdigest())
+        self.uploads[UploadId][1][PartNumber] = (etag, Body)
+        return {'ETag': etag}
+
+    def list_parts (self, Bucket, Key, UploadId):
+        parts = self.uploads[UploadId][1]
+        return {'Parts': [{'PartNumber': n, 'ETag': etag, 'Size': len (body)} for n, (etag, body) in sorted (parts.items())]}
+
+    def complete_multipart_upload (self, Bucket, Key, UploadId, MultipartUpload):
+        key, parts = self.uploads.pop (UploadId)
+        self.completed.append (UploadId)
+        assert [p['ETag'] for p in MultipartUpload['Parts']] == [parts[p['PartNumber']][0] for p in MultipartUpload['Parts']]
+        self.objects[key] = b''.join ([parts[p['PartNumber']][1] for p in MultipartUpload['Parts']])
+
+    def abort_multipart_upload (self, Bucket, Key, UploadId):
+        del self.uploads[UploadId]
+
+    def list_multipart_uploads (self, Bucket, Prefix):
+        return {'Uploads': [{'Key': key, 'UploadId': u} for u, (key, _) in self.uploads.items() if key.startswith (Prefix)]}
+
+    def list_objects_v2 (self, Bucket, Prefix, Delimiter = None):
+        keys = sorted ([k for k in self.objects if k.startswith (Prefix)])
+        if (Delimiter is None):
+            return {'Contents': [{'Key': k} for k in keys]}
+        prefixes = sorted (set ([Prefix + k[len (Prefix):].split (Delimiter)[0] + Delimiter for k in keys if Delimiter in k[len (Prefix):]]))
+        return {'Contents': [{'Key': k} for k in keys if Delimiter not in k[len (Prefix):]], 'CommonPrefixes': [{'Prefix': p} for p in prefixes]}
+
+    def put_object (self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def get_object (self, Bucket, Key):
+        return {'Body': io.BytesIO (self.objects[Key])}
+
+    def delete_objects (self, Bucket, Delete):
+        for o in Delete['Objects']:
+            self.objects.pop (o['Key'], None)
+        return {}
+
+
+def test_parse_url():
+    assert objectstore.parse_url ('s3://bucket') == ('bucket', '')
+    assert objectstore.parse_url ('s3://bucket/backups/daily/') == ('bucket', 'backups/daily/')
+    with pytest.raises (objectstore.ObjectStoreError):
+        objectstore.parse_url ('/mnt/backups')
+
+
+def test_multipart_upload_is_resumed_without_sending_uploaded_parts_again():
+    client = FakeClient()
+    bucket = objectstore.Bucket ('s3://bucket/backups', client = client)
+    partSize = objectstore.min_part_size
+    data = bytes (range (256)) * (partSize * 3 // 256) + b'tail'
+
+    # The upload is interrupted after two parts.
+    writer = bucket.open_writer ('host/a.tar.gz', partSize = partSize)
+    writer.write (data[:2 * partSize + 10])
+    writer.close()
+    assert bucket.list_uploads ('host/') == {'host/a.tar.gz': [writer.upload_id]}
+    assert client.objects == {}
+
+    # The same data is written again: only the parts after them are sent.
+    client.uploadedParts = []
+    writer = bucket.open_writer ('host/a.tar.gz', partSize = partSize, uploadId = writer.upload_id)
+    for i in range (0, len (data), 1000000):
+        writer.write (data[i : i + 1000000])
+    writer.complete()
+    assert sorted (client.uploadedParts) == [3, 4]
+    assert writer.skipped_bytes == 2 * partSize
+    assert client.objects['backups/host/a.tar.gz'] == data
+    assert bucket.list_uploads ('host/') == {}
+
+
+def test_empty_stream_is_uploaded_as_one_part():
+    client = FakeClient()
+    bucket = objectstore.Bucket ('s3://bucket', client = client)
+    bucket.open_writer ('host/empty.tar.gz', partSize = objectstore.min_part_size).complete()
+    assert client.objects['host/empty.tar.gz'] == b''
+
+
+def test_backups_are_listed_by_their_names():
+    client = FakeClient()
+    bucket = objectstore.Bucket ('s3://bucket/backups/', client = client)
+    for key in ['host/.btrcp-run', 'host/2022-01-01-12-00.tar.gz', 'host/2022-01-01-12-00.tar.gz.idx', 'host/2022-01-02-12-00.shards/shard-001.tar.gz', 'host/2022-01-02-12-00.shards/shards', 'other/2022-01-03-12-00.tar.gz']:
+        bucket.write_text (key, 'x')
+    names = bucket.list_names ('host/')
+    assert sorted (names) == ['.btrcp-run', '2022-01-01-12-00.tar.gz', '2022-01-01-12-00.tar.gz.idx', '2022-01-02-12-00.shards/']
+    assert objectstore.match_backups (names, ['*.tar.gz', '*.shards']) == ['2022-01-01-12-00.tar.gz', '2022-01-02-12-00.shards']
+    assert bucket.list_keys ('host/2022-01-02-12-00.shards/') == ['host/2022-01-02-12-00.shards/shard-001.tar.gz', 'host/2022-01-02-12-00.shards/shards']
+    assert bucket.read_text ('host/.btrcp-run') == 'x'
+    bucket.delete_keys (bucket.list_keys ('host/'))
+    assert bucket.list_names ('host/') == []
+    assert list (client.objects) == ['backups/other/2022-01-03-12-00.tar.gz']
+
+
+def test_all_uploads_of_a_key_are_listed():
+    client = FakeClient()
+    bucket = objectstore.Bucket ('s3://bucket', client = client)
+    first = bucket.open_writer ('host/a.tar.gz', partSize = objectstore.min_part_size).upload_id
+    second = bucket.open_writer ('host/a.tar.gz', partSize = objectstore.min_part_size).upload_id
+    assert bucket.list_uploads ('host/') == {'host/a.tar.gz': [first, second]}
+
+
+# Starts an upload that is left unfinished, like an interrupted backup.
+def _interrupted_upload (client, key):
+    return client.create_multipart_upload (Bucket = 'bucket', Key = key)['UploadId']
+
+
+@pytest.fixture
+def sources (tmp_path, monkeypatch):
+    for name in ['a', 'b']:
+        (tmp_path / 'src' / name).mkdir (parents = True)
+        (tmp_path / 'src' / name / 'file').write_bytes (name.encode() * 1000)
+    monkeypatch.setattr (btrcp.env, 's3_part_size', objectstore.min_part_size)
+    return [Path (str (tmp_path / 'src'))]
+
+
+def test_interrupted_backup_resumes_the_latest_upload_of_its_archive (sources):
+    client = FakeClient()
+    bucket = objectstore.Bucket ('s3://bucket', client = client)
+    target = '2022-01-01-12-00.tar.gz'
+    bucket.write_text ('host/.btrcp-run', btrcp._format_run_journal ({'strategy': 1, 'phase': 'transfer', 'target': target}))
+    _interrupted_upload (client, 'host/' + target)
+    latest = _interrupted_upload (client, 'host/' + target)
+    # The index of an earlier run with --seekable-archives, and an upload
+    # of another backup.
+    _interrupted_upload (client, 'host/' + target + '.idx')
+    _interrupted_upload (client, 'host/2021-12-31-12-00.tar.gz')
+
+    assert btrcp._backup_to_bucket ('host', sources, bucket, 'host/')
+    assert client.completed == [latest]
+    assert client.uploads == {}
+    assert sorted (client.objects) == ['host/.btrcp-run', 'host/' + target]
+    journal = btrcp._parse_run_journal (bucket.read_text ('host/.btrcp-run'))
+    assert (journal['phase'], journal['target']) == ('complete', target)
+
+
+def test_completed_backup_is_not_resumed (sources):
+    client = FakeClient()
+    bucket = objectstore.Bucket ('s3://bucket', client = client)
+    target = '2022-01-01-12-00.tar.gz'
+    bucket.write_text ('host/.btrcp-run', btrcp._format_run_journal ({'strategy': 1, 'phase': 'complete', 'target': target}))
+    stale = _interrupted_upload (client, 'host/' + target)
+
+    assert btrcp._backup_to_bucket ('host', sources, bucket, 'host/')
+    assert stale not in client.completed and client.uploads == {}
+    name = btrcp._parse_run_journal (bucket.read_text ('host/.btrcp-run'))['target']
+    assert name != target and 'host/' + name in client.objects
+
+
+def test_shards_that_are_not_written_again_are_aborted (sources, monkeypatch):
+    monkeypatch.setattr (btrcp.env, 'archive_shards', 2)
+    client = FakeClient()
+    bucket = objectstore.Bucket ('s3://bucket', client = client)
+    target = '2022-01-01-12-00.shards'
+    bucket.write_text ('host/.btrcp-run', btrcp._format_run_journal ({'strategy': 1, 'phase': 'transfer', 'target': target}))
+    resumed = _interrupted_upload (client, 'host/' + target + '/shard-001.tar.gz')
+    # The sources had been split into three shards by the interrupted run.
+    _interrupted_upload (client, 'host/' + target + '/shard-003.tar.gz')
+
+    assert btrcp._backup_to_bucket ('host', sources, bucket, 'host/')
+    assert resumed in client.completed and len (client.completed) == 2
+    assert client.uploads == {}
+    assert sorted (bucket.list_keys ('host/' + target + '/')) == ['host/' + target + '/' + n for n in ['shard-001.tar.gz', 'shard-002.tar.gz', 'shards']]
+
+
+def test_object_retention_removes_backups_by_their_keys():
+    client = FakeClient()
+    bucket = objectstore.Bucket ('s3://bucket/backups', client = client)
+    recent = datetime.datetime.now().strftime ('%Y-%m-%d-%H-%M.tar.gz')
+    for key in ['.btrcp-run', '2020-01-01-00-00.tar.gz', '2020-01-01-00-00.tar.gz.idx', '2020-02-01-00-00.tar.gz', '2020-02-01-00-00.tar.gz.idx', '2020-03-01-00-00.shards/shard-001.tar.gz', '2020-03-01-00-00.shards/shards', recent]:
+        bucket.write_text ('host/' + key, 'x')
+    bucket.write_text ('other/2020-02-01-00-00.tar.gz', 'x')
+
+    # The oldest backup of 2020 is retained.
+    btrcp._execute_object_retention (bucket, 'host/')
+    assert sorted (client.objects) == ['backups/host/' + k for k in ['.btrcp-run', '2020-01-01-00-00.tar.gz', '2020-01-01-00-00.tar.gz.idx', recent]] + ['backups/other/2020-02-01-00-00.tar.gz']
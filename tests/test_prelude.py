@@ -0,0 +1,18 @@
+import prelude
+
+
+def test_folds_are_linear_and_ordered():
+    assert prelude.foldl (range (100000), prelude.add, 0) == sum (range (100000))
+    assert prelude.foldl (['a', 'b', 'c'], prelude.add, 'd') == 'dabc'
+    assert prelude.foldr (['a', 'b', 'c'], prelude.add, 'd') == 'abcd'
+    assert prelude.foldr (iter (['a', 'b']), prelude.add, '') == 'ab'
+    assert prelude.foldl ([], prelude.add, 5) == 5
+
+
+def test_min_max_groupby_concat():
+    pairs = [(3, 'c'), (1, 'a'), (2, 'b'), (1, 'z')]
+    assert prelude.min (pairs, key_fn = prelude.fst) == (1, 'a')
+    assert prelude.max (pairs, key_fn = prelude.fst) == (3, 'c')
+    assert prelude.min (iter ([]), default = 'none') == 'none'
+    assert list (prelude.groupby ([1, 1, 2, 3, 3], prelude.identity)) == [(1, [1, 1]), (2, [2]), (3, [3, 3])]
+    assert list (prelude.concat (([1], iter ([2, 3]), []))) == [1, 2, 3]
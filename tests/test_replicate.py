@@ -0,0 +1,14 @@
+import replicate
+
+
+def test_plan_sends_resumes_after_the_last_common_snapshot():
+    names = ['2022-01-01-12-00', '2022-01-02-12-00', '2022-01-03-12-00', '2022-01-04-12-00']
+    # Nothing has been replicated: the first snapshot is sent completely.
+    assert replicate.plan_sends (names, set(), {}) == [(names[0], None), (names[1], names[0]), (names[2], names[1]), (names[3], names[2])]
+    # The replica has the first two snapshots; the third one has been taken
+    # of the first, the fourth one of a snapshot that has been removed.
+    parents = {names[2]: names[0], names[3]: '2021-12-31-12-00'}
+    assert replicate.plan_sends (names, set (names[:2]), parents) == [(names[2], names[0]), (names[3], names[2])]
+    # Snapshots the replica has but the host no longer has are not parents.
+    assert replicate.plan_sends (names[2:], set (['2021-12-31-12-00']), {names[2]: '2021-12-31-12-00'}) == [(names[2], None), (names[3], names[2])]
+    assert replicate.plan_sends (names, set (names), parents) == []
@@ -0,0 +1,61 @@
+import sys
+import threading
+
+import plumbum as pb
+
+import btrcp
+import restore
+from runcmdutils import Path
+from shards import split_into_shares
+
+
+def test_find_backup_skips_an_incomplete_snapshot (tmp_path):
+    hostDir = tmp_path / 'host'
+    for name in ['2022-01-01-12-00', '2022-01-02-12-00']:
+        (hostDir / name).mkdir (parents = True)
+    (hostDir / btrcp.env.run_journal_name).write_text (btrcp._format_run_journal ({'strategy': 3, 'phase': 'transfer', 'target': '2022-01-02-12-00'}))
+    dest = Path (str (tmp_path))
+    assert restore.find_backup ('host', dest, 'latest').get_last_part() == '2022-01-01-12-00'
+    assert restore.find_backup ('host', dest, '2022-01-02-12-00').get_last_part() == '2022-01-02-12-00'
+
+    # A newer archive is preferred to the snapshots.
+    (hostDir / '2022-01-03-12-00.tar.gz').write_bytes (b'')
+    assert restore.find_backup ('host', dest, 'latest').get_last_part() == '2022-01-03-12-00.tar.gz'
+    assert restore.find_backup ('host', dest, '2022-01-03-12-00').get_last_part() == '2022-01-03-12-00.tar.gz'
+    assert restore.find_backup ('host', dest, '2022-01-04-12-00') is None
+    assert restore.find_backup ('other', dest, 'latest') is None
+
+
+def test_list_backup_returns_files_and_dirs_below_the_paths (tmp_path):
+    (tmp_path / 'etc' / 'conf.d').mkdir (parents = True)
+    (tmp_path / 'etc' / 'hosts').write_bytes (b'x' * 10)
+    (tmp_path / 'etc' / 'conf.d' / 'a b').write_bytes (b'x' * 3)
+    (tmp_path / 'home').mkdir()
+    (tmp_path / 'home' / 'file').write_bytes (b'x')
+    files, dirs = restore._list_backup (Path (str (tmp_path)), ['/etc/'])
+    assert sorted (files) == [(3, 'etc/conf.d/a b'), (10, 'etc/hosts')]
+    assert sorted (dirs) == ['etc', 'etc/conf.d']
+    files, dirs = restore._list_backup (Path (str (tmp_path)), [])
+    assert len (files) == 3 and sorted (dirs) == ['etc', 'etc/conf.d', 'home']
+
+
+def test_files_are_split_into_shares_of_about_the_same_size():
+    files = [(10, 'a'), (7, 'b'), (5, 'c'), (4, 'd'), (1, 'e')]
+    assert split_into_shares (files, 2) == [['a', 'd'], ['b', 'c', 'e']]
+    # Shares without files are dropped.
+    assert split_into_shares (files[:2], 4) == [['a'], ['b']]
+
+
+def test_rsync_share_reads_errors_while_it_reads_the_output (monkeypatch):
+    # Fills the stderr pipe before anything is written to stdout.
+    script = 'import sys; sys.stderr.write ("e" * 200000); sys.stderr.flush(); print ("5 a"); print ("7 b"); sys.exit (23)'
+    monkeypatch.setattr (restore, 'mk_cmd', lambda args: pb.local[sys.executable]['-c', script])
+    progress = restore._Progress (12, 2)
+    results = [None]
+    worker = threading.Thread (target = restore._rsync_share, args = ('/src/', '/dst/', ['a', 'b'], progress, results, 0), daemon = True)
+    worker.start()
+    worker.join (30)
+    progress.stop()
+    assert not worker.is_alive()
+    assert results == [23]
+    assert (progress.bytes, progress.files) == (12, 2)
@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+import pytest
+
+import runcmdutils
+
+
+def test_run_cmd_many_keeps_order_and_runs_concurrently():
+    start = time.monotonic()
+    results = runcmdutils.run_cmds ([['sh', '-c', 'sleep 0.5; echo a'], ['sh', '-c', 'sleep 0.5; echo b']])
+    assert [r.stdout for r in results] == ['a\n', 'b\n']
+    assert [r.returncode for r in results] == [0, 0]
+    assert time.monotonic() - start < 0.9
+
+
+def test_run_cmds_works_within_a_running_event_loop():
+    async def main():
+        return runcmdutils.run_cmds ([['echo', 'a'], ['echo', 'b']])
+    assert [r.stdout for r in asyncio.run (main())] == ['a\n', 'b\n']
+
+
+def test_run_cmd_async_timeout_kills_process(tmp_path):
+    marker = tmp_path / 'marker'
+    with pytest.raises (asyncio.TimeoutError):
+        asyncio.run (runcmdutils.run_cmd_async (['sh', '-c', 'sleep 1; touch {0}'.format (marker)], timeout = 0.2))
+    time.sleep (1.2)
+    assert not marker.exists()
+
+
+def test_run_cmd_records_resource_usage():
+    res = runcmdutils.run_cmd (['sh', '-c', 'echo out; echo err >&2; exit 3'])
+    assert (res.returncode, res.stdout, res.stderr) == (3, 'out\n', 'err\n')
+    assert res.usage.machine == 'localhost'
+    assert res.usage.wallTime >= 0
+    assert res.usage.userTime is not None and res.usage.maxRss > 0
+    assert res.usage.command in runcmdutils.usage_summary (count = 1000)
+
+
+def test_path_is_an_immutable_value_sharing_its_location(tmp_path):
+    remote = runcmdutils.Path ('ssh://backup@example.com/srv/backups')
+    child = remote.join ('host', '2022-01-01-12-00')
+    assert child.full_path() == 'backup@example.com:/srv/backups/host/2022-01-01-12-00'
+    assert runcmdutils.Path ('ssh://example.com/srv/b').full_path() == 'example.com:/srv/b'
+    assert runcmdutils.Path ('example.com:/srv/b').full_path() == 'example.com:/srv/b'
+    assert child._location is runcmdutils.Path ('backup@example.com:/other')._location
+    assert child.strip_base (remote) == 'host/2022-01-01-12-00'
+    assert runcmdutils.Path ('/srv/backups2').strip_base (runcmdutils.Path ('/srv/backups')) is None
+    with pytest.raises (AttributeError):
+        child.path = '/elsewhere'
+
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b.txt').write_text ('b')
+    local = runcmdutils.Path (str (tmp_path))
+    assert not local.is_remote_path()
+    assert sorted ([p.get_last_part() for p in local.glob()]) == ['a', 'b.txt']
+    assert local.glob ('*/') == [local.join ('a')]
+
+
+def test_atomic_write_replaces_a_file_only_when_done(tmp_path, monkeypatch):
+    target = tmp_path / 'state' / 'file'
+    with runcmdutils.atomic_write (str (target), makeDirs = True, sync = True) as f:
+        f.write ('old\n')
+    with pytest.raises (ValueError):
+        with runcmdutils.atomic_write (str (target)) as f:
+            f.write ('new\n')
+            raise ValueError()
+    assert target.read_text() == 'old\n'
+    assert [p.name for p in target.parent.iterdir()] == ['file']
+
+    monkeypatch.setenv ('XDG_STATE_HOME', str (tmp_path))
+    assert runcmdutils.state_dir() == str (tmp_path / 'btrcp')
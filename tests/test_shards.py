@@ -0,0 +1,35 @@
+import pytest
+
+import manifest
+import shards
+
+
+def test_split_sources_balances_shares (tmp_path):
+    for name, size in [('a', 9000), ('b', 5000), ('c', 4000), ('d', 100)]:
+        (tmp_path / name).write_bytes (b'x' * size)
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'e').write_bytes (b'x' * 100)
+    (tmp_path / 'skip').mkdir()
+    (tmp_path / 'skip' / 'f').write_bytes (b'x' * 100)
+
+    shares = shards.split_sources ([str (tmp_path)], 2, excludes = [str (tmp_path / 'skip')])
+    assert len (shares) == 2
+    # The directories are archived with the first share.
+    assert str (tmp_path) in shares[0] and str (tmp_path / 'sub') in shares[0]
+    assert sorted ([p for s in shares for p in s if not p.endswith ('sub') and p != str (tmp_path)]) == [str (tmp_path / n) for n in ['a', 'b', 'c', 'd', 'sub/e']]
+    assert all (['skip' not in p for s in shares for p in s])
+    assert str (tmp_path / 'a') in shares[0] and str (tmp_path / 'b') in shares[1]
+
+
+def test_list_round_trip_and_selection():
+    text = shards.format_list ([('shard-001.tar.gz', ['/home', '/home/a', '/home/new\nline']), ('shard-002.tar.gz', ['/home/b', '/etc/hosts'])])
+    parsed = shards.parse_list (text)
+    assert parsed == [('shard-001.tar.gz', ['home', 'home/a', 'home/new\nline']), ('shard-002.tar.gz', ['home/b', 'etc/hosts'])]
+
+    assert shards.select_shards (parsed, []) == [('shard-001.tar.gz', []), ('shard-002.tar.gz', [])]
+    assert shards.select_shards (parsed, ['/etc']) == [('shard-002.tar.gz', ['/etc'])]
+    assert shards.select_shards (parsed, ['home/a', 'etc/hosts']) == [('shard-001.tar.gz', ['home/a']), ('shard-002.tar.gz', ['etc/hosts'])]
+    assert shards.select_shards (parsed, ['home/ab']) == []
+
+    with pytest.raises (manifest.ManifestError):
+        shards.parse_list ('something else\n')
@@ -0,0 +1,19 @@
+import sizes
+
+
+def test_parse_qgroups():
+    out = ('qgroupid         rfer         excl \n'
+           '--------         ----         ---- \n'
+           '0/5             16384        16384 \n'
+           '0/257      1073741824     52428800 \n'
+           '0/258      1073745920         4096 <stale>\n'
+           '1/100      2147487744   1073745920 \n')
+    assert sizes.parse_qgroups (out) == {5: (16384, 16384), 257: (1073741824, 52428800), 258: (1073745920, 4096)}
+    assert sizes.parse_qgroups ('') == {}
+
+
+def test_sizes_round_trip():
+    backupSizes = {'2022-01-01-12-00': {'id': 257, 'referenced': 1073741824, 'exclusive': 52428800, 'transferred': 52428800}}
+    assert sizes.parse_sizes (sizes.format_sizes (backupSizes)) == backupSizes
+    assert sizes.parse_sizes ('not json') == {}
+    assert sizes.parse_sizes ('{"a": 1, "b": {}}') == {'b': {}}
@@ -0,0 +1,38 @@
+import json
+
+import runcmdutils
+import tracing
+
+
+@tracing.traced()
+def _outer():
+    return runcmdutils.run_cmd (['true'])
+
+
+def test_trace_records_nested_spans_with_command_details(tmp_path):
+    traceFile = tmp_path / 'trace.json'
+    _outer()
+    tracing.start_trace()
+    _outer()
+    tracing.write_trace (str (traceFile))
+    assert not tracing.is_tracing()
+
+    events = [e for e in json.loads (traceFile.read_text())['traceEvents'] if e['ph'] == 'X']
+    outer, cmd = events
+    assert outer['name'] == '_outer'
+    assert cmd['name'] == 'exec_cmd'
+    assert cmd['args']['machine'] == 'localhost'
+    assert cmd['args']['returncode'] == '0'
+    assert cmd['args']['command'].endswith ('true')
+    assert outer['ts'] <= cmd['ts'] and cmd['ts'] + cmd['dur'] <= outer['ts'] + outer['dur']
+
+
+def test_phases_are_collected_without_a_trace():
+    with tracing.collect_phases() as phases:
+        _outer()
+        _outer()
+    _outer()
+    assert not tracing.is_tracing()
+    assert sorted (phases) == ['_outer', 'exec_cmd']
+    assert phases['_outer'][1] == 2 and phases['exec_cmd'][1] == 2
+    assert phases['_outer'][0] >= phases['exec_cmd'][0] > 0
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+# Records nested, timed spans of a backup run and writes them as a trace
+# file in the Chrome trace event format, which can be loaded into trace
+# viewers like chrome://tracing or Perfetto.
+#
+# Spans are only recorded after start_trace() has been called; before that
+# span() and traced() cost hardly more than a function call. Independent of
+# the trace, the total time spent in each span can be collected for the
+# spans of a thread, see collect_phases().
+
+
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+
+
+# The recorded trace events, or None if tracing is off.
+_events = None
+_lock = threading.Lock()
+_startTime = 0
+
+# The phase times collected for the current thread, see collect_phases().
+_phases = threading.local()
+
+
+
+# Turns tracing on and drops the spans that have been recorded so far.
+def start_trace():
+    global _events, _startTime
+    with _lock:
+        _events = []
+        _startTime = time.perf_counter()
+
+
+
+# Returns True if spans are being recorded.
+def is_tracing():
+    return _events is not None
+
+
+
+# Measures the time spent in a with-block as a span with the given name.
+# The keyword arguments are stored with the span, and the with-block can
+# add further arguments to the yielded dictionary, e.g. a return code.
+# Spans of the same thread that lie within each other are shown nested.
+@contextlib.contextmanager
+def span (name, **args):
+    phases = getattr (_phases, 'current', None)
+    if (_events is None and phases is None):
+        yield args
+        return
+
+    begin = time.perf_counter()
+    try:
+        yield args
+    finally:
+        end = time.perf_counter()
+        if (phases is not None):
+            total = phases.setdefault (name, [0.0, 0])
+            total[0] += end - begin
+            total[1] += 1
+        if (_events is not None):
+            event = {
+                'name': name,
+                'ph': 'X',
+                'ts': (begin - _startTime) * 1e6,
+                'dur': (end - begin) * 1e6,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': {k: str(v) for k, v in args.items()}
+            }
+            with _lock:
+                if (_events is not None):
+                    _events.append (event)
+
+
+
+# A decorator that records each call of the function as a span, which is
+# named after the function unless a name is given.
+def traced (name = None):
+    def decorator (fn):
+        spanName = name or fn.__name__
+
+        @functools.wraps (fn)
+        def wrapper (*args, **kwargs):
+            if (_events is None and getattr (_phases, 'current', None) is None):
+                return fn (*args, **kwargs)
+            with span (spanName):
+                return fn (*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+
+# Collects the total time and the number of the spans of the current thread
+# during the with-block, by the name of the span, and yields them as a
+# dictionary that maps each name to a list of the seconds and the count.
+# Spans of the same name that lie within each other are counted each.
+@contextlib.contextmanager
+def collect_phases():
+    previous = getattr (_phases, 'current', None)
+    _phases.current = {}
+    try:
+        yield _phases.current
+    finally:
+        _phases.current = previous
+
+
+
+# Writes the spans recorded so far to the trace file and turns tracing off.
+def write_trace (traceFile):
+    global _events
+    with _lock:
+        events, _events = _events or [], None
+
+    # Name the threads, so that the viewer shows which spans belong to the
+    # main thread and which to worker threads.
+    threadNames = {t.ident: t.name for t in threading.enumerate()}
+    metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': threadNames.get (tid, str(tid))}}
+        for tid in sorted ({e['tid'] for e in events})]
+
+    with open (traceFile, 'w') as f:
+        json.dump ({'traceEvents': metadata + sorted (events, key = lambda e: e['ts']), 'displayTimeUnit': 'ms'}, f)